@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the cache backends on the operations of the token cache.
+
+Run from the directory holding ini/config.ini, Redis is skipped when it
+cannot be reached:
+
+    python benchmarks/bench_cache_backends.py --keys 10000
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import uuid
+
+import redis
+
+from stealth.impl_rax import cache_backend
+from stealth.impl_rax import token_validation
+
+
+def make_keys(count):
+    return ['bench:{0}'.format(uuid.uuid4().hex) for i in range(count)]
+
+
+def timed(func, keys, repeat):
+    """Best microseconds per key of func over repeat runs"""
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        func(keys)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best * 1e6 / len(keys)
+
+
+def bench(backend, keys, value, repeat, batch):
+    def store(keys):
+        # As _send_data_to_cache, record and index in one pipeline
+        for key in keys:
+            with backend.pipeline(transaction=True) as pipe:
+                pipe.set(key, value, px=600000)
+                pipe.set(key + ':index', key, px=600000)
+                pipe.execute()
+
+    def retrieve(keys):
+        for key in keys:
+            backend.get(key)
+
+    def batch_retrieve(keys):
+        for i in range(0, len(keys), batch):
+            backend.mget(keys[i:i + batch])
+
+    def add(keys):
+        for key in keys:
+            backend.set(key + ':lease', 'lease', nx=True, px=600000)
+
+    try:
+        return [timed(func, keys, repeat)
+            for func in (store, retrieve, batch_retrieve, add)]
+    finally:
+        for key in keys:
+            backend.delete(key, key + ':index', key + ':lease')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--keys', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--batch', type=int, default=100)
+    parser.add_argument('--value-size', type=int, default=200)
+    args = parser.parse_args()
+
+    keys = make_keys(args.keys)
+    value = os.urandom(args.value_size)
+    directory = tempfile.mkdtemp()
+    backends = [('memory', cache_backend.MemoryBackend()),
+        ('sqlite', cache_backend.SQLiteBackend(
+            os.path.join(directory, 'cache.db')))]
+    try:
+        client = token_validation.get_auth_redis_client()
+        client.ping()
+        backends.insert(0, ('redis', client))
+    except redis.RedisError as ex:
+        print('Skipping redis: {0}'.format(ex))
+
+    print('{0:<8} {1:>10} {2:>12} {3:>10} {4:>10}'.format('backend',
+        'store us', 'retrieve us', 'mget us', 'add us'))
+    try:
+        for name, backend in backends:
+            results = bench(backend, keys, value, args.repeat, args.batch)
+            print('{0:<8} {1:>10.2f} {2:>12.2f} {3:>10.2f} {4:>10.2f}'.format(
+                name, *results))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
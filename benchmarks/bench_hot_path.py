@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Times each step of the cache-hit path, against the in-repo baselines.
+
+Timings are compared as multiples of a pure Python calibration loop, so
+the baselines hold across machines of different speeds.  The exit status
+is 1 when a step is slower than its baseline by more than the tolerance.
+Run from the directory holding ini/config.ini:
+
+    python benchmarks/bench_hot_path.py
+    python benchmarks/bench_hot_path.py --save    # after a deliberate change
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+import timeit
+
+import falcon
+from falcon import testing as ftest
+
+import stealth
+from stealth.common import context
+from stealth.impl_rax import auth_token_cache
+from stealth.impl_rax.auth_token import TokenBase
+from stealth.transport.wsgi import hooks
+import stealth.util.log as logging
+
+
+BASELINES = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+    'baselines', 'hot_path.json')
+
+
+def calibration():
+    total = 0
+    for i in range(100):
+        total += i
+    return total
+
+
+def make_steps():
+    """Name and callable of each step, set up as on a cache hit"""
+    expires_ms = int(time.time() * 1000) + 3600000
+    data = {'token': 'a' * 32, 'tenant': '1234567',
+        'expires': time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+            time.gmtime(expires_ms // 1000)),
+        'expires_ms': expires_ms}
+    json_record = json.dumps(data).encode('utf-8')
+    origval = stealth.conf.auth_redis.record_format
+    try:
+        stealth.conf.auth_redis.record_format = 'msgpack'
+        msgpack_record = auth_token_cache._encode_record(data)
+    finally:
+        stealth.conf.auth_redis.record_format = origval
+    expires = TokenBase.normal_time(data['expires'])
+
+    adapter = logging.getLogger('stealth.benchmark')
+    context.current.set(context.RequestContext())
+
+    env = ftest.create_environ(path='/auth',
+        headers={'X-Project-ID': '1234567'})
+    req, resp = falcon.Request(env), falcon.Response()
+
+    def hook_pair():
+        hooks.ContextHook(req, resp, {})
+        hooks.TransactionidHook(req, resp, {})
+
+    return [
+        ('calibration', calibration),
+        ('generate_cache_key',
+            lambda: auth_token_cache._generate_cache_key('1234567')),
+        ('decode_record_json',
+            lambda: auth_token_cache._decode_record(json_record)),
+        ('decode_record_msgpack',
+            lambda: auth_token_cache._decode_record(msgpack_record)),
+        ('normal_time', lambda: TokenBase.normal_time(data['expires'])),
+        ('will_expire_soon', lambda: TokenBase.will_expire_soon(expires)),
+        ('will_expire_soon_ms',
+            lambda: TokenBase.will_expire_soon_ms(expires_ms)),
+        ('request_context', context.RequestContext),
+        ('context_adapter_process',
+            lambda: adapter.process('message', {})),
+        ('context_transaction_hooks', hook_pair),
+    ]
+
+
+def measure(func, repeat, number):
+    """Best nanoseconds per call of func"""
+    return min(timeit.repeat(func, repeat=repeat, number=number)) * \
+        1e9 / number
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=20000)
+    parser.add_argument('--repeat', type=int, default=7)
+    parser.add_argument('--tolerance', type=float, default=1.5,
+        help='slowdown over the baseline counted as a regression')
+    parser.add_argument('--save', action='store_true',
+        help='store the timings as the new baselines')
+    args = parser.parse_args()
+
+    steps = make_steps()
+    results = dict((name, measure(func, args.repeat, args.number))
+        for name, func in steps)
+    unit = results['calibration']
+
+    baselines = {}
+    if os.path.exists(BASELINES):
+        with open(BASELINES) as f:
+            baselines = json.load(f)
+
+    regressions = []
+    print('{0:<28} {1:>10} {2:>10} {3:>10}'.format('step', 'ns/call',
+        'relative', 'baseline'))
+    for name, func in steps:
+        relative = results[name] / unit
+        baseline = baselines.get(name)
+        flag = ''
+        if baseline is not None and relative > baseline * args.tolerance:
+            flag = ' REGRESSION'
+            regressions.append(name)
+        print('{0:<28} {1:>10.0f} {2:>10.2f} {3:>10}{4}'.format(name,
+            results[name], relative, '-' if baseline is None else
+            '{0:.2f}'.format(baseline), flag))
+
+    if args.save:
+        with open(BASELINES, 'w') as f:
+            json.dump(dict((name, round(value / unit, 2))
+                for name, value in results.items()), f, indent=4,
+                sort_keys=True)
+            f.write('\n')
+        print('Baselines saved to {0}'.format(BASELINES))
+    elif regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,406 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Load test of the authentication paths against a fake Keystone.
+
+A stand-in Keystone, with the given latency, error rate and users per
+tenant, serves on 127.0.0.1.  The middleware, the uWSGI app or the falcon
+/auth route are called by concurrent clients picking their tenants from a
+Zipf distribution, and presenting the token they were last given most of
+the time.  The cache is an in-memory, a SQLite or the configured Redis
+backend.  The random seed makes runs reproducible.
+
+Run from the directory holding ini/config.ini:
+
+    python benchmarks/bench_load.py --target app --cache memory \\
+        --requests 20000 --tenants 5000 --keystone-latency 50
+"""
+
+import argparse
+import collections
+import json
+import os
+import random
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+from http import server
+
+from falcon import testing as ftest
+
+from stealth import conf
+from stealth.impl_rax import auth_app
+from stealth.impl_rax import auth_middleware
+from stealth.impl_rax import cache_backend
+from stealth.impl_rax import token_validation
+
+
+TARGETS = ('middleware', 'app', 'falcon')
+CACHES = ('memory', 'sqlite', 'redis')
+
+
+class Counter(object):
+
+    """Thread-safe counts by name"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = collections.Counter()
+
+    def inc(self, name, amount=1):
+        with self._lock:
+            self._counts[name] += amount
+
+    def total(self):
+        with self._lock:
+            return sum(self._counts.values())
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def clear(self):
+        with self._lock:
+            self._counts.clear()
+
+
+class FakeKeystone(object):
+
+    """Keystone v2 with the RAX-AUTH extensions, over HTTP
+
+    :param latency: milliseconds each call takes, with +-50% jitter
+    :param error_rate: fraction of the tenant calls answered with a 500
+    :param users: users listed per tenant
+    """
+
+    def __init__(self, latency=0.0, error_rate=0.0, users=1, seed=0):
+        self.calls = Counter()
+        self._latency = latency / 1000.0
+        self._error_rate = error_rate
+        self._users = users
+        self._random = random.Random(seed)
+        self._random_lock = threading.Lock()
+        self._server = server.ThreadingHTTPServer(('127.0.0.1', 0),
+            self._handler())
+        self._server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{0}'.format(self._server.server_port)
+
+    def start(self):
+        thread = threading.Thread(target=self._server.serve_forever,
+            name='fake-keystone')
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def _draw(self):
+        with self._random_lock:
+            return self._random.random()
+
+    def _respond(self, path, body):
+        parts = path.strip('/').split('/')
+        if parts == ['tokens']:
+            # The admin login is never failed, it is not what is measured
+            return 'admin_tokens', 200, self._token()
+        if self._latency:
+            time.sleep(self._latency * (0.5 + self._draw()))
+        if self._draw() < self._error_rate:
+            return 'errors', 500, {}
+        if len(parts) == 3 and parts[0] == 'tenants' and \
+                parts[2] == 'users':
+            return 'tenant_users', 200, {'users': [
+                {'id': '{0}:{1}'.format(parts[1], i)}
+                for i in range(self._users)]}
+        if len(parts) == 4 and parts[0] == 'users' and \
+                parts[2:] == ['RAX-AUTH', 'admins']:
+            tenant = parts[1].split(':')[0]
+            return 'user_admins', 200, {'users': [
+                {'username': 'admin-{0}'.format(tenant)}]}
+        if parts == ['RAX-AUTH', 'impersonation-tokens']:
+            return 'impersonation_tokens', 200, self._token()
+        return 'not_found', 404, {}
+
+    def _token(self):
+        expires = time.strftime('%Y-%m-%dT%H:%M:%S.000Z',
+            time.gmtime(time.time() + 86400))
+        return {'access': {'token': {'id': uuid.uuid4().hex,
+            'expires': expires}}}
+
+    def _handler(self):
+        keystone = self
+
+        class Handler(server.BaseHTTPRequestHandler):
+
+            protocol_version = 'HTTP/1.1'
+            # The headers and the body go out in two writes, which Nagle's
+            # algorithm would hold back for the delayed ACK of the client
+            disable_nagle_algorithm = True
+
+            def _serve(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = self.rfile.read(length) if length else b''
+                endpoint, status, data = keystone._respond(self.path, body)
+                keystone.calls.inc(endpoint)
+                payload = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = _serve
+            do_POST = _serve
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+
+def counting(backend_class, ops):
+    """backend_class counting its commands in ops, by command"""
+
+    def command(name):
+        def counted(self, *args, **kwargs):
+            ops.inc(name)
+            return getattr(super(Counting, self), name)(*args, **kwargs)
+        return counted
+
+    if issubclass(backend_class, cache_backend.RedisBackend):
+        class Counting(backend_class):
+
+            def execute_command(self, *args, **options):
+                ops.inc(args[0].lower())
+                return super(Counting, self).execute_command(*args,
+                    **options)
+
+            def pipeline(self, transaction=True, shard_hint=None):
+                pipe = super(Counting, self).pipeline(transaction,
+                    shard_hint)
+                execute, immediate = pipe.execute, \
+                    pipe.immediate_execute_command
+
+                def counted_execute(*args, **kwargs):
+                    for command_args, options in pipe.command_stack:
+                        ops.inc(command_args[0].lower())
+                    return execute(*args, **kwargs)
+
+                def counted_immediate(*args, **options):
+                    ops.inc(args[0].lower())
+                    return immediate(*args, **options)
+
+                pipe.execute = counted_execute
+                pipe.immediate_execute_command = counted_immediate
+                return pipe
+    else:
+        class Counting(backend_class):
+            pass
+        # The pipelines of the local backends call these too
+        for name in ('get', 'set', 'delete', 'mget', 'pttl', 'publish'):
+            setattr(Counting, name, command(name))
+    return Counting
+
+
+def make_cache(name, ops, directory):
+    if name == 'memory':
+        return counting(cache_backend.MemoryBackend, ops)()
+    if name == 'sqlite':
+        return counting(cache_backend.SQLiteBackend, ops)(
+            os.path.join(directory, 'cache.db'))
+    client = token_validation.get_auth_redis_client()
+    return counting(cache_backend.RedisBackend, ops)(
+        connection_pool=client.connection_pool)
+
+
+def make_target(name, cache):
+    if name == 'middleware':
+        def downstream(env, start_response):
+            start_response('204 No Content', [])
+            return []
+        return auth_middleware.wrap(downstream, cache)
+    if name == 'app':
+        return auth_app.app(cache)
+
+    from stealth.impl_rax import auth_endpoint
+    from stealth.transport.wsgi import Driver
+    from stealth.transport.wsgi.v1_0 import controller_auth
+    controller_auth.authserv = auth_endpoint.AuthServ(cache)
+    return Driver().app
+
+
+class Zipf(object):
+
+    """Tenants by popularity, the k-th most popular with weight 1/k^s"""
+
+    def __init__(self, tenants, exponent, rng):
+        self.tenants = [str(1000000 + i) for i in range(tenants)]
+        self._weights = list(_cumulative(
+            1.0 / (k ** exponent) for k in range(1, tenants + 1)))
+        self._rng = rng
+
+    def pick(self):
+        return self._rng.choices(self.tenants,
+            cum_weights=self._weights)[0]
+
+
+def _cumulative(values):
+    total = 0.0
+    for value in values:
+        total += value
+        yield total
+
+
+def _response_token(headers):
+    for name, value in headers:
+        if name.lower() in ('x-auth-token', 'http_x_auth_token'):
+            return value
+    return None
+
+
+def run(app, args, seed):
+    """Drive app with args.concurrency clients for args.requests requests
+
+    :returns: latencies in seconds, and the counts by status
+    """
+    remaining = [args.requests]
+    lock = threading.Lock()
+    latencies = []
+    statuses = collections.Counter()
+
+    def client(index):
+        rng = random.Random(seed * 1000 + index)
+        tenants = Zipf(args.tenants, args.zipf, rng)
+        tokens = {}
+        mine = []
+        seen = collections.Counter()
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    break
+                remaining[0] -= 1
+            tenant = tenants.pick()
+            headers = {'X-Project-ID': tenant}
+            if tenant in tokens and rng.random() < args.token_reuse:
+                headers['X-Auth-Token'] = tokens[tenant]
+            env = ftest.create_environ(path='/auth', headers=headers)
+            response = {}
+
+            def start_response(status, headers, exc_info=None):
+                response['status'] = status
+                response['headers'] = headers
+
+            start = time.time()
+            for chunk in app(env, start_response):
+                pass
+            mine.append(time.time() - start)
+            seen[response['status'].split(' ')[0]] += 1
+            token = _response_token(response['headers'])
+            if token:
+                tokens[tenant] = token
+
+        with lock:
+            latencies.extend(mine)
+            statuses.update(seen)
+
+    threads = [threading.Thread(target=client, args=(i,))
+        for i in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return latencies, statuses
+
+
+def percentile(values, fraction):
+    return values[int(fraction * (len(values) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip(),
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--target', choices=TARGETS, default='app')
+    parser.add_argument('--cache', choices=CACHES, default='memory')
+    parser.add_argument('--requests', type=int, default=10000)
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--tenants', type=int, default=1000)
+    parser.add_argument('--zipf', type=float, default=1.1,
+        help='exponent of the tenant popularity')
+    parser.add_argument('--token-reuse', type=float, default=0.9,
+        help='fraction of the requests presenting the last token given')
+    parser.add_argument('--keystone-latency', type=float, default=20.0,
+        help='milliseconds')
+    parser.add_argument('--keystone-errors', type=float, default=0.0,
+        help='fraction of the Keystone calls failing')
+    parser.add_argument('--users', type=int, default=1,
+        help='users per tenant')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    keystone = FakeKeystone(args.keystone_latency, args.keystone_errors,
+        args.users, seed=args.seed)
+    keystone.start()
+    conf.auth.auth_url = keystone.url
+    conf.auth.admin_name = 'admin'
+    conf.auth.admin_pass = 'secret'
+    # Neither the flushes nor the pubsub are part of what is measured
+    conf.metrics.aggregate = False
+    conf.local_cache.invalidation = False
+
+    ops = Counter()
+    directory = tempfile.mkdtemp()
+    try:
+        cache = make_cache(args.cache, ops, directory)
+        app = make_target(args.target, cache)
+        keystone.calls.clear()
+        ops.clear()
+
+        start = time.time()
+        latencies, statuses = run(app, args, args.seed)
+        elapsed = time.time() - start
+    finally:
+        keystone.stop()
+        shutil.rmtree(directory)
+
+    latencies.sort()
+    count = len(latencies)
+    print('{0} with the {1} cache, {2} requests, {3} clients, {4} '
+        'tenants'.format(args.target, args.cache, count, args.concurrency,
+        args.tenants))
+    print('{0:<30} {1:>12.1f}'.format('requests/s', count / elapsed))
+    print('{0:<30} {1:>12.2f}'.format('p50 ms',
+        percentile(latencies, 0.5) * 1000))
+    print('{0:<30} {1:>12.2f}'.format('p99 ms',
+        percentile(latencies, 0.99) * 1000))
+    print('{0:<30} {1:>12.3f}'.format('keystone calls/request',
+        float(keystone.calls.total()) / count))
+    print('{0:<30} {1:>12.3f}'.format('cache ops/request',
+        float(ops.total()) / count))
+    for status, seen in sorted(statuses.items()):
+        print('{0:<30} {1:>12}'.format('status ' + status, seen))
+    for endpoint, calls in sorted(keystone.calls.snapshot().items()):
+        print('{0:<30} {1:>12}'.format('keystone ' + endpoint, calls))
+    for command, calls in sorted(ops.snapshot().items()):
+        print('{0:<30} {1:>12}'.format('cache ' + command, calls))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Compares the size and the decode time of the cache record formats.
+
+msgpack records are about a third smaller.  Which format decodes faster
+depends on the machine and the Python build, measure before relying on
+either.
+
+Run from the directory holding ini/config.ini:
+
+    python benchmarks/bench_record_format.py --records 10000
+"""
+
+import argparse
+import random
+import time
+import uuid
+
+from stealth import conf
+from stealth.impl_rax import auth_token_cache
+
+
+def make_records(count):
+    """Token data shaped like the impersonation tokens we cache."""
+    records = []
+    for i in range(count):
+        expires_ms = int(time.time() * 1000) + random.randint(0, 10800000)
+        records.append({
+            'token': uuid.uuid4().hex,
+            'tenant': str(random.randrange(100000, 9999999)),
+            'expires': '{0}.{1:03d}Z'.format(
+                time.strftime('%Y-%m-%dT%H:%M:%S',
+                    time.gmtime(expires_ms // 1000)),
+                expires_ms % 1000),
+            'expires_ms': expires_ms})
+    return records
+
+
+def bench(record_format, records, repeat):
+    conf.auth_redis.record_format = record_format
+    encoded = [auth_token_cache._encode_record(data) for data in records]
+    size = sum(len(record) for record in encoded)
+
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        for record in encoded:
+            auth_token_cache._decode_record(record)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return size, best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip())
+    parser.add_argument('--records', type=int, default=10000)
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    origval = conf.auth_redis.record_format
+    print('{0:<8} {1:>12} {2:>16}'.format('format', 'bytes/record',
+        'decode us/record'))
+    try:
+        for record_format in ('json', 'msgpack'):
+            size, elapsed = bench(record_format, records, args.repeat)
+            print('{0:<8} {1:>12.1f} {2:>16.2f}'.format(record_format,
+                float(size) / len(records), elapsed * 1e6 / len(records)))
+    finally:
+        conf.auth_redis.record_format = origval
+
+
+if __name__ == '__main__':
+    main()
@@ -40,6 +40,7 @@ else:
         author_email='xuanyu1@yahoo.com',
         include_package_data=True,
         install_requires=REQUIRES,
+        extras_require={'asgi': ['httpx']},
         test_suite='stealth',
         zip_safe=False,
         entry_points={
@@ -29,6 +29,6 @@ def example_app(env, start_response):
     return []
 
 
-auth_redis_client = token_validation.get_auth_redis_client()
+auth_redis_client = token_validation.get_cache_backend()
 
 app = auth_middleware.wrap(example_app, auth_redis_client)
@@ -14,6 +14,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import contextvars
 import uuid
 
 
@@ -26,3 +27,8 @@ class RequestContext(object):
 
     def __init__(self):
         self.request_id = 'req-' + str(uuid.uuid4())
+
+
+# Context of the request being served.  Unlike a thread local, it follows
+# the request across the asyncio tasks serving it.
+current = contextvars.ContextVar('stealth_request_context', default=None)
@@ -0,0 +1,100 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import threading
+import time
+
+
+class LRUCache(object):
+
+    """Bounded, thread-safe mapping with per-entry expiry.
+
+    Entries are dropped once they expire, and the least recently used
+    entries are evicted when the cache holds more than max_entries entries
+    or more than max_bytes of their declared sizes.
+    """
+
+    def __init__(self, max_entries, max_bytes=None):
+        self._max_entries = max_entries
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._data = collections.OrderedDict()
+        self._bytes = 0
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._expirations = 0
+
+    def get(self, key):
+        """Return the live value of key, or None"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self._misses += 1
+                return None
+            value, expires_at, size = entry
+            if expires_at <= time.time():
+                del self._data[key]
+                self._bytes -= size
+                self._expirations += 1
+                self._misses += 1
+                return None
+            self._data.move_to_end(key)
+            self._hits += 1
+            return value
+
+    def set(self, key, value, expires_at, size=0):
+        """Store value under key until the epoch expires_at
+
+        :param size: approximate memory used by the entry, in bytes
+        """
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[2]
+            self._data[key] = (value, expires_at, size)
+            self._bytes += size
+            while len(self._data) > self._max_entries or \
+                    (self._max_bytes is not None and
+                     self._bytes > self._max_bytes and self._data):
+                evicted = self._data.popitem(last=False)[1]
+                self._bytes -= evicted[2]
+                self._evictions += 1
+
+    def delete(self, key):
+        """Drop key from the cache"""
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._bytes -= entry[2]
+
+    def clear(self):
+        """Drop every entry"""
+        with self._lock:
+            self._data.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Hit, miss and eviction counters along with the current size"""
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses,
+                'evictions': self._evictions,
+                'expirations': self._expirations,
+                'entries': len(self._data), 'bytes': self._bytes}
+
+    def __len__(self):
+        return len(self._data)
@@ -0,0 +1,303 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Admin token shared by the whole fleet.
+#
+# A background thread renews the admin token ahead of its expiry.  The
+# current token is published in Redis, and a lease elects the one worker
+# logging in to Keystone; the others adopt the token it publishes.
+#
+
+import os
+import threading
+import time
+import uuid
+import weakref
+import stealth.util.log as logging
+from stealth import conf
+from stealth.impl_rax.auth_token import AdminToken
+from stealth.impl_rax.auth_token_cache import _encode_record, \
+    _decode_record, _generate_cache_key
+from stealth.impl_rax.single_flight import RedisSingleFlight
+
+
+LOG = logging.getLogger(__name__)
+
+# Managers whose refresher threads are restarted in forked children
+_managers = weakref.WeakSet()
+
+# Managers of get_admin_token() by Keystone URL and admin user
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+class AdminTokenManager(AdminToken):
+
+    """Admin token renewed in the background and shared over Redis.
+
+    Request threads read the current token without waiting, unless none
+    is usable yet.  Renewals are serialized by a lock within the process,
+    and by a lease in Redis across processes and hosts.
+
+    :param url: Keystone Identity URL to authenticate against
+    :param tenant: admin user name
+    :param passwd: admin password
+    :param redis_client: redis.Redis object sharing the token, the token is
+                         only renewed within the process without it
+    :param fraction: part of the token lifetime after which it is renewed
+    :param lease_ttl: seconds a worker may hold the login lease
+    :param wait: seconds to wait on another worker's login
+    :param retry_interval: seconds between failed renewals
+    :param poll_interval: seconds between two looks at the shared token
+    """
+
+    def __init__(self, url, tenant, passwd, redis_client=None,
+            fraction=0.75, lease_ttl=10.0, wait=5.0, retry_interval=5.0,
+            poll_interval=0.05):
+        self._redis_client = redis_client
+        self._fraction = fraction
+        self._lease_ms = int(lease_ttl * 1000)
+        self._wait = wait
+        self._retry_interval = retry_interval
+        self._poll_interval = poll_interval
+        self._shared_key = 'admin_token:{0}'.format(
+            _generate_cache_key('{0}|{1}'.format(url, tenant)))
+        self._lease_key = 'lease:{0}'.format(self._shared_key)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._stats = {'logins': 0, 'adopted': 0, 'failures': 0}
+        super(AdminTokenManager, self).__init__(url=url, tenant=tenant,
+            passwd=passwd)
+        _managers.add(self)
+        self.start()
+
+    def _is_due(self, issued_ms, expires_ms):
+        renew_at = issued_ms + (expires_ms - issued_ms) * self._fraction
+        return time.time() * 1000 >= renew_at or \
+            self.will_expire_soon_ms(expires_ms)
+
+    def _update_token(self):
+        with self._lock:
+            # Another thread may have renewed it while this one waited
+            if self._token is not None and \
+                    not self._is_due(self._issued_ms, self._expires_ms):
+                return
+            if self._adopt_shared():
+                return
+            self._login()
+
+    def _read_shared(self):
+        """The token published in Redis, or None if it is due for renewal"""
+        try:
+            record = self._redis_client.get(self._shared_key)
+            if record is None:
+                return None
+            data = _decode_record(record)
+        except Exception as ex:
+            LOG.debug(('Admin token: Failed to read the shared token - '
+                '%(s_except)s'), {
+                's_except': ex
+            })
+            return None
+
+        if 'issued_ms' not in data or \
+                self._is_due(data['issued_ms'], data['expires_ms']):
+            return None
+        return data
+
+    def _adopt_shared(self):
+        if self._redis_client is None:
+            return False
+        data = self._read_shared()
+        if data is None:
+            return False
+        self._token = data['token']
+        self._expires = data['expires']
+        self._expires_ms = data['expires_ms']
+        self._issued_ms = data['issued_ms']
+        self._stats['adopted'] += 1
+        return True
+
+    def _login(self):
+        """Log in, once across the fleet when the token is shared"""
+        if self._redis_client is None:
+            return self._login_locally()
+
+        lease_id = str(uuid.uuid4())
+        deadline = time.time() + self._wait
+        while True:
+            try:
+                acquired = self._redis_client.set(self._lease_key, lease_id,
+                    nx=True, px=self._lease_ms)
+            except Exception as ex:
+                LOG.debug(('Admin token: Failed to take the login lease - '
+                    '%(s_except)s'), {
+                    's_except': ex
+                })
+                return self._login_locally()
+
+            if acquired:
+                try:
+                    self._login_locally()
+                    self._publish()
+                finally:
+                    RedisSingleFlight._release(self._redis_client,
+                        self._lease_key, lease_id)
+                return
+
+            if self._adopt_shared():
+                return
+
+            if time.time() >= deadline:
+                LOG.debug('Admin token: Gave up waiting on the login lease')
+                self._login_locally()
+                self._publish()
+                return
+
+            time.sleep(self._poll_interval)
+
+    def _login_locally(self):
+        try:
+            super(AdminTokenManager, self)._update_token()
+            self._stats['logins'] += 1
+        except Exception:
+            self._stats['failures'] += 1
+            raise
+
+    def _publish(self):
+        data = self._snapshot()
+        try:
+            self._redis_client.set(self._shared_key, _encode_record(data),
+                pxat=self._expires_ms)
+        except Exception as ex:
+            LOG.debug(('Admin token: Failed to publish the shared token - '
+                '%(s_except)s'), {
+                's_except': ex
+            })
+
+    def _snapshot(self):
+        """The current token data, without renewing it"""
+        return {'token': self._token, 'tenant': self._tenant,
+            'expires': self._expires, 'expires_ms': self._expires_ms,
+            'issued_ms': self._issued_ms}
+
+    def _next_renewal(self):
+        """Seconds until the token is due for renewal"""
+        if self._token is None or \
+                self._is_due(self._issued_ms, self._expires_ms):
+            return self._retry_interval
+        renew_at = self._issued_ms + \
+            (self._expires_ms - self._issued_ms) * self._fraction
+        return max(0.0, renew_at / 1000.0 - time.time())
+
+    def start(self):
+        """Start the background refresher, once per process
+
+        The refresher only holds a weak reference to the manager, and exits
+        once the manager is released.
+        """
+        if self._thread is None or not self._thread.is_alive():
+            self._stopped.clear()
+            weakref.finalize(self, self._stopped.set)
+            self._thread = threading.Thread(target=_run,
+                args=(weakref.ref(self), self._stopped),
+                name='stealth-admin-token')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        """Ask the background refresher to exit"""
+        self._stopped.set()
+
+    def stats(self):
+        """Keystone login, adopted shared token and failure counters"""
+        return dict(self._stats)
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+        self.start()
+
+
+def _run(ref, stopped):
+    """Renew the token of the manager behind ref until it is released"""
+    while True:
+        manager = ref()
+        if manager is None:
+            return
+        delay = manager._next_renewal()
+        del manager
+        if stopped.wait(delay):
+            return
+
+        manager = ref()
+        if manager is None:
+            return
+        try:
+            manager._update_token()
+        except Exception as ex:
+            LOG.error(('Admin token: Failed to renew the admin token - '
+                '%(s_except)s'), {
+                's_except': ex
+            })
+        del manager
+
+
+def get_admin_token(url, tenant, passwd, redis_client=None):
+    """The admin token manager of url and tenant, from the [auth] settings
+
+    A single manager, and refresher thread, is kept per Keystone URL and
+    admin user in the process.  It is built, with its Keystone login,
+    without holding the lock of the others; of concurrent callers, the
+    first manager kept wins.
+    """
+    key = (url, tenant)
+    with _shared_lock:
+        manager = _shared.get(key)
+    if manager is None:
+        built = AdminTokenManager(url, tenant, passwd,
+            redis_client=redis_client,
+            fraction=conf.auth.admin_refresh_ahead,
+            lease_ttl=conf.auth.admin_lease_ttl,
+            wait=conf.auth.admin_lease_wait,
+            retry_interval=conf.auth.admin_retry_interval)
+        with _shared_lock:
+            manager = _shared.setdefault(key, built)
+        if manager is built:
+            return manager
+        built.stop()
+
+    if manager._passwd != passwd or \
+            (manager._redis_client is None) != (redis_client is None):
+        LOG.warning(('Admin token: Reusing the manager of %(s_tenant)s '
+            'built with another password or Redis client'), {
+            's_tenant': tenant
+        })
+    manager.start()
+    return manager
+
+
+def _restart_in_child():
+    global _shared_lock
+    _shared_lock = threading.Lock()
+    for manager in list(_managers):
+        manager._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_in_child)
@@ -0,0 +1,116 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# ASGI counterpart of stealth.impl_rax.auth_app, e.g. served by uvicorn.
+#
+
+import time
+from stealth.impl_rax.admin_token import get_admin_token
+from stealth.impl_rax import token_validation
+from stealth.impl_rax.aio import token_validation as aio_validation
+from stealth.impl_rax.bulkhead import BulkheadFullError
+from stealth.impl_rax.aio.auth_middleware import _respond, \
+    _request_headers
+from stealth import conf
+from stealth.common import context
+
+import stealth.util.log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+def app(redis_client, auth_url=None, admin_name=None, admin_pass=None,
+        client=None):
+    """
+    ASGI app for returning impersonation token.
+
+    :param redis_client: redis.asyncio.Redis object connected to the redis
+                         cache
+    :param client: AsyncKeystoneClient, defaults to the process wide one
+    """
+    if auth_url is None:
+        auth_url = conf.auth.auth_url
+    if admin_name is None:
+        admin_name = conf.auth.admin_name
+    if admin_pass is None:
+        admin_pass = conf.auth.admin_pass
+    # The admin token and the invalidations are kept up by threads
+    sync_redis_client = token_validation.get_auth_redis_client()
+    Admintoken = get_admin_token(auth_url, admin_name, admin_pass,
+        redis_client=sync_redis_client)
+    token_validation.start_cache_invalidation(sync_redis_client)
+
+    LOG.debug('App: Auth URL: %s', auth_url)
+
+    async def validate(headers, send):
+        start = time.time()
+        if 'x-project-id' not in headers:
+            # Header failure, error out with 412
+            LOG.error(('App: Missing required headers.'))
+            token_validation.record_outcome('precondition_failed', start)
+            return await _respond(send, 412)
+        project_id = headers['x-project-id']
+        cache_key = headers.get('x-auth-token', '')
+
+        valid, token = await aio_validation.validate_client_token(
+            redis_client, auth_url, project_id, cache_key, Admintoken,
+            client=client)
+        if valid:
+            LOG.debug(('App: Auth Token validated.'))
+            token_validation.record_outcome('hit', start)
+            return await _respond(send, 204)
+
+        # Reuse the tenant's current token when one is cached
+        valid, usertoken, cache_key = \
+            await aio_validation.validate_tenant_token(redis_client,
+                auth_url, project_id, Admintoken, client=client)
+        outcome = 'tenant_hit'
+        if not valid:
+            # validate the client and fill out the env
+            outcome = 'impersonated'
+            try:
+                valid, usertoken, cache_key = \
+                    await aio_validation.validate_client_impersonation(
+                        redis_client, auth_url, project_id, Admintoken,
+                        client=client)
+            except BulkheadFullError as ex:
+                # Keystone is saturated, have the client come back later
+                LOG.error(('App: Auth Token validation shed.'))
+                token_validation.record_outcome('shed', start)
+                return await _respond(send, 503, [(b'retry-after',
+                    str(ex.retry_after).encode())])
+        if valid and usertoken and usertoken['token']:
+            LOG.debug(('App: Auth Token validated.'))
+            token_validation.record_outcome(outcome, start)
+            return await _respond(send, 204,
+                [(b'x-auth-token', cache_key.encode())])
+
+        # Validation failed. Error out as a 401
+        LOG.error(('App: Auth Token validation failed.'))
+        token_validation.record_outcome('unauthorized', start)
+        return await _respond(send, 401)
+
+    async def auth(scope, receive, send):
+        if scope['type'] != 'http':
+            return
+
+        reset = context.current.set(context.RequestContext())
+        try:
+            return await validate(_request_headers(scope), send)
+        finally:
+            context.current.reset(reset)
+
+    return auth
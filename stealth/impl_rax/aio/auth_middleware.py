@@ -0,0 +1,151 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# ASGI counterpart of stealth.impl_rax.auth_middleware.
+#
+
+import time
+from stealth.impl_rax.admin_token import get_admin_token
+from stealth.impl_rax import token_validation
+from stealth.impl_rax.aio import token_validation as aio_validation
+from stealth.impl_rax.bulkhead import BulkheadFullError
+from stealth import conf
+from stealth.common import context
+
+import stealth.util.log as logging
+
+LOG = logging.getLogger(__name__)
+
+
+async def _respond(send, status, headers=None):
+    """Responds with an empty body."""
+    await send({'type': 'http.response.start', 'status': status,
+        'headers': [(b'content-length', b'0')] + (headers or [])})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+def _request_headers(scope):
+    """The request headers of an ASGI scope, by lower case name"""
+    return dict((name.decode('latin-1').lower(), value.decode('latin-1'))
+        for name, value in scope.get('headers', []))
+
+
+def _with_headers(send, headers):
+    """Wrap send to add headers to the response"""
+    async def wrapped(message):
+        if message['type'] == 'http.response.start':
+            message = dict(message)
+            message['headers'] = list(message.get('headers', [])) + headers
+        await send(message)
+    return wrapped
+
+
+def wrap(app, redis_client, client=None):
+    """Wrap an ASGI app with Authentication middleware.
+
+    Like the WSGI middleware, the Keystone token is handed to the app under
+    'X-AUTH-TOKEN' in the scope, in place of the X-Auth-Token header.
+
+    :param app: ASGI app to wrap
+    :param redis_client: redis.asyncio.Redis object connected to the redis
+                         cache
+    :param client: AsyncKeystoneClient, defaults to the process wide one
+
+    :returns: a new ASGI app that wraps the original
+    """
+
+    auth_url = conf.auth.auth_url
+    # The admin token and the invalidations are kept up by threads
+    sync_redis_client = token_validation.get_auth_redis_client()
+    Admintoken = get_admin_token(auth_url, conf.auth.admin_name,
+        conf.auth.admin_pass, redis_client=sync_redis_client)
+    token_validation.start_cache_invalidation(sync_redis_client)
+
+    async def authenticate(scope, receive, send):
+        start = time.time()
+        headers = _request_headers(scope)
+        if 'x-project-id' not in headers:
+            # Header failure, error out with 412
+            LOG.error(('Middleware: Missing required headers.'))
+            token_validation.record_outcome('precondition_failed', start)
+            return await _respond(send, 412)
+        project_id = headers['x-project-id']
+        cache_key = headers.get('x-auth-token', '')
+        transaction_header = [(b'transaction-id',
+            str(context.current.get().request_id).encode())]
+
+        # Validate the input cache_key.
+        valid, token = await aio_validation.validate_client_token(
+            redis_client, auth_url, project_id, cache_key, Admintoken,
+            client=client)
+        if valid:
+            token_validation.record_outcome('hit', start)
+            return await app(_authenticated(scope, token), receive,
+                _with_headers(send, transaction_header))
+
+        # Reuse the tenant's current token when one is cached
+        valid, usertoken, cache_key = \
+            await aio_validation.validate_tenant_token(redis_client,
+                auth_url, project_id, Admintoken, client=client)
+        outcome = 'tenant_hit'
+        if not valid:
+            # Validate the client with the impersonation token
+            outcome = 'impersonated'
+            try:
+                valid, usertoken, cache_key = \
+                    await aio_validation.validate_client_impersonation(
+                        redis_client, auth_url, project_id, Admintoken,
+                        client=client)
+            except BulkheadFullError as ex:
+                # Keystone is saturated, have the client come back later
+                LOG.error(('Middleware: Auth Token validation shed.'))
+                token_validation.record_outcome('shed', start)
+                return await _respond(send, 503, [(b'retry-after',
+                    str(ex.retry_after).encode())])
+        if valid and usertoken and usertoken['token']:
+            LOG.debug(('Middleware: Auth Token validated.'))
+            token_validation.record_outcome(outcome, start)
+            # Inject cache_key as the auth token into the response headers.
+            return await app(_authenticated(scope, usertoken['token']),
+                receive, _with_headers(send, transaction_header +
+                    [(b'http_x_auth_token', str(cache_key).encode())]))
+
+        # Validation failed for some reason, just error out as a 401
+        LOG.error(('Middleware: Auth Token validation failed.'))
+        token_validation.record_outcome('unauthorized', start)
+        return await _respond(send, 401)
+
+    async def middleware(scope, receive, send):
+        if scope['type'] != 'http':
+            return await app(scope, receive, send)
+
+        reset = context.current.set(context.RequestContext())
+        try:
+            return await authenticate(scope, receive, send)
+        finally:
+            context.current.reset(reset)
+
+    return middleware
+
+
+def _authenticated(scope, token):
+    """The scope handed to the app, carrying the Keystone token"""
+    scope = dict(scope)
+    scope['headers'] = [(name, value)
+        for name, value in scope.get('headers', [])
+        if name.lower() != b'x-auth-token']
+    scope['X-AUTH-TOKEN'] = token
+    return scope
@@ -0,0 +1,315 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# asyncio counterparts of stealth.impl_rax.auth_token_cache, on a
+# redis.asyncio client.  Records, keys, the local caches and the
+# invalidations are shared with the synchronous implementation.
+#
+
+import time
+import simplejson as json
+import redis.asyncio as redis
+import stealth.util.log as logging
+from stealth import conf
+from stealth.impl_rax import invalidation
+from stealth.impl_rax import token_lifetime
+from stealth.impl_rax import auth_token_cache as cache
+from stealth.impl_rax.auth_token_cache import _count_round_trip, \
+    _encode_record, _generate_cache_key, _tenant_index_key, _username_key, \
+    _blacklist_key, _retained_until_ms, _redis_latency
+
+
+LOG = logging.getLogger(__name__)
+
+
+async def _send_data_to_cache(redis_client, data, cache_key=None):
+    """Stores the authentication data to cache
+
+    See stealth.impl_rax.auth_token_cache._send_data_to_cache.
+
+    :param redis_client: redis.asyncio.Redis object
+    :param data: token data with 'tenant' and 'expires_ms'
+    :param cache_key: existing client side auth_token to renew
+
+    :returns: True and cache_key on success, otherwise False and None
+    """
+    queued = False
+    try:
+        data = dict(data, expires_ms=token_lifetime.cache_expires_ms(data))
+        action = invalidation.STORE
+        if cache_key is None:
+            cache_key = _generate_cache_key(json.dumps(data,
+                sort_keys=True))
+        else:
+            action = invalidation.RENEW
+            if cache._tokens is not None:
+                cache._tokens.delete(cache_key)
+
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.set(cache_key, _encode_record(data),
+                pxat=_retained_until_ms(data['expires_ms']))
+            if data.get('tenant'):
+                pipe.set(_tenant_index_key(data['tenant']), cache_key,
+                    pxat=_retained_until_ms(data['expires_ms']))
+            queued = invalidation.queue(pipe, action, cache_key,
+                data.get('tenant'))
+            _count_round_trip('store')
+            with _redis_latency.time(operation='store'):
+                await pipe.execute()
+
+        invalidation.sent(queued)
+        return True, cache_key
+
+    except Exception as ex:
+        invalidation.sent(queued, success=False)
+        LOG.error(('Endpoint: Failed to cache the data - Exception: \
+            %(s_except)s'), {
+            's_except': ex,
+        })
+        return False, None
+
+
+async def _retrieve_data_from_cache(redis_client, cache_key):
+    """Retrieve the authentication data from cache
+
+    :param redis_client: redis.asyncio.Redis object
+    :param cache_key: client side auth_token
+
+    :returns: cached user info on success, or None.  It is shared with the
+    :         in-process cache, so it must not be modified.
+    """
+    if cache_key is None:
+        return None
+
+    if cache._tokens is not None:
+        data = cache._tokens.get(cache_key)
+        if data is not None:
+            return data
+
+    try:
+        _count_round_trip('retrieve')
+        with _redis_latency.time(operation='retrieve'):
+            cached_data = await redis_client.get(cache_key)
+
+    except Exception:
+        LOG.debug(('Failed to retrieve data to cache for key %(s_key)s'), {
+            's_key': cache_key
+        })
+        return None
+
+    if cached_data is None:
+        LOG.debug(('No data in cache for key %(s_key)s'), {
+            's_key': cache_key
+        })
+        return None
+
+    try:
+        data, migrate = cache._parse_cached_data(cached_data)
+    except Exception as ex:
+        cache._log_malformed_data(ex, cached_data)
+        return None
+
+    if migrate:
+        await _migrate_data_in_cache(redis_client, cache_key, data,
+            cached_data)
+
+    cache._keep_local(cache_key, data, cached_data)
+    return data
+
+
+async def _migrate_data_in_cache(redis_client, cache_key, data, cached_data):
+    """Rewrite a cached record in the current format, if still unchanged
+
+    See stealth.impl_rax.auth_token_cache._migrate_data_in_cache.
+    """
+    if isinstance(cached_data, str):
+        cached_data = cached_data.encode('utf-8')
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            await pipe.watch(cache_key)
+            _count_round_trip('migrate')
+            if await pipe.get(cache_key) != cached_data:
+                return
+            pipe.multi()
+            pipe.set(cache_key, _encode_record(data),
+                pxat=_retained_until_ms(data['expires_ms']))
+            _count_round_trip('migrate')
+            await pipe.execute()
+
+    except redis.WatchError:
+        # Replaced meanwhile, the newer record is kept
+        pass
+
+    except Exception as ex:
+        # The old record is still readable, retry on the next miss
+        LOG.debug(('Endpoint: Failed to migrate the data - Exception: '
+            '%(s_except)s'), {
+            's_except': ex
+        })
+
+
+async def _retrieve_tenant_data_from_cache(redis_client, tenant):
+    """Retrieve the tenant's current authentication data from cache
+
+    :returns: the cache_key and the cached user info on success,
+    :         otherwise None and None
+    """
+    if not tenant:
+        return None, None
+
+    try:
+        _count_round_trip('tenant_index')
+        with _redis_latency.time(operation='tenant_index'):
+            cache_key = await redis_client.get(_tenant_index_key(tenant))
+
+    except Exception:
+        LOG.debug(('Failed to retrieve the index for tenant %(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return None, None
+
+    if cache_key is None:
+        return None, None
+    if isinstance(cache_key, bytes):
+        cache_key = cache_key.decode()
+
+    data = await _retrieve_data_from_cache(redis_client, cache_key)
+    if data is None or data.get('tenant') != tenant:
+        return None, None
+    return cache_key, data
+
+
+async def _send_username_to_cache(redis_client, tenant, username):
+    """Stores the tenant's admin username to cache
+
+    :returns: True on success, otherwise False
+    """
+    cache._usernames.set(tenant, username,
+        time.time() + conf.auth.username_cache_local_ttl)
+    try:
+        _count_round_trip('username_store')
+        await redis_client.set(_username_key(tenant), username,
+            ex=conf.auth.username_cache_ttl)
+        return True
+
+    except Exception as ex:
+        LOG.error(('Endpoint: Failed to cache the username - Exception: \
+            %(s_except)s'), {
+            's_except': ex,
+        })
+        return False
+
+
+async def _retrieve_username_from_cache(redis_client, tenant):
+    """Retrieve the tenant's admin username from cache
+
+    :returns: the admin username on success, or None
+    """
+    username = cache._usernames.get(tenant)
+    if username is not None:
+        return username
+
+    try:
+        _count_round_trip('username_retrieve')
+        username = await redis_client.get(_username_key(tenant))
+
+    except Exception:
+        LOG.debug(('Failed to retrieve the username for tenant '
+            '%(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return None
+
+    if username is None:
+        return None
+    if isinstance(username, bytes):
+        username = username.decode()
+    cache._usernames.set(tenant, username,
+        time.time() + conf.auth.username_cache_local_ttl)
+    return username
+
+
+async def _invalidate_username_cache(redis_client, tenant):
+    """Drop the tenant's admin username from cache"""
+    cache._usernames.delete(tenant)
+    queued = False
+    try:
+        async with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(_username_key(tenant))
+            queued = invalidation.queue(pipe, invalidation.USERNAME,
+                tenant=tenant)
+            _count_round_trip('username_invalidate')
+            await pipe.execute()
+        invalidation.sent(queued)
+
+    except Exception as ex:
+        invalidation.sent(queued, success=False)
+        LOG.error(('Endpoint: Failed to invalidate the username - Exception: \
+            %(s_except)s'), {
+            's_except': ex,
+        })
+
+
+async def _send_failure_to_cache(redis_client, tenant, failure):
+    """Blacklist the tenant after a failed impersonation
+
+    See stealth.impl_rax.auth_token_cache._send_failure_to_cache.
+
+    :returns: True on success, otherwise False
+    """
+    ttl = cache._blacklist_ttl(failure)
+    if ttl <= 0:
+        return False
+
+    cache._failures.set(tenant, failure, time.time() + ttl)
+    cache._count_blacklist('blacklisted', failure)
+    try:
+        _count_round_trip('blacklist_store')
+        await redis_client.set(_blacklist_key(tenant), failure, ex=ttl)
+        return True
+
+    except Exception as ex:
+        LOG.error(('Endpoint: Failed to blacklist the tenant - Exception: \
+            %(s_except)s'), {
+            's_except': ex,
+        })
+        return False
+
+
+async def _retrieve_failure_from_cache(redis_client, tenant):
+    """Retrieve the class of the tenant's blacklisted failure
+
+    :returns: the failure class while the tenant is blacklisted, or None
+    """
+    failure = cache._failures.get(tenant)
+    if failure is not None:
+        return failure
+
+    try:
+        _count_round_trip('blacklist_retrieve')
+        async with redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(_blacklist_key(tenant))
+            pipe.pttl(_blacklist_key(tenant))
+            failure, ttl_ms = await pipe.execute()
+
+    except Exception:
+        LOG.debug(('Failed to retrieve the blacklist for tenant '
+            '%(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return None
+
+    return cache._keep_failure(tenant, failure, ttl_ms)
@@ -0,0 +1,149 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# asyncio counterpart of stealth.impl_rax.bulkhead, same settings.
+#
+
+import asyncio
+import collections
+import contextlib
+import os
+import stealth.util.log as logging
+from stealth import conf
+from stealth.impl_rax.bulkhead import BulkheadFullError, RENEWAL, LOGIN, \
+    PRIORITIES, _shed_calls
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncBulkhead(object):
+
+    """Bounded concurrency with a bounded priority queue, for one loop.
+
+    A freed slot is handed over to the first waiter of the highest
+    priority.  See stealth.impl_rax.bulkhead.Bulkhead for the parameters.
+    """
+
+    def __init__(self, max_calls=16, max_queue=64, wait=2.0, retry_after=1):
+        self._max_calls = max_calls
+        self._max_queue = max_queue
+        self._wait = wait
+        self._retry_after = retry_after
+        self._active = 0
+        self._waiters = dict((priority, collections.deque())
+            for priority in PRIORITIES)
+        self._stats = {'admitted': 0, 'queued': 0, 'shed': 0,
+            'timed_out': 0}
+
+    def _shed(self, reason):
+        self._stats[reason] += 1
+        _shed_calls.inc(reason=reason)
+        LOG.warning('Keystone: Call shed', fields={'reason': reason})
+        raise BulkheadFullError(self._retry_after)
+
+    async def acquire(self, priority=LOGIN):
+        """Take a slot, see Bulkhead.acquire()"""
+        if self._active < self._max_calls and not any(
+                self._waiters[other] for other in PRIORITIES
+                if other <= priority):
+            self._active += 1
+            self._stats['admitted'] += 1
+            return
+        if sum(len(waiters) for waiters in self._waiters.values()) >= \
+                self._max_queue:
+            self._shed('shed')
+
+        self._stats['queued'] += 1
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[priority].append(future)
+        try:
+            await asyncio.wait_for(future, self._wait)
+            self._stats['admitted'] += 1
+        except asyncio.TimeoutError:
+            self._shed('timed_out')
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Handed a slot on the way out
+                self.release()
+            raise
+        finally:
+            if future in self._waiters[priority]:
+                self._waiters[priority].remove(future)
+
+    def release(self):
+        """Give back a slot, or hand it over to the next waiter"""
+        for priority in PRIORITIES:
+            waiters = self._waiters[priority]
+            while waiters:
+                future = waiters.popleft()
+                if not future.done():
+                    future.set_result(None)
+                    return
+        self._active -= 1
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority=LOGIN):
+        """Hold a slot for the duration of the block, see acquire()"""
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """See Bulkhead.stats()"""
+        return dict(self._stats, active=self._active,
+            waiting=sum(len(waiters) for waiters in self._waiters.values()))
+
+
+_bulkhead = None
+
+
+def get_bulkhead():
+    """The process wide asyncio Keystone bulkhead
+
+    uses the [keystone] bulkhead settings, None when it is disabled
+    """
+    global _bulkhead
+    if not conf.keystone.bulkhead:
+        return None
+    if _bulkhead is None:
+        _bulkhead = AsyncBulkhead(max_calls=conf.keystone.bulkhead_calls,
+            max_queue=conf.keystone.bulkhead_queue,
+            wait=conf.keystone.bulkhead_wait,
+            retry_after=conf.keystone.bulkhead_retry_after)
+    return _bulkhead
+
+
+@contextlib.asynccontextmanager
+async def slot(priority=LOGIN):
+    """Hold a slot of the process wide bulkhead, if any"""
+    bulkhead = get_bulkhead()
+    if bulkhead is None:
+        yield
+        return
+    async with bulkhead.slot(priority):
+        yield
+
+
+def _reset_bulkhead():
+    global _bulkhead
+    _bulkhead = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_bulkhead)
@@ -0,0 +1,158 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import os
+import threading
+import time
+import stealth.util.log as logging
+from stealth import conf
+from stealth.impl_rax import circuit_breaker
+from stealth.impl_rax.keystone_client import KeystoneClient, \
+    RETRY_STATUS_CODES
+
+try:
+    import httpx
+except ImportError:  # pragma: no cover
+    httpx = None
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncKeystoneClient(KeystoneClient):
+
+    """asyncio HTTP client shared by all the Keystone calls.
+
+    Same pooling, timeouts, retries and per-endpoint latency counters as
+    KeystoneClient, on httpx.  Install the 'asgi' extra to use it.
+
+    :param breaker: CircuitBreaker every attempt goes through, if any
+    :param transport: httpx transport, e.g. to mock Keystone in tests
+    """
+
+    def __init__(self, pool_connections=10, pool_size=10,
+            connect_timeout=3.05, read_timeout=10.0, retries=2,
+            backoff_factor=0.1, backoff_max=2.0, keep_alive=True,
+            breaker=None, transport=None):
+        if httpx is None:
+            raise ImportError('httpx is required by the asyncio Keystone '
+                'client, install stealth[asgi]')
+        self._timeout = httpx.Timeout(read_timeout, connect=connect_timeout)
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+        self._backoff_max = backoff_max
+        self._breaker = breaker
+
+        headers = {} if keep_alive else {'Connection': 'close'}
+        self._session = httpx.AsyncClient(transport=transport,
+            headers=headers, timeout=self._timeout,
+            limits=httpx.Limits(max_connections=pool_size,
+                max_keepalive_connections=pool_connections if keep_alive
+                else 0))
+
+        # stats() may be read from other threads
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    async def request(self, method, url, endpoint=None, **kwargs):
+        """Send a request to Keystone
+
+        :param method: HTTP method
+        :param url: URL of the request
+        :param endpoint: name the latency is counted under, defaults to url
+        :param kwargs: passed on to httpx.AsyncClient.request
+
+        :returns: httpx.Response object
+        :raises: httpx.TransportError once the retries are used up,
+                 circuit_breaker.CircuitOpenError while the circuit is open
+        """
+        endpoint = url if endpoint is None else endpoint
+
+        attempt = 0
+        while True:
+            self._admit()
+            start = time.time()
+            try:
+                res = await self._session.request(method, url, **kwargs)
+            except httpx.TransportError as ex:
+                self._record(endpoint, time.time() - start, failed=True)
+                self._report(failed=True)
+                if attempt >= self._retries:
+                    raise
+                LOG.debug(('Keystone: %(s_endpoint)s failed, retrying - '
+                    '%(s_except)s'), {
+                    's_endpoint': endpoint,
+                    's_except': ex
+                })
+            else:
+                retry = res.status_code in RETRY_STATUS_CODES
+                self._record(endpoint, time.time() - start, failed=retry)
+                self._report(failed=res.status_code >= 500)
+                if not retry or attempt >= self._retries:
+                    return res
+                LOG.debug(('Keystone: %(s_endpoint)s returned %(s_code)s, '
+                    'retrying'), {
+                    's_endpoint': endpoint,
+                    's_code': res.status_code
+                })
+
+            await asyncio.sleep(self._backoff(attempt))
+            attempt += 1
+
+    async def get(self, url, endpoint=None, **kwargs):
+        """Send a GET request to Keystone"""
+        return await self.request('GET', url, endpoint=endpoint, **kwargs)
+
+    async def post(self, url, endpoint=None, **kwargs):
+        """Send a POST request to Keystone"""
+        return await self.request('POST', url, endpoint=endpoint, **kwargs)
+
+    async def aclose(self):
+        """Close the pooled connections"""
+        await self._session.aclose()
+
+
+_client = None
+
+
+def get_client():
+    """Get the process wide asyncio Keystone client
+
+    uses the [keystone] settings
+    """
+    global _client
+    if _client is None:
+        _client = AsyncKeystoneClient(
+            pool_connections=conf.keystone.pool_connections,
+            pool_size=conf.keystone.pool_size,
+            connect_timeout=conf.keystone.connect_timeout,
+            read_timeout=conf.keystone.read_timeout,
+            retries=conf.keystone.retries,
+            backoff_factor=conf.keystone.backoff_factor,
+            backoff_max=conf.keystone.backoff_max,
+            keep_alive=conf.keystone.keep_alive,
+            breaker=circuit_breaker.get_breaker())
+    return _client
+
+
+def _reset_client():
+    """Drop the client, a forked worker must not share pooled sockets."""
+    global _client
+    _client = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client)
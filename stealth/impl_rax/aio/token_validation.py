@@ -0,0 +1,459 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# asyncio counterparts of stealth.impl_rax.token_validation.
+#
+# Validations wait on Redis and Keystone without holding a thread, so one
+# event loop serves many of them at once.
+#
+
+import asyncio
+import time
+import uuid
+import stealth.util.log as logging
+import redis.asyncio as redis
+from redis.asyncio import connection
+from stealth import conf
+from stealth.impl_rax.auth_token import TokenBase, failure_class
+from stealth.impl_rax import auth_token_cache
+from stealth.impl_rax.auth_token_cache import _expires_ms
+from stealth.impl_rax import circuit_breaker
+from stealth.impl_rax import refresh_ahead
+from stealth.impl_rax import token_lifetime
+from stealth.impl_rax.aio import bulkhead
+from stealth.impl_rax.aio import keystone_client
+from stealth.impl_rax.aio.auth_token_cache import _send_data_to_cache, \
+    _retrieve_data_from_cache, _retrieve_tenant_data_from_cache, \
+    _send_username_to_cache, _retrieve_username_from_cache, \
+    _invalidate_username_cache, _send_failure_to_cache, \
+    _retrieve_failure_from_cache
+
+LOG = logging.getLogger(__name__)
+
+# In-flight impersonations by tenant, and renewals by cache_key
+_flights = {}
+_renewals = {}
+
+
+class _Failure(Exception):
+
+    """Keystone refused the impersonation, see failure_class()"""
+
+    def __init__(self, failure=None):
+        super(_Failure, self).__init__(failure)
+        self.failure = failure
+
+
+def get_auth_redis_client():
+    """Get a redis.asyncio client from the pool
+
+    uses the cnc:auth_redis settings
+    """
+
+    if conf.auth_redis.ssl_enable != 'None':
+        pool = redis.ConnectionPool(
+            host=conf.auth_redis.host,
+            port=conf.auth_redis.port,
+            db=conf.auth_redis.redis_db,
+            password=conf.auth_redis.password,
+            ssl_keyfile=conf.auth_redis.ssl_keyfile,
+            ssl_certfile=conf.auth_redis.ssl_certfile,
+            ssl_cert_reqs=conf.auth_redis.ssl_cert_reqs,
+            ssl_ca_certs=conf.auth_redis.ssl_ca_certs,
+            connection_class=connection.SSLConnection)
+    else:
+        pool = redis.ConnectionPool(host=conf.auth_redis.host,
+                                    port=conf.auth_redis.port,
+                                    db=conf.auth_redis.redis_db)
+
+    return redis.Redis(connection_pool=pool)
+
+
+async def _admin_token(admintoken):
+    """The admin token, renewed off the event loop when it is due"""
+    if admintoken.expires_ms is not None and \
+            not TokenBase.will_expire_soon_ms(admintoken.expires_ms):
+        return admintoken.token
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, lambda: admintoken.token)
+
+
+async def _lookup_username(redis_client, client, url, tenant, headers):
+    """Resolve the tenant to its admin username through Keystone"""
+
+    # Step 1. List users of the tenant
+    res = await client.get('{0}/tenants/{1}/users'.format(url, tenant),
+        endpoint='tenant_users', headers=headers)
+    if res.status_code != 200:
+        raise _Failure(failure_class(res.status_code, 'no_users'))
+    users = res.json()['users']
+    if not users:
+        raise _Failure('no_users')
+    userid = users[0]['id']
+
+    # Step 2. Lookup the admin role user id of the tenant
+    res = await client.get('{0}/users/{1}/RAX-AUTH/admins'.format(url,
+        userid), endpoint='user_admins', headers=headers)
+    if res.status_code != 200:
+        raise _Failure(failure_class(res.status_code, 'no_admin'))
+    admins = res.json()['users']
+    if not admins:
+        raise _Failure('no_admin')
+    username = admins[0]['username']
+
+    await _send_username_to_cache(redis_client, tenant, username)
+    return username
+
+
+async def _impersonation_request(client, url, headers, tenant, username):
+    """Create the impersonation token for the user"""
+    data = '{"RAX-AUTH:impersonation": {"user": {"username":"%s"}, \
+        "expire-in-seconds": %d}}' % (username,
+        token_lifetime.impersonation_lifetime(tenant))
+    return await client.post('{0}/RAX-AUTH/impersonation-tokens'.format(url),
+        endpoint='impersonation_tokens', headers=headers, content=data)
+
+
+async def _impersonate_token(redis_client, client, url, tenant, admintoken):
+    """Impersonate the tenant against Keystone
+
+    See stealth.impl_rax.auth_token.UserToken.
+
+    :returns: the token data, or None
+    """
+    try:
+        headers = {'X-Auth-Token': await _admin_token(admintoken)}
+
+        # Steps 1 and 2 are skipped while the admin username is cached
+        username = await _retrieve_username_from_cache(redis_client, tenant)
+        cached = username is not None
+        if not cached:
+            username = await _lookup_username(redis_client, client, url,
+                tenant, headers)
+
+        # Step 3. Create the impersonation token for the user
+        impersonation_headers = dict(headers)
+        impersonation_headers['Content-Type'] = 'application/json'
+        res = await _impersonation_request(client, url,
+            impersonation_headers, tenant, username)
+        if cached and 400 <= res.status_code < 500 and \
+                res.status_code != 401:
+            # The cached admin username may be stale, resolve it again
+            await _invalidate_username_cache(redis_client, tenant)
+            username = await _lookup_username(redis_client, client, url,
+                tenant, headers)
+            res = await _impersonation_request(client, url,
+                impersonation_headers, tenant, username)
+        if res.status_code != 200:
+            raise _Failure(failure_class(res.status_code, 'rejected'))
+
+        token = res.json()['access']['token']
+        data = {'token': token['id'], 'tenant': tenant,
+            'expires': token['expires'],
+            'expires_ms': _expires_ms(token['expires']),
+            'issued_ms': int(time.time() * 1000)}
+        # As it will be cached
+        data['expires_ms'] = token_lifetime.cache_expires_ms(data)
+        return data
+
+    except _Failure as ex:
+        LOG.debug(('auth token: Failed to authenticate against %(s_url)s'), {
+            's_url': url
+        })
+        if ex.failure is not None:
+            # Spare Keystone the same failing calls for a while
+            await _send_failure_to_cache(redis_client, tenant, ex.failure)
+        return None
+
+    except Exception as ex:
+        LOG.debug(('auth token: Failed to authenticate against %(s_url)s'
+            ' - %(s_except)s'), {
+            's_url': url,
+            's_except': ex
+        })
+        return None
+
+
+async def _take_lease(redis_client, lease_key, lease_id, lease_ttl):
+    try:
+        return bool(await redis_client.set(lease_key, lease_id, nx=True,
+            px=int(lease_ttl * 1000)))
+    except Exception as ex:
+        # Never let the lease block the work itself
+        LOG.debug(('Single flight: Failed to take the lease %(s_key)s - '
+            '%(s_except)s'), {
+            's_key': lease_key,
+            's_except': ex
+        })
+        return None
+
+
+async def _release_lease(redis_client, lease_key, lease_id):
+    """Delete the lease, unless it expired and was taken over."""
+    try:
+        async with redis_client.pipeline() as pipe:
+            await pipe.watch(lease_key)
+            current = await pipe.get(lease_key)
+            if current is not None and current.decode() == lease_id:
+                pipe.multi()
+                pipe.delete(lease_key)
+                await pipe.execute()
+    except Exception as ex:
+        # The lease expires on its own
+        LOG.debug(('Single flight: Failed to release the lease %(s_key)s - '
+            '%(s_except)s'), {
+            's_key': lease_key,
+            's_except': ex
+        })
+
+
+def _refresh_ahead(redis_client, url, cache_key, token_data, admintoken,
+        client):
+    """Schedule the renewal of a cached token past its renewal point"""
+    refresher = refresh_ahead.get_refresher()
+    if admintoken is None or not refresher.is_due(token_data):
+        return
+    if cache_key in _renewals or \
+            len(_renewals) >= conf.auth.refresh_max_pending:
+        refresher.skip()
+        return
+    _renewals[cache_key] = asyncio.ensure_future(_renew(redis_client, url,
+        token_data['tenant'], cache_key, admintoken,
+        client or keystone_client.get_client()))
+
+
+async def _renew(redis_client, url, tenant, cache_key, admintoken, client):
+    """Replace the Keystone token behind cache_key with a fresh one"""
+    try:
+        # Left to expire, see RefreshAhead
+        lease_key = 'lease:refresh:{0}'.format(cache_key)
+        if not await _take_lease(redis_client, lease_key,
+                str(uuid.uuid4()), conf.auth.refresh_lease_ttl):
+            return False
+
+        try:
+            async with bulkhead.slot(bulkhead.RENEWAL):
+                data = await _impersonate_token(redis_client, client, url,
+                    tenant, admintoken)
+        except bulkhead.BulkheadFullError:
+            LOG.debug(('Renewal of the token of %(s_tenant)s shed'), {
+                's_tenant': tenant
+            })
+            return False
+        if data is None:
+            return False
+        retval, _ = await _send_data_to_cache(redis_client, data,
+            cache_key=cache_key)
+        return retval
+
+    finally:
+        _renewals.pop(cache_key, None)
+
+
+async def validate_client_token(redis_client, url, tenant, cache_key,
+        admintoken=None, client=None):
+    """Validate Input Client Token
+
+    See stealth.impl_rax.token_validation.validate_client_token.
+
+    :param redis_client: redis.asyncio.Redis object
+    :param client: AsyncKeystoneClient of the renewals, defaults to the
+                   process wide one
+
+    :returns: True and token-data on success, False and None otherwise
+    """
+
+    token_lifetime.record_request(tenant)
+    try:
+        token_data = await _retrieve_data_from_cache(redis_client, cache_key)
+        if token_data is not None:
+            if TokenBase.will_expire_soon_ms(token_data['expires_ms']):
+                if circuit_breaker.serve_stale(token_data['expires_ms']):
+                    # Keystone is unavailable, keep the client going
+                    LOG.info('Serving an expired token')
+                    return True, token_data['token']
+                LOG.info('Token has expired')
+            else:
+                _refresh_ahead(redis_client, url, cache_key, token_data,
+                    admintoken, client)
+                return True, token_data['token']
+
+        LOG.debug(('Unable to get Access information for '
+            '%(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return False, None
+
+    except Exception as ex:
+        LOG.debug(('Endpoint: Error while trying to authenticate against'
+            ' %(s_url)s - %(s_except)s'), {
+            's_url': url,
+            's_except': ex
+        })
+        return False, None
+
+
+async def validate_tenant_token(redis_client, url, tenant, admintoken=None,
+        client=None):
+    """Validate the Tenant's Current Cached Token
+
+    :returns: True, the auth token, and the cachekey on success,
+    :         otherwise False, None, and None
+    """
+
+    try:
+        cache_key, token_data = await _retrieve_tenant_data_from_cache(
+            redis_client, tenant)
+        if token_data is not None:
+            if TokenBase.will_expire_soon_ms(token_data['expires_ms']):
+                if circuit_breaker.serve_stale(token_data['expires_ms']):
+                    # Keystone is unavailable, keep the client going
+                    LOG.info('Serving an expired token')
+                    return True, token_data, cache_key
+                LOG.info('Tenant token has expired')
+            else:
+                _refresh_ahead(redis_client, url, cache_key, token_data,
+                    admintoken, client)
+                return True, token_data, cache_key
+
+        return False, None, None
+
+    except Exception as ex:
+        LOG.debug(('Endpoint: Error while looking up the tenant token for'
+            ' %(s_tenant)s - %(s_except)s'), {
+            's_tenant': tenant,
+            's_except': ex
+        })
+        return False, None, None
+
+
+async def _priority(redis_client, tenant):
+    """Tenants whose admin username is cached are renewals, see bulkhead"""
+    if await _retrieve_username_from_cache(redis_client, tenant) is not None:
+        return bulkhead.RENEWAL
+    return bulkhead.LOGIN
+
+
+async def _impersonate(redis_client, url, tenant, admintoken, client):
+    """Impersonate the tenant against Keystone and cache the token"""
+    async with bulkhead.slot(await _priority(redis_client, tenant)):
+        data = await _impersonate_token(redis_client, client, url, tenant,
+            admintoken)
+    if data is None:
+        LOG.debug(('Unable to get Access information for '
+            '%(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return False, None, None
+
+    retval, cache_key = await _send_data_to_cache(redis_client, data)
+    return True, data, cache_key
+
+
+async def _leased_impersonate(redis_client, url, tenant, admintoken, client):
+    """Impersonate once across the processes, see RedisSingleFlight"""
+    lease_key = 'lease:impersonate:{0}'.format(tenant)
+    lease_id = str(uuid.uuid4())
+    deadline = time.time() + conf.auth.coalesce_wait
+
+    while True:
+        acquired = await _take_lease(redis_client, lease_key, lease_id,
+            conf.auth.coalesce_lease_ttl)
+        if acquired is None:
+            return await _impersonate(redis_client, url, tenant, admintoken,
+                client)
+        if acquired:
+            try:
+                return await _impersonate(redis_client, url, tenant,
+                    admintoken, client)
+            finally:
+                await _release_lease(redis_client, lease_key, lease_id)
+
+        result = await validate_tenant_token(redis_client, url, tenant)
+        if result[0]:
+            return result
+
+        if time.time() >= deadline:
+            LOG.debug(('Single flight: Gave up waiting on the lease '
+                'for %(s_key)s'), {
+                's_key': tenant
+            })
+            return await _impersonate(redis_client, url, tenant, admintoken,
+                client)
+
+        await asyncio.sleep(0.05)
+
+
+async def _blacklisted(redis_client, tenant):
+    """Whether impersonations of the tenant are currently refused"""
+    failure = await _retrieve_failure_from_cache(redis_client, tenant)
+    if failure is None:
+        return False
+    auth_token_cache._count_blacklist('suppressed', failure)
+    LOG.debug(('Impersonation of %(s_tenant)s suppressed, blacklisted '
+        'for %(s_failure)s'), {
+        's_tenant': tenant,
+        's_failure': failure
+    })
+    return True
+
+
+async def validate_client_impersonation(redis_client, url, tenant,
+        admintoken, client=None):
+    """Validate Client Token
+
+    Concurrent impersonations of the same tenant are coalesced within the
+    event loop and, with the [auth] coalesce setting 'redis', across
+    processes.  Blacklisted tenants are refused without calling Keystone,
+    and the Keystone work goes through the bulkhead.
+
+    :param redis_client: redis.asyncio.Redis object
+    :param url: Keystone Identity URL to authenticate against
+    :param tenant: tenant id of user data to retrieve
+    :param admintoken: admin token object for Keystone Identity authentication
+    :param client: AsyncKeystoneClient, defaults to the process wide one
+
+    :returns: True, the auth token, and the cachekey on success,
+    :         otherwise False, None, and None
+    :raises: BulkheadFullError when the Keystone work was shed
+    """
+    flight = _flights.get(tenant)
+    if flight is None or flight.get_loop() is not asyncio.get_running_loop():
+        flight = _flights[tenant] = asyncio.ensure_future(_flight(
+            redis_client, url, tenant, admintoken,
+            client or keystone_client.get_client()))
+        flight.add_done_callback(lambda task: _land(tenant, task))
+    # A caller being cancelled, the first one included, must not cancel
+    # the shared call
+    return await asyncio.shield(flight)
+
+
+async def _flight(redis_client, url, tenant, admintoken, client):
+    """The impersonation shared by the callers of a tenant"""
+    if await _blacklisted(redis_client, tenant):
+        return False, None, None
+    if conf.auth.coalesce == 'redis':
+        return await _leased_impersonate(redis_client, url, tenant,
+            admintoken, client)
+    return await _impersonate(redis_client, url, tenant, admintoken, client)
+
+
+def _land(tenant, flight):
+    if _flights.get(tenant) is flight:
+        del _flights[tenant]
+    # Retrieved, so a call without waiters left is not reported
+    if not flight.cancelled():
+        flight.exception()
@@ -19,9 +19,11 @@
 #
 
 
+import time
 import falcon
-from stealth.impl_rax.auth_token import AdminToken
+from stealth.impl_rax.admin_token import get_admin_token
 from stealth.impl_rax import token_validation
+from stealth.impl_rax.bulkhead import BulkheadFullError
 from stealth import conf
 
 import stealth.util.log as logging
@@ -41,6 +43,13 @@ def _http_unauthorized(start_response):
     return []
 
 
+def _http_service_unavailable(start_response, retry_after):
+    """Responds with HTTP 503."""
+    start_response(falcon.HTTP_503, [('Content-Length', '0'),
+        ('Retry-After', str(retry_after))])
+    return []
+
+
 def app(redis_client, auth_url=None, admin_name=None, admin_pass=None):
     """
     uWSGI app for returning impersonation token.
@@ -53,11 +62,14 @@ def app(redis_client, auth_url=None, admin_name=None, admin_pass=None):
         admin_name = conf.auth.admin_name
     if admin_pass is None:
         admin_pass = conf.auth.admin_pass
-    Admintoken = AdminToken(auth_url, admin_name, admin_pass)
+    Admintoken = get_admin_token(auth_url, admin_name, admin_pass,
+        redis_client=redis_client)
+    token_validation.start_cache_invalidation(redis_client)
 
-    LOG.debug('App: Auth URL: {0:}'.format(auth_url))
+    LOG.debug('App: Auth URL: %s', auth_url)
 
     def auth(env, start_response):
+        start = time.time()
         try:
             project_id = env['HTTP_X_PROJECT_ID']
             token = ''
@@ -68,32 +80,48 @@ def app(redis_client, auth_url=None, admin_name=None, admin_pass=None):
                 cache_key = env['HTTP_X_AUTH_TOKEN']
 
             valid, token = token_validation.validate_client_token(redis_client,
-                auth_url, project_id, cache_key)
+                auth_url, project_id, cache_key, Admintoken)
             if valid:
                 LOG.debug(('App: Auth Token validated.'))
+                token_validation.record_outcome('hit', start)
                 start_response('204 No Content',
                     [])
                 return []
 
-            # validate the client and fill out the env
+            # Reuse the tenant's current token when one is cached
             valid, usertoken, cache_key = \
-                token_validation.validate_client_impersonation(
+                token_validation.validate_tenant_token(
                     redis_client, auth_url, project_id, Admintoken)
+            outcome = 'tenant_hit'
+            if not valid:
+                # validate the client and fill out the env
+                valid, usertoken, cache_key = \
+                    token_validation.validate_client_impersonation(
+                        redis_client, auth_url, project_id, Admintoken)
+                outcome = 'impersonated'
             if valid and usertoken and usertoken['token']:
                 token = usertoken['token']
                 # env['X-AUTH-TOKEN'] = token
                 LOG.debug(('App: Auth Token validated.'))
+                token_validation.record_outcome(outcome, start)
                 start_response('204 No Content',
                     [('X-AUTH-TOKEN', cache_key)])
                 return []
 
             # Validation failed. Error out as a 401
             LOG.error(('App: Auth Token validation failed.'))
+            token_validation.record_outcome('unauthorized', start)
             return _http_unauthorized(start_response)
 
+        except BulkheadFullError as ex:
+            # Keystone is saturated, have the client come back later
+            LOG.error(('App: Auth Token validation shed.'))
+            token_validation.record_outcome('shed', start)
+            return _http_service_unavailable(start_response, ex.retry_after)
         except (KeyError, LookupError):
             # Header failure, error out with 412
             LOG.error(('App: Missing required headers.'))
+            token_validation.record_outcome('precondition_failed', start)
             return _http_precondition_failed(start_response)
 
     return auth
@@ -13,12 +13,15 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from stealth.impl_rax.auth_token import AdminToken
+from stealth.impl_rax.admin_token import get_admin_token
 from stealth.impl_rax import token_validation
+from stealth.impl_rax.bulkhead import BulkheadFullError
+from stealth.util import metrics
 
 
 import functools
 import datetime
+import time
 import stealth.util.log as logging
 import pytz
 import dateutil
@@ -58,11 +61,15 @@ class AuthServ(object):
             admin_pass = conf.auth.admin_pass
         else:
             admin_pass = admin_pass
-        LOG.debug('Auth URL: {0:}'.format(self.auth_url))
-        self.Admintoken = AdminToken(self.auth_url, admin_name, admin_pass)
+        LOG.debug('Auth URL: %s', self.auth_url)
+        self.Admintoken = get_admin_token(self.auth_url, admin_name,
+            admin_pass, redis_client=self.redis_client)
+        token_validation.start_cache_invalidation(self.redis_client)
+        metrics.start_flusher(self.redis_client)
 
     def auth(self, req, resp):
 
+        start = time.time()
         try:
             auth_token = None
             valid = False
@@ -75,18 +82,30 @@ class AuthServ(object):
 
             valid, auth_token = token_validation.validate_client_token(
                 self.redis_client,
-                self.auth_url, project_id, cache_key)
+                self.auth_url, project_id, cache_key,
+                self.Admintoken)
 
+            outcome = 'hit'
             if not valid:
+                # Reuse the tenant's current token when one is cached
                 valid, usertoken, cache_key =\
-                    token_validation.validate_client_impersonation(
+                    token_validation.validate_tenant_token(
                         self.redis_client, self.auth_url, project_id,
                         self.Admintoken)
+                outcome = 'tenant_hit'
+
+                if not valid:
+                    valid, usertoken, cache_key =\
+                        token_validation.validate_client_impersonation(
+                            self.redis_client, self.auth_url, project_id,
+                            self.Admintoken)
+                    outcome = 'impersonated'
 
                 if not valid:
                     # Validation failed for some reason,
                     # just error out as a 401
                     LOG.error('Auth Token validation failed.')
+                    token_validation.record_outcome('unauthorized', start)
                     return False, 'Auth Token validation failed.'
 
                 # WHY NOT? else if usertoken and usertoken['token']:
@@ -102,10 +121,17 @@ class AuthServ(object):
 
             # validate the client and fill out the request it's valid
             LOG.debug('Auth Token validated.')
+            token_validation.record_outcome(outcome, start)
             # Return only generated hmac values back to the users.
             return True, cache_key
 
+        except BulkheadFullError:
+            # Answered with a 503 by the caller
+            token_validation.record_outcome('shed', start)
+            raise
+
         except (KeyError, LookupError):
             # Header failure, error out with 412
             LOG.error('Missing required headers.')
+            token_validation.record_outcome('precondition_failed', start)
             return False, 'Missing required headers.'
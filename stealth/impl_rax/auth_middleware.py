@@ -14,9 +14,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 import stealth
-from stealth.impl_rax.auth_token import AdminToken
+from stealth.impl_rax.admin_token import get_admin_token
 from stealth.impl_rax import token_validation
+from stealth.impl_rax.bulkhead import BulkheadFullError
 from stealth import conf
 from stealth.common import context
 from stealth.common import local
@@ -38,6 +40,13 @@ def _http_unauthorized(start_response):
     return []
 
 
+def _http_service_unavailable(start_response, retry_after):
+    """Responds with HTTP 503."""
+    start_response('503 Service Unavailable', [('Content-Length', '0'),
+        ('Retry-After', str(retry_after))])
+    return []
+
+
 def wrap(app, redis_client):
     """Wrap a WSGI app with Authentication middleware.
 
@@ -50,15 +59,13 @@ def wrap(app, redis_client):
     auth_url = conf.auth.auth_url
     admin_name = conf.auth.admin_name
     admin_pass = conf.auth.admin_pass
-    Admintoken = AdminToken(auth_url, admin_name, admin_pass)
+    Admintoken = get_admin_token(auth_url, admin_name, admin_pass,
+        redis_client=redis_client)
+    token_validation.start_cache_invalidation(redis_client)
 
     from threading import local as local_factory
     stealth.context = local_factory()
 
-    # TODO:
-    # blacklist_ttl = conf.'blacklist_ttl'
-    # max_cache_life = conf.'max_cache_life'
-
     def middleware(env, start_response):
 
         # Inject transaction-id into the response headers.
@@ -70,6 +77,7 @@ def wrap(app, redis_client):
                 stealth.context.transaction.request_id)))
             return start_response(status, headers, exc_info)
 
+        start = time.time()
         try:
             project_id = env['HTTP_X_PROJECT_ID']
             token = ''
@@ -81,17 +89,26 @@ def wrap(app, redis_client):
 
             # Validate the input cache_key.
             valid, token = token_validation.validate_client_token(redis_client,
-                auth_url, project_id, cache_key)
+                auth_url, project_id, cache_key, Admintoken)
             if valid:
+                token_validation.record_outcome('hit', start)
                 env['X-AUTH-TOKEN'] = token
                 env.pop('HTTP_X_AUTH_TOKEN', cache_key)
                 return app(env, transactionhook)
 
-            # Validate the client with the impersonation token
+            # Reuse the tenant's current token when one is cached
             valid, usertoken, cache_key = \
-                token_validation.validate_client_impersonation(
+                token_validation.validate_tenant_token(
                     redis_client, auth_url, project_id, Admintoken)
+            outcome = 'tenant_hit'
+            if not valid:
+                # Validate the client with the impersonation token
+                valid, usertoken, cache_key = \
+                    token_validation.validate_client_impersonation(
+                        redis_client, auth_url, project_id, Admintoken)
+                outcome = 'impersonated'
             if valid and usertoken and usertoken['token']:
+                token_validation.record_outcome(outcome, start)
 
                 # Inject cahce_key as the auth token into the response headers.
                 def custom_start_response(status, headers, exc_info=None):
@@ -106,10 +123,17 @@ def wrap(app, redis_client):
             else:
                 # Validation failed for some reason, just error out as a 401
                 LOG.error(('Middleware: Auth Token validation failed.'))
+                token_validation.record_outcome('unauthorized', start)
                 return _http_unauthorized(start_response)
+        except BulkheadFullError as ex:
+            # Keystone is saturated, have the client come back later
+            LOG.error(('Middleware: Auth Token validation shed.'))
+            token_validation.record_outcome('shed', start)
+            return _http_service_unavailable(start_response, ex.retry_after)
         except (KeyError, LookupError):
             # Header failure, error out with 412
             LOG.error(('Middleware: Missing required headers.'))
+            token_validation.record_outcome('precondition_failed', start)
             return _http_precondition_failed(start_response)
 
     return middleware
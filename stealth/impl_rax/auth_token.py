@@ -15,6 +15,7 @@
 
 import functools
 import datetime
+import time
 import stealth.util.log as logging
 import pytz
 import dateutil
@@ -25,11 +26,29 @@ from keystoneclient import exceptions
 import simplejson as json
 from oslo_utils import timeutils
 import validators
+from stealth.impl_rax import keystone_client
+from stealth.impl_rax import token_lifetime
+from stealth.impl_rax.auth_token_cache import _send_username_to_cache, \
+    _retrieve_username_from_cache, _invalidate_username_cache, _expires_ms, \
+    _send_failure_to_cache
 
 STALE_TOKEN_DURATION = 30
 LOG = logging.getLogger(__name__)
 
 
+def failure_class(status_code, failure):
+    """Classify a failed Keystone answer about the tenant
+
+    Only answers about the tenant itself are classified; an unauthorized
+    admin token, server errors and the like are not the tenant's doing.
+
+    :returns: failure, or None when the answer is not about the tenant
+    """
+    if 400 <= status_code < 500 and status_code != 401:
+        return failure
+    return None
+
+
 class TokenBase(object):
 
     def __init__(self, url, tenant, token=None):
@@ -37,19 +56,19 @@ class TokenBase(object):
         self._tenant = tenant
         self._token = token
         self._expires = str(timeutils.utcnow())
-        self._norm_expires = self.normal_time(self._expires)
+        self._expires_ms = int(time.time() * 1000)
+        self._issued_ms = self._expires_ms
         try:
             if tenant and token is None:
                 self._update_token()
         except (exceptions.AuthorizationFailure,
                 exceptions.Unauthorized) as ex:
             # token update is failed.
-            msg = ('auth token: Failed to update token for \
-                    %(tenant)s: %(s_except)s') % {
+            LOG.debug(('auth token: Failed to update token for \
+                    %(tenant)s: %(s_except)s'), {
                 'tenant': self._tenant,
-                's_except': str(ex)
-            }
-            LOG.debug(msg)
+                's_except': ex
+            })
 
     @abstractmethod
     def _update_token(self):
@@ -72,12 +91,18 @@ class TokenBase(object):
             datetime.timedelta(seconds=stale_duration))
         return expires < soon
 
+    @staticmethod
+    def will_expire_soon_ms(expires_ms, stale_duration=None):
+        stale_duration = (STALE_TOKEN_DURATION if stale_duration is None
+                          else stale_duration)
+        return expires_ms < (time.time() + stale_duration) * 1000
+
     @property
     def token(self):
         if self._token is None:
             return None
         try:
-            if self.will_expire_soon(self._norm_expires):
+            if self.will_expire_soon_ms(self._expires_ms):
                 self._update_token()
             return self._token
         except exceptions.AuthorizationFailure:
@@ -89,7 +114,15 @@ class TokenBase(object):
 
     @property
     def expires_norm(self):
-        return self._norm_expires
+        return self.normal_time(self._expires)
+
+    @property
+    def expires_ms(self):
+        return self._expires_ms
+
+    @property
+    def issued_ms(self):
+        return self._issued_ms
 
     @property
     def tenant(self):
@@ -100,10 +133,11 @@ class TokenBase(object):
         if self._token is None:
             return None
         try:
-            if self.will_expire_soon(self._norm_expires):
+            if self.will_expire_soon_ms(self._expires_ms):
                 self._update_token()
             return {'token': self._token, 'tenant': self._tenant,
-                'expires': self._expires}
+                'expires': self._expires, 'expires_ms': self._expires_ms,
+                'issued_ms': self._issued_ms}
         except exceptions.AuthorizationFailure:
             return None
 
@@ -122,70 +156,125 @@ class AdminToken(TokenBase):
         headers['Content-type'] = 'application/json'
         data = '{"auth":{"passwordCredentials":{"username":"%s",\
             "password":"%s"}}}' % (self._tenant, self._passwd)
-        res = requests.post(urlpath, headers=headers, data=data)
+        try:
+            res = keystone_client.get_client().post(urlpath,
+                endpoint='tokens', headers=headers, data=data)
+        except requests.RequestException:
+            raise exceptions.AuthorizationFailure
         if res.status_code != 200:
             raise exceptions.AuthorizationFailure
         self._token = res.json()['access']['token']['id']
         self._expires = res.json()['access']['token']['expires']
-        self._norm_expires = self.normal_time(self._expires)
+        self._expires_ms = _expires_ms(self._expires)
+        self._issued_ms = int(time.time() * 1000)
 
 
 class UserToken(TokenBase):
 
-    def __init__(self, url, tenant, admintoken, token=None):
+    def __init__(self, url, tenant, admintoken, token=None,
+            redis_client=None):
         self._admintoken = admintoken
+        self._redis_client = redis_client
+        # Class of the last failed impersonation, see failure_class()
+        self._failure = None
         super(UserToken, self).__init__(url=url, tenant=tenant, token=token)
 
+    def _lookup_username(self, client, headers):
+        """Resolve the tenant to its admin username through Keystone"""
+
+        # Step 1. List users of the tenant
+        urlpath = '{0}/tenants/{1}/users'.format(
+            self.auth_url, self._tenant)
+        res = client.get(urlpath, endpoint='tenant_users',
+            headers=headers)
+        if res.status_code != 200:
+            self._failure = failure_class(res.status_code, 'no_users')
+            raise exceptions.AuthorizationFailure
+        users = res.json()['users']
+        if not users:
+            self._failure = 'no_users'
+            raise exceptions.AuthorizationFailure
+        userid = users[0]['id']
+
+        # Step 2. Lookup the admin role user id of the tenant
+        urlpath = '{0}/users/{1}/RAX-AUTH/admins'.format(
+            self.auth_url, userid)
+        res = client.get(urlpath, endpoint='user_admins',
+            headers=headers)
+        if res.status_code != 200:
+            self._failure = failure_class(res.status_code, 'no_admin')
+            raise exceptions.AuthorizationFailure
+        admins = res.json()['users']
+        if not admins:
+            self._failure = 'no_admin'
+            raise exceptions.AuthorizationFailure
+        username = admins[0]['username']
+
+        _send_username_to_cache(self._redis_client, self._tenant, username)
+        return username
+
+    def _impersonate(self, client, headers, username):
+        """Create the impersonation token for the user"""
+        urlpath = '{0}/RAX-AUTH/impersonation-tokens'.format(self.auth_url)
+        data = '{"RAX-AUTH:impersonation": {"user": {"username":"%s"}, \
+            "expire-in-seconds": %d}}' % (username,
+            token_lifetime.impersonation_lifetime(self._tenant))
+        return client.post(urlpath, endpoint='impersonation_tokens',
+            headers=headers, data=data)
+
     def _update_token(self):
 
+        self._failure = None
         try:
-            # Step 1. List users of the tenant
-            urlpath = '{0}/tenants/{1}/users'.format(
-                self.auth_url, self._tenant)
             headers = {}
             headers['X-Auth-Token'] = self._admintoken.token
-            res = requests.get(urlpath, headers=headers)
-            if res.status_code != 200:
-                raise exceptions.AuthorizationFailure
-            userid = res.json()['users'][0]['id']
+            client = keystone_client.get_client()
 
-            # Step 2. Lookup the admin role user id of the tenant
-            urlpath = '{0}/users/{1}/RAX-AUTH/admins'.format(
-                self.auth_url, userid)
-            res = requests.get(urlpath, headers=headers)
-            if res.status_code != 200:
-                raise exceptions.AuthorizationFailure
-            username = res.json()['users'][0]['username']
+            # Steps 1 and 2 are skipped while the admin username is cached
+            username = _retrieve_username_from_cache(self._redis_client,
+                self._tenant)
+            cached = username is not None
+            if not cached:
+                username = self._lookup_username(client, headers)
 
             # Step 3. Create the impersonation token for the user
-            urlpath = '{0}/RAX-AUTH/impersonation-tokens'.format(self.auth_url)
-            headers['Content-Type'] = 'application/json'
-            data = '{"RAX-AUTH:impersonation": {"user": {"username":"%s"}, \
-                "expire-in-seconds": 10800}}' % (username)
-            res = requests.post(urlpath, headers=headers, data=data)
+            impersonation_headers = dict(headers)
+            impersonation_headers['Content-Type'] = 'application/json'
+            res = self._impersonate(client, impersonation_headers, username)
+            if cached and 400 <= res.status_code < 500 and \
+                    res.status_code != 401:
+                # The cached admin username may be stale, resolve it again
+                _invalidate_username_cache(self._redis_client, self._tenant)
+                username = self._lookup_username(client, headers)
+                res = self._impersonate(client, impersonation_headers,
+                    username)
             if res.status_code != 200:
+                self._failure = failure_class(res.status_code, 'rejected')
                 raise exceptions.AuthorizationFailure
             self._token = res.json()['access']['token']['id']
             self._expires = res.json()['access']['token']['expires']
-            self._norm_expires = self.normal_time(self._expires)
+            self._expires_ms = _expires_ms(self._expires)
+            self._issued_ms = int(time.time() * 1000)
         except (exceptions.AuthorizationFailure,
                 exceptions.Unauthorized) as ex:
             # Provided data was invalid and authorization failed
-            msg = ('auth token: Failed to authenticate against %(s_url)s'
-                ' - %(s_except)s') % {
+            LOG.debug(('auth token: Failed to authenticate against %(s_url)s'
+                ' - %(s_except)s'), {
                 's_url': self.auth_url,
-                's_except': str(ex)
-            }
-            LOG.debug(msg)
+                's_except': ex
+            })
             self._token = None
             self._expires = None
+            if self._failure is not None:
+                # Spare Keystone the same failing calls for a while
+                _send_failure_to_cache(self._redis_client, self._tenant,
+                    self._failure)
         except Exception as ex:
             # Provided data was invalid or something else went wrong
-            msg = ('auth token: Failed to authenticate against %(s_url)s'
-                ' - %(s_except)s') % {
+            LOG.debug(('auth token: Failed to authenticate against %(s_url)s'
+                ' - %(s_except)s'), {
                 's_url': self.auth_url,
-                's_except': str(ex)
-            }
-            LOG.debug(msg)
+                's_except': ex
+            })
             self._token = None
             self._expires = None
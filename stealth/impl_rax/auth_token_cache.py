@@ -17,10 +17,62 @@ import stealth.util.log as logging
 import simplejson as json
 import hmac
 import hashlib
+import time
+import calendar
+import re
+import threading
+import dateutil.parser
+import msgpack
+import redis
+from stealth import conf
+from stealth.common.lru import LRUCache
+from stealth.impl_rax import invalidation
+from stealth.impl_rax import token_lifetime
+from stealth.util import metrics
 
 
 LOG = logging.getLogger(__name__)
 
+# In-process copy of the tenant -> admin username mapping
+_usernames = LRUCache(conf.auth.username_cache_size)
+
+# In-process copy of the tenant -> impersonation failure class blacklist
+_failures = LRUCache(conf.auth.blacklist_cache_size)
+
+# Classes of impersonation failures kept in the blacklist, see
+# _send_failure_to_cache
+FAILURE_CLASSES = ('no_users', 'no_admin', 'rejected')
+
+# Impersonations blacklisted and suppressed, by failure class
+_blacklist_lock = threading.Lock()
+_blacklist_counts = {'blacklisted': {}, 'suppressed': {}}
+
+# In-process L1 of the decoded token records, in front of redis
+_tokens = LRUCache(conf.local_cache.max_entries,
+    max_bytes=conf.local_cache.max_bytes) \
+    if conf.local_cache.enabled else None
+
+# Rough per-entry memory of a decoded record beside its raw size
+_TOKEN_ENTRY_OVERHEAD = 512
+
+# Redis round-trips per cache operation
+_round_trips_lock = threading.Lock()
+_round_trips = {}
+
+_redis_latency = metrics.histogram('stealth_redis_seconds',
+    'Latency of the token cache round-trips to Redis', ('operation',))
+
+# Version of the binary cache records, bumped on incompatible changes
+RECORD_VERSION = 1
+
+# Short tags of the binary record fields
+_RECORD_TAGS = (('token', 't'), ('tenant', 'n'), ('expires', 'e'),
+    ('expires_ms', 'x'), ('issued_ms', 'i'))
+
+# e.g. 2015-09-04T14:09:20.236Z, 2015-09-04 14:09:20+00:00
+_ISO_TIME = re.compile(r'^(\d{4})-(\d{2})-(\d{2})[T ](\d{2}):(\d{2}):(\d{2})'
+    r'(?:\.(\d+))?(Z|([+-])(\d{2}):?(\d{2}))?$')
+
 
 def _generate_cache_key(t):
     """Convert a tuple to a cache key."""
@@ -29,34 +81,187 @@ def _generate_cache_key(t):
     return hashval
 
 
-def _send_data_to_cache(redis_client, url, token_data):
+def _expires_ms(expires):
+    """Convert a Keystone expiry time string to epoch milliseconds.
+
+    Times without a zone are taken as UTC.  The ISO 8601 forms Keystone
+    returns are converted directly, anything else goes through dateutil.
+    """
+    match = _ISO_TIME.match(expires)
+    if match is None:
+        expires = dateutil.parser.parse(expires)
+        if expires.utcoffset() is not None:
+            expires = expires - expires.utcoffset()
+        return calendar.timegm(expires.timetuple()) * 1000 + \
+            expires.microsecond // 1000
+
+    (year, month, day, hour, minute, second, fraction, zone, sign,
+        zone_hour, zone_minute) = match.groups()
+    seconds = calendar.timegm((int(year), int(month), int(day), int(hour),
+        int(minute), int(second)))
+    if sign is not None:
+        offset = int(zone_hour) * 3600 + int(zone_minute) * 60
+        seconds = seconds - offset if sign == '+' else seconds + offset
+    millis = int((fraction or '0')[:3].ljust(3, '0'))
+    return seconds * 1000 + millis
+
+
+def _count_round_trip(operation, count=1):
+    with _round_trips_lock:
+        _round_trips[operation] = _round_trips.get(operation, 0) + count
+
+
+def round_trip_stats():
+    """Redis round-trips made by this process, per cache operation
+
+    :returns: dict of operation name to number of round-trips
+    """
+    with _round_trips_lock:
+        return dict(_round_trips)
+
+
+def _encode_record(data):
+    """Convert token data to the configured storable format
+
+    msgpack records are maps of short field tags with a version under 'v';
+    json records are the token data itself.
+    """
+    if data is not None and conf.auth_redis.record_format == 'msgpack':
+        record = {'v': RECORD_VERSION}
+        for field, tag in _RECORD_TAGS:
+            if field in data:
+                record[tag] = data[field]
+        return msgpack.packb(record, use_bin_type=True)
+    return json.dumps(data, sort_keys=True)
+
+
+def _decode_record(cached_data):
+    """Convert a stored record back to token data, json or msgpack."""
+    if isinstance(cached_data, str) or cached_data[:1] in (b'{', b'n'):
+        return json.loads(cached_data)
+
+    record = msgpack.unpackb(cached_data, raw=False)
+    if record.get('v') != RECORD_VERSION:
+        raise ValueError('Unknown record version {0}'.format(
+            record.get('v')))
+    return dict((field, record[tag])
+        for field, tag in _RECORD_TAGS if tag in record)
+
+
+def _is_current_record(cached_data):
+    """Whether a stored record is to be left in its format
+
+    Only json records are rewritten, as msgpack once it is configured, so
+    a worker still on json never turns msgpack records back.
+    """
+    is_json = isinstance(cached_data, str) or cached_data[:1] in (b'{', b'n')
+    return not is_json or conf.auth_redis.record_format == 'json'
+
+
+def local_cache_stats():
+    """Hit, miss and eviction counters of the in-process token cache
+
+    :returns: dict of counters, or None when the cache is disabled
+    """
+    if _tokens is None:
+        return None
+    return _tokens.stats()
+
+
+def _cache_entries():
+    """Entries of the in-process caches, by cache"""
+    caches = (('tokens', _tokens), ('usernames', _usernames),
+        ('failures', _failures))
+    return [((name,), len(cache)) for name, cache in caches
+        if cache is not None]
+
+
+metrics.gauge('stealth_local_cache_entries',
+    'Entries held in the in-process caches', ('cache',),
+    func=_cache_entries)
+metrics.gauge('stealth_local_cache_bytes',
+    'Approximate memory held in the in-process token cache',
+    func=lambda: _tokens.stats()['bytes'] if _tokens is not None else 0)
+
+
+def _retained_until_ms(expires_ms):
+    """Epoch milliseconds a record expiring at expires_ms is kept until
+
+    Expired records are kept [auth] stale_while_error seconds longer, to
+    be served while Keystone is unavailable.
+    """
+    return expires_ms + conf.auth.stale_while_error * 1000
+
+
+def _tenant_index_key(tenant):
+    """Build the key of the tenant's current token index entry."""
+    return 'tenant:{0}'.format(tenant)
+
+
+def _send_data_to_cache(redis_client, url, token_data, cache_key=None):
     """Stores the authentication data to cache
 
-    :param redis_client: redis.Redis object connected to the redis cache
+    The tenant's index entry is pointed at the new cache_key, so requests
+    without a client side token can find the tenant's current token.  The
+    record, the index and the invalidation are written in one atomic
+    MULTI/EXEC round-trip, with the expiry set by the SET itself.  Records
+    expire with the token, or [auth] max_cache_life after its issue when
+    that comes first.
+
+    :param redis_client: redis.Redis object connected to the redis cache,
+                         or any cache_backend.CacheBackend
     :param url: URL used for authentication
     :param token_data: json formatted token information to cache.
+    :param cache_key: existing client side auth_token to renew, the
+                      clients holding it keep using it
 
     :returns: True and cache_key on success, otherwise False and None
     """
+    queued = False
     try:
         # Convert the storable format
-        cache_data = json.dumps(token_data.token_data, sort_keys=True)
+        data = token_data.token_data
+        expires_ms = token_data.expires_ms
+        if data is not None:
+            expires_ms = data['expires_ms'] = \
+                token_lifetime.cache_expires_ms(data)
+        cache_data = _encode_record(data)
 
         # Build the cache key and store the value
         # Use the token's expiration time for the cache expiration
-        cache_key = _generate_cache_key(cache_data)
+        action = invalidation.STORE
+        if cache_key is None:
+            cache_key = _generate_cache_key(json.dumps(data,
+                sort_keys=True))
+        else:
+            action = invalidation.RENEW
+            if _tokens is not None:
+                _tokens.delete(cache_key)
+
+        with redis_client.pipeline(transaction=True) as pipe:
+            pipe.set(cache_key, cache_data,
+                pxat=_retained_until_ms(expires_ms))
 
-        redis_client.set(cache_key, cache_data)
-        redis_client.pexpireat(cache_key, token_data.expires_norm)
+            if data is not None and token_data.tenant:
+                index_key = _tenant_index_key(token_data.tenant)
+                pipe.set(index_key, cache_key,
+                    pxat=_retained_until_ms(expires_ms))
 
+            queued = invalidation.queue(pipe, action, cache_key,
+                token_data.tenant)
+            _count_round_trip('store')
+            with _redis_latency.time(operation='store'):
+                pipe.execute()
+
+        invalidation.sent(queued)
         return True, cache_key
 
     except Exception as ex:
-        msg = ('Endpoint: Failed to cache the data - Exception: \
-            %(s_except)s') % {
-            's_except': str(ex),
-        }
-        LOG.error(msg)
+        invalidation.sent(queued, success=False)
+        LOG.error(('Endpoint: Failed to cache the data - Exception: \
+            %(s_except)s'), {
+            's_except': ex,
+        })
         return False, None
 
 
@@ -68,41 +273,486 @@ def _retrieve_data_from_cache(redis_client, url, tenant, cache_key):
     :param tenant: tenant id of the user
     :param cache_key: client side auth_token for the tenant_id
 
-    :returns: cached user info on success, or None
+    :returns: cached user info on success, or None.  The info carries the
+    :         expiry as epoch milliseconds in 'expires_ms', and is shared
+    :         with the in-process cache, so it must not be modified.
     """
     if cache_key is None:
         return None
 
+    # Decoded records held in process skip redis altogether
+    if _tokens is not None:
+        data = _tokens.get(cache_key)
+        if data is not None:
+            return data
+
     cached_data = None
     try:
         # Look up the token from the cache
-        cached_data = redis_client.get(cache_key)
+        _count_round_trip('retrieve')
+        with _redis_latency.time(operation='retrieve'):
+            cached_data = redis_client.get(cache_key)
 
     except Exception:
-        LOG.debug(('Failed to retrieve data to cache for key %(s_key)s') % {
+        LOG.debug(('Failed to retrieve data to cache for key %(s_key)s'), {
             's_key': cache_key
         })
         return None
 
     if cached_data is not None:
-        # So 'data' can be used in the exception handler...
-        data = None
-
-        try:
-            return json.loads(cached_data)
-
-        except Exception as ex:
-            # The cached object didn't match what we expected
-            msg = ('Endpoint: Stored Data does not contain any credentials - '
-                'Exception: %(s_except)s; Data: $(s_data)s') % {
-                's_except': str(ex),
-                's_data': str(cached_data)
-            }
-            LOG.error(msg)
-            return None
+        return _load_cached_data(redis_client, cache_key, cached_data)
     else:
-        LOG.debug(('No data in cache for key %(s_key)s') % {
+        LOG.debug(('No data in cache for key %(s_key)s'), {
             's_key': cache_key
         })
         # It wasn't cached
         return None
+
+
+def _parse_cached_data(cached_data):
+    """Decode a record read from redis
+
+    :returns: the decoded user info, and whether the record is to be
+    :         rewritten, see _is_current_record
+    :raises: Exception when the record is malformed
+    """
+    data = _decode_record(cached_data)
+    if 'expires_ms' not in data:
+        # Records written before the epoch expiry are migrated
+        data['expires_ms'] = _expires_ms(data['expires'])
+        return data, True
+    return data, not _is_current_record(cached_data)
+
+
+def _log_malformed_data(ex, cached_data):
+    # The cached object didn't match what we expected
+    LOG.error(('Endpoint: Stored Data does not contain any credentials - '
+        'Exception: %(s_except)s; Data: $(s_data)s'), {
+        's_except': ex,
+        's_data': str(cached_data)
+    })
+
+
+def _keep_local(cache_key, data, cached_data):
+    """Keep a decoded record in the local cache until it expires"""
+    expires_at = data['expires_ms'] / 1000.0
+    if _tokens is not None and expires_at > time.time():
+        _tokens.set(cache_key, data, expires_at,
+            size=len(cached_data) + _TOKEN_ENTRY_OVERHEAD)
+
+
+def _load_cached_data(redis_client, cache_key, cached_data):
+    """Decode a record read from redis and keep it in the local cache
+
+    :returns: the decoded user info, or None if the record is malformed
+    """
+    try:
+        data, migrate = _parse_cached_data(cached_data)
+        if migrate:
+            _migrate_data_in_cache(redis_client, cache_key, data,
+                cached_data)
+
+    except Exception as ex:
+        _log_malformed_data(ex, cached_data)
+        return None
+
+    _keep_local(cache_key, data, cached_data)
+    return data
+
+
+def _retrieve_batch_from_cache(redis_client, url, cache_keys):
+    """Retrieve the authentication data of many cache keys at once
+
+    Keys held in the local cache are answered from it, the others are
+    fetched with a single MGET round-trip.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param url: URL used for authentication
+    :param cache_keys: list of client side auth_tokens
+
+    :returns: list of cached user info, or None, in the order of cache_keys
+    """
+    results = [None] * len(cache_keys)
+    missing = []
+    for position, cache_key in enumerate(cache_keys):
+        if not cache_key:
+            continue
+        data = _tokens.get(cache_key) if _tokens is not None else None
+        if data is not None:
+            results[position] = data
+        else:
+            missing.append(position)
+
+    if not missing:
+        return results
+
+    try:
+        _count_round_trip('batch_retrieve')
+        with _redis_latency.time(operation='batch_retrieve'):
+            values = redis_client.mget([cache_keys[position]
+                for position in missing])
+
+    except Exception:
+        LOG.debug(('Failed to retrieve a batch of %(s_count)s keys'), {
+            's_count': len(missing)
+        })
+        return results
+
+    for position, cached_data in zip(missing, values):
+        if cached_data is not None:
+            results[position] = _load_cached_data(redis_client,
+                cache_keys[position], cached_data)
+    return results
+
+
+def _revoke_data_from_cache(redis_client, url, cache_key):
+    """Revoke the authentication data from cache
+
+    The entry is dropped from redis, from the tenant index when it is the
+    tenant's current token, and from the local caches of every worker.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param url: URL used for authentication
+    :param cache_key: client side auth_token to revoke
+
+    :returns: True on success, otherwise False
+    """
+    if _tokens is not None:
+        _tokens.delete(cache_key)
+
+    queued = False
+    try:
+        tenant = None
+        _count_round_trip('revoke')
+        cached_data = redis_client.get(cache_key)
+        if cached_data is not None:
+            tenant = _decode_record(cached_data)['tenant']
+
+        index_key = _tenant_index_key(tenant) if tenant else None
+        with redis_client.pipeline(transaction=True) as pipe:
+            while True:
+                try:
+                    # Only drop the index if it still points at the
+                    # revoked token, checked and deleted atomically
+                    current = None
+                    if index_key is not None:
+                        pipe.watch(index_key)
+                        _count_round_trip('revoke')
+                        current = pipe.get(index_key)
+
+                    pipe.multi()
+                    pipe.delete(cache_key)
+                    if current is not None and current.decode() == cache_key:
+                        pipe.delete(index_key)
+                    queued = invalidation.queue(pipe, invalidation.REVOKE,
+                        cache_key, tenant)
+                    _count_round_trip('revoke')
+                    pipe.execute()
+                    invalidation.sent(queued)
+                    return True
+
+                except redis.WatchError:
+                    # The tenant got a new token meanwhile, look again
+                    queued = False
+                    continue
+
+    except Exception as ex:
+        invalidation.sent(queued, success=False)
+        LOG.error(('Endpoint: Failed to revoke the data - Exception: \
+            %(s_except)s'), {
+            's_except': ex,
+        })
+        return False
+
+
+def _evict_local(action, cache_key=None, tenant=None):
+    """Apply a published invalidation to the local caches."""
+    if action == invalidation.USERNAME:
+        if tenant:
+            _usernames.delete(tenant)
+    elif cache_key and _tokens is not None:
+        _tokens.delete(cache_key)
+
+
+def _resync_local():
+    """Drop every local entry, invalidations may have been missed."""
+    if _tokens is not None:
+        _tokens.clear()
+    _usernames.clear()
+
+
+def _migrate_data_in_cache(redis_client, cache_key, data, cached_data):
+    """Rewrite a cached record in the current format, keeping its expiry
+
+    The record is only rewritten if it still holds cached_data, checked
+    and set atomically under WATCH, so a token renewed meanwhile under the
+    same cache_key is never replaced by the old one.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param cache_key: client side auth_token of the record
+    :param data: the record with its epoch expiry filled in
+    :param cached_data: the record as it was read
+    """
+    if isinstance(cached_data, str):
+        cached_data = cached_data.encode('utf-8')
+    try:
+        with redis_client.pipeline(transaction=True) as pipe:
+            pipe.watch(cache_key)
+            _count_round_trip('migrate')
+            if pipe.get(cache_key) != cached_data:
+                return
+            pipe.multi()
+            pipe.set(cache_key, _encode_record(data),
+                pxat=_retained_until_ms(data['expires_ms']))
+            _count_round_trip('migrate')
+            pipe.execute()
+
+    except redis.WatchError:
+        # Replaced meanwhile, the newer record is kept
+        pass
+
+    except Exception as ex:
+        # The old record is still readable, retry on the next miss
+        LOG.debug(('Endpoint: Failed to migrate the data - Exception: \
+            %(s_except)s'), {
+            's_except': ex,
+        })
+
+
+def _retrieve_tenant_data_from_cache(redis_client, url, tenant):
+    """Retrieve the tenant's current authentication data from cache
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param url: URL used for authentication
+    :param tenant: tenant id of the user
+
+    :returns: the cache_key and the cached user info on success,
+    :         otherwise None and None
+    """
+    if not tenant:
+        return None, None
+
+    try:
+        # Look up the tenant's current cache_key from the index
+        _count_round_trip('tenant_index')
+        with _redis_latency.time(operation='tenant_index'):
+            cache_key = redis_client.get(_tenant_index_key(tenant))
+
+    except Exception:
+        LOG.debug(('Failed to retrieve the index for tenant %(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return None, None
+
+    if cache_key is None:
+        LOG.debug(('No index in cache for tenant %(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return None, None
+
+    if isinstance(cache_key, bytes):
+        cache_key = cache_key.decode()
+
+    cached_data = _retrieve_data_from_cache(redis_client, url, tenant,
+        cache_key)
+    if cached_data is None or cached_data.get('tenant') != tenant:
+        return None, None
+
+    return cache_key, cached_data
+
+
+def _username_key(tenant):
+    """Build the key of the tenant's admin username entry."""
+    return 'username:{0}'.format(tenant)
+
+
+def _send_username_to_cache(redis_client, tenant, username):
+    """Stores the tenant's admin username to cache
+
+    The mapping is kept in process and, when a redis client is given, in
+    the shared cache.  It is independent of the impersonation token, so it
+    outlives token renewals.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param tenant: tenant id of the user
+    :param username: admin username of the tenant
+
+    :returns: True on success, otherwise False
+    """
+    _usernames.set(tenant, username,
+        time.time() + conf.auth.username_cache_local_ttl)
+    if redis_client is None:
+        return True
+
+    try:
+        _count_round_trip('username_store')
+        redis_client.set(_username_key(tenant), username,
+            ex=conf.auth.username_cache_ttl)
+        return True
+
+    except Exception as ex:
+        LOG.error(('Endpoint: Failed to cache the username - Exception: \
+            %(s_except)s'), {
+            's_except': ex,
+        })
+        return False
+
+
+def _retrieve_username_from_cache(redis_client, tenant):
+    """Retrieve the tenant's admin username from cache
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param tenant: tenant id of the user
+
+    :returns: the admin username on success, or None
+    """
+    username = _usernames.get(tenant)
+    if username is not None or redis_client is None:
+        return username
+
+    try:
+        _count_round_trip('username_retrieve')
+        username = redis_client.get(_username_key(tenant))
+
+    except Exception:
+        LOG.debug(('Failed to retrieve the username for tenant '
+            '%(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return None
+
+    if username is None:
+        return None
+
+    if isinstance(username, bytes):
+        username = username.decode()
+    _usernames.set(tenant, username,
+        time.time() + conf.auth.username_cache_local_ttl)
+    return username
+
+
+def _invalidate_username_cache(redis_client, tenant):
+    """Drop the tenant's admin username from cache
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param tenant: tenant id of the user
+    """
+    _usernames.delete(tenant)
+    if redis_client is None:
+        return
+
+    queued = False
+    try:
+        with redis_client.pipeline(transaction=True) as pipe:
+            pipe.delete(_username_key(tenant))
+            queued = invalidation.queue(pipe, invalidation.USERNAME,
+                tenant=tenant)
+            _count_round_trip('username_invalidate')
+            pipe.execute()
+        invalidation.sent(queued)
+
+    except Exception as ex:
+        invalidation.sent(queued, success=False)
+        LOG.error(('Endpoint: Failed to invalidate the username - Exception: \
+            %(s_except)s'), {
+            's_except': ex,
+        })
+
+
+def _blacklist_key(tenant):
+    """Build the key of the tenant's blacklist entry."""
+    return 'blacklist:{0}'.format(tenant)
+
+
+def _count_blacklist(counter, failure):
+    with _blacklist_lock:
+        counts = _blacklist_counts[counter]
+        counts[failure] = counts.get(failure, 0) + 1
+
+
+def blacklist_stats():
+    """Impersonations blacklisted, and Keystone calls suppressed since
+
+    :returns: dict of 'blacklisted' and 'suppressed', each by failure class
+    """
+    with _blacklist_lock:
+        return dict((counter, dict(counts))
+            for counter, counts in _blacklist_counts.items())
+
+
+def _blacklist_ttl(failure):
+    """Seconds the failure class is blacklisted for, 0 when it is not"""
+    return getattr(conf.auth, 'blacklist_ttl_{0}'.format(failure), 0)
+
+
+def _send_failure_to_cache(redis_client, tenant, failure):
+    """Blacklist the tenant after a failed impersonation
+
+    Impersonations of the tenant are refused without calling Keystone
+    until the [auth] blacklist_ttl_<failure> of the class expires.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param tenant: tenant id of the user
+    :param failure: one of FAILURE_CLASSES
+
+    :returns: True on success, otherwise False
+    """
+    ttl = _blacklist_ttl(failure)
+    if ttl <= 0:
+        return False
+
+    _failures.set(tenant, failure, time.time() + ttl)
+    _count_blacklist('blacklisted', failure)
+    if redis_client is None:
+        return True
+
+    try:
+        _count_round_trip('blacklist_store')
+        redis_client.set(_blacklist_key(tenant), failure, ex=ttl)
+        return True
+
+    except Exception as ex:
+        LOG.error(('Endpoint: Failed to blacklist the tenant - Exception: \
+            %(s_except)s'), {
+            's_except': ex,
+        })
+        return False
+
+
+def _retrieve_failure_from_cache(redis_client, tenant):
+    """Retrieve the class of the tenant's blacklisted failure
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param tenant: tenant id of the user
+
+    :returns: the failure class while the tenant is blacklisted, or None
+    """
+    failure = _failures.get(tenant)
+    if failure is not None or redis_client is None:
+        return failure
+
+    try:
+        _count_round_trip('blacklist_retrieve')
+        with redis_client.pipeline(transaction=False) as pipe:
+            pipe.get(_blacklist_key(tenant))
+            pipe.pttl(_blacklist_key(tenant))
+            failure, ttl_ms = pipe.execute()
+
+    except Exception:
+        LOG.debug(('Failed to retrieve the blacklist for tenant '
+            '%(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return None
+
+    return _keep_failure(tenant, failure, ttl_ms)
+
+
+def _keep_failure(tenant, failure, ttl_ms):
+    """Copy a blacklist entry read from redis in process, until it expires"""
+    if failure is None or ttl_ms is None or ttl_ms <= 0:
+        return None
+    if isinstance(failure, bytes):
+        failure = failure.decode()
+    _failures.set(tenant, failure, time.time() + ttl_ms / 1000.0)
+    return failure
@@ -0,0 +1,202 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Bulkhead around the outbound Keystone work.
+#
+# At most [keystone] bulkhead_calls impersonations and renewals run at
+# once, up to bulkhead_queue more wait bulkhead_wait seconds for a slot,
+# and the rest are shed at once with BulkheadFullError, answered with a
+# 503 and a Retry-After of bulkhead_retry_after seconds.  Renewals of the
+# tenants already known, those whose admin username is cached, are given
+# the free slots before the first-time logins.
+#
+# Validations of tokens found in the cache never enter the bulkhead, so
+# they keep flowing while Keystone is slow.
+#
+
+import contextlib
+import os
+import threading
+import time
+import stealth.util.log as logging
+from stealth import conf
+from stealth.util import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+# Priorities, the lower first
+RENEWAL = 0
+LOGIN = 1
+PRIORITIES = (RENEWAL, LOGIN)
+
+_shed_calls = metrics.counter('stealth_keystone_shed_total',
+    'Keystone calls shed by the bulkhead', ('reason',))
+
+
+class BulkheadFullError(Exception):
+
+    """The Keystone work was shed, retry after retry_after seconds"""
+
+    def __init__(self, retry_after=1):
+        super(BulkheadFullError, self).__init__(
+            'Too many pending Keystone calls')
+        self.retry_after = retry_after
+
+
+class Bulkhead(object):
+
+    """Thread-safe bounded concurrency with a bounded priority queue.
+
+    :param max_calls: calls running at once
+    :param max_queue: calls waiting for a slot at once
+    :param wait: seconds a call waits for a slot before it is shed
+    :param retry_after: seconds the shed callers are told to wait
+    """
+
+    def __init__(self, max_calls=16, max_queue=64, wait=2.0, retry_after=1):
+        self._max_calls = max_calls
+        self._max_queue = max_queue
+        self._wait = wait
+        self._retry_after = retry_after
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = dict((priority, 0) for priority in PRIORITIES)
+        self._stats = {'admitted': 0, 'queued': 0, 'shed': 0,
+            'timed_out': 0}
+
+    def _admissible(self, priority):
+        return self._active < self._max_calls and not any(
+            self._waiting[other] for other in PRIORITIES if other < priority)
+
+    def _shed(self, reason):
+        self._stats[reason] += 1
+        _shed_calls.inc(reason=reason)
+        LOG.warning('Keystone: Call shed', fields={'reason': reason})
+        raise BulkheadFullError(self._retry_after)
+
+    def acquire(self, priority=LOGIN):
+        """Take a slot, waiting for one behind the higher priorities
+
+        :param priority: RENEWAL or LOGIN
+
+        :raises: BulkheadFullError when the queue is full, or no slot was
+                 freed in time
+        """
+        with self._cond:
+            if self._admissible(priority) and not self._waiting[priority]:
+                self._active += 1
+                self._stats['admitted'] += 1
+                return
+            if sum(self._waiting.values()) >= self._max_queue:
+                self._shed('shed')
+
+            self._stats['queued'] += 1
+            self._waiting[priority] += 1
+            deadline = time.time() + self._wait
+            try:
+                while not self._admissible(priority):
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self._shed('timed_out')
+                    self._cond.wait(remaining)
+                self._active += 1
+                self._stats['admitted'] += 1
+            finally:
+                self._waiting[priority] -= 1
+                # The lower priorities may have been held back by this one
+                self._cond.notify_all()
+
+    def release(self):
+        """Give back a slot"""
+        with self._cond:
+            self._active -= 1
+            self._cond.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, priority=LOGIN):
+        """Hold a slot for the duration of the block, see acquire()"""
+        self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def stats(self):
+        """Calls running and waiting, and counters of the bulkhead
+
+        :returns: dict of active and waiting calls, and of the calls
+                  admitted, queued, shed with a full queue and timed out
+        """
+        with self._cond:
+            return dict(self._stats, active=self._active,
+                waiting=sum(self._waiting.values()))
+
+
+_bulkhead = None
+_bulkhead_lock = threading.Lock()
+
+
+def get_bulkhead():
+    """The process wide Keystone bulkhead
+
+    uses the [keystone] bulkhead settings, None when it is disabled
+    """
+    global _bulkhead
+    if not conf.keystone.bulkhead:
+        return None
+    with _bulkhead_lock:
+        if _bulkhead is None:
+            _bulkhead = Bulkhead(max_calls=conf.keystone.bulkhead_calls,
+                max_queue=conf.keystone.bulkhead_queue,
+                wait=conf.keystone.bulkhead_wait,
+                retry_after=conf.keystone.bulkhead_retry_after)
+        return _bulkhead
+
+
+@contextlib.contextmanager
+def slot(priority=LOGIN):
+    """Hold a slot of the process wide bulkhead, if any, see Bulkhead"""
+    bulkhead = get_bulkhead()
+    if bulkhead is None:
+        yield
+        return
+    with bulkhead.slot(priority):
+        yield
+
+
+def _reset_bulkhead():
+    # Locks held by other threads at the fork are never released
+    global _bulkhead, _bulkhead_lock
+    _bulkhead_lock = threading.Lock()
+    _bulkhead = None
+
+
+def _bulkhead_calls():
+    bulkhead = _bulkhead
+    if bulkhead is None:
+        return []
+    stats = bulkhead.stats()
+    return [(('active',), stats['active']), (('waiting',), stats['waiting'])]
+
+
+metrics.gauge('stealth_keystone_bulkhead_calls',
+    'Keystone calls running and waiting in the bulkhead', ('state',),
+    func=_bulkhead_calls)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_bulkhead)
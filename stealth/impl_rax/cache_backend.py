@@ -0,0 +1,403 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Backends of the token cache.
+#
+# The cache functions take any CacheBackend where they take a redis
+# client: the Redis client itself, shared by the whole fleet, an
+# in-memory backend local to the process, or a SQLite backend on disk
+# shared by the processes of one node.  The backend is chosen by the
+# [cache] backend setting.
+#
+# Only Redis delivers the invalidations to the other processes, see
+# stealth.impl_rax.invalidation.  With the SQLite backend and several
+# processes, disable the [local_cache] or accept that revocations reach
+# the other processes once their local entries expire.
+#
+
+import contextlib
+import os
+import sqlite3
+import threading
+import time
+from abc import ABCMeta, abstractmethod
+import redis
+import stealth.util.log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+# Writes between two sweeps of the expired entries
+PURGE_INTERVAL = 1000
+
+
+def _now_ms():
+    return int(time.time() * 1000)
+
+
+def _expires_at_ms(ex=None, px=None, pxat=None):
+    """Epoch milliseconds of the expiry given as with Redis SET"""
+    if pxat is not None:
+        return int(pxat)
+    if px is not None:
+        return _now_ms() + int(px)
+    if ex is not None:
+        return _now_ms() + int(ex * 1000)
+    return None
+
+
+def _encode(value):
+    """Values are stored and returned as bytes, as with Redis"""
+    if isinstance(value, bytes):
+        return value
+    if not isinstance(value, str):
+        value = str(value)
+    return value.encode('utf-8')
+
+
+class CacheBackend(object, metaclass=ABCMeta):
+
+    """Key-value store with per-key expiry the token cache runs on.
+
+    The methods follow the Redis commands of the same name, so that a
+    redis.Redis client is a backend as is.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """The value of key as bytes, or None"""
+
+    @abstractmethod
+    def set(self, key, value, ex=None, px=None, pxat=None, nx=False):
+        """Store value under key
+
+        :param ex: seconds to expire in
+        :param px: milliseconds to expire in
+        :param pxat: epoch milliseconds to expire at
+        :param nx: only store the value if key holds none
+
+        :returns: True when stored, None otherwise
+        """
+
+    @abstractmethod
+    def delete(self, *keys):
+        """Drop keys, returns the number of keys dropped"""
+
+    @abstractmethod
+    def mget(self, keys):
+        """The values of many keys, or None, in the order of keys"""
+
+    @abstractmethod
+    def pttl(self, key):
+        """Milliseconds key lives for, -1 without expiry, -2 if missing"""
+
+    @abstractmethod
+    def pipeline(self, transaction=True):
+        """Commands queued and run together by execute()"""
+
+    def add(self, key, value, px=None):
+        """Atomically store value under key, unless key holds one already
+
+        :returns: True when stored, False otherwise
+        """
+        return bool(self.set(key, value, px=px, nx=True))
+
+    def publish(self, channel, message):
+        """No other process listens to a local backend"""
+        return 0
+
+
+class RedisBackend(redis.Redis, CacheBackend):
+
+    """The Redis client, shared by every process and host."""
+
+
+class _Pipeline(object):
+
+    """Commands of a local backend, run atomically by execute().
+
+    After watch(), the backend is held until execute() or reset() and the
+    commands run at once until multi(), as a check-and-set with Redis.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._commands = []
+        self._held = None
+        self._queueing = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.reset()
+
+    def _command(name):
+        def command(self, *args, **kwargs):
+            if not self._queueing:
+                return getattr(self._backend, name)(*args, **kwargs)
+            self._commands.append((name, args, kwargs))
+            return self
+        command.__name__ = name
+        return command
+
+    get = _command('get')
+    set = _command('set')
+    delete = _command('delete')
+    mget = _command('mget')
+    pttl = _command('pttl')
+    publish = _command('publish')
+
+    def watch(self, *keys):
+        """Hold the whole backend, run the commands at once"""
+        if self._held is None:
+            self._held = self._backend._atomic()
+            self._held.__enter__()
+        self._queueing = False
+
+    def multi(self):
+        """Queue the commands again, up to execute()"""
+        self._queueing = True
+
+    def execute(self):
+        """Run the queued commands atomically
+
+        :returns: list of the commands' results
+        """
+        commands, self._commands = self._commands, []
+        try:
+            with self._backend._atomic():
+                return [getattr(self._backend, name)(*args, **kwargs)
+                    for name, args, kwargs in commands]
+        finally:
+            self.reset()
+
+    def reset(self):
+        """Drop the queued commands and let go of the backend"""
+        self._commands = []
+        self._queueing = True
+        held, self._held = self._held, None
+        if held is not None:
+            held.__exit__(None, None, None)
+
+
+class MemoryBackend(CacheBackend):
+
+    """Process local backend, for single process deployments."""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data = {}
+        self._writes = 0
+
+    def _atomic(self):
+        return self._lock
+
+    def _live(self, key, now_ms):
+        entry = self._data.get(key)
+        if entry is not None and entry[1] is not None and \
+                entry[1] <= now_ms:
+            del self._data[key]
+            return None
+        return entry
+
+    def _purge(self, now_ms):
+        expired = [key for key, (value, expires_at) in self._data.items()
+            if expires_at is not None and expires_at <= now_ms]
+        for key in expired:
+            del self._data[key]
+
+    def get(self, key):
+        with self._lock:
+            entry = self._live(key, _now_ms())
+            return None if entry is None else entry[0]
+
+    def set(self, key, value, ex=None, px=None, pxat=None, nx=False):
+        expires_at = _expires_at_ms(ex, px, pxat)
+        now_ms = _now_ms()
+        with self._lock:
+            if nx and self._live(key, now_ms) is not None:
+                return None
+            self._data[key] = (_encode(value), expires_at)
+            self._writes += 1
+            if self._writes % PURGE_INTERVAL == 0:
+                self._purge(now_ms)
+        return True
+
+    def delete(self, *keys):
+        now_ms = _now_ms()
+        with self._lock:
+            dropped = 0
+            for key in keys:
+                if self._live(key, now_ms) is not None:
+                    del self._data[key]
+                    dropped += 1
+            return dropped
+
+    def mget(self, keys):
+        with self._lock:
+            return [self.get(key) for key in keys]
+
+    def pttl(self, key):
+        now_ms = _now_ms()
+        with self._lock:
+            entry = self._live(key, now_ms)
+            if entry is None:
+                return -2
+            if entry[1] is None:
+                return -1
+            return entry[1] - now_ms
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+    def _after_fork(self):
+        self._lock = threading.RLock()
+
+
+class SQLiteBackend(CacheBackend):
+
+    """Backend in a SQLite database in WAL mode, shared by one node.
+
+    Each thread has its own connection, and writes are serialized by
+    SQLite's database lock.
+
+    :param path: file of the database, created when missing
+    :param timeout: seconds to wait for the database lock
+    """
+
+    def __init__(self, path, timeout=5.0):
+        self._path = path
+        self._timeout = timeout
+        self._local = threading.local()
+        with self._atomic() as db:
+            db.execute('CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY '
+                'KEY, value BLOB NOT NULL, expires_at INTEGER)')
+            db.execute('CREATE INDEX IF NOT EXISTS cache_expires_at ON '
+                'cache (expires_at)')
+
+    def _connection(self):
+        local = self._local
+        # Connections are not carried over to forked children
+        if getattr(local, 'pid', None) != os.getpid():
+            db = sqlite3.connect(self._path, timeout=self._timeout,
+                isolation_level=None, check_same_thread=False)
+            db.execute('PRAGMA journal_mode=WAL')
+            db.execute('PRAGMA synchronous=NORMAL')
+            local.db, local.pid, local.depth, local.writes = db, \
+                os.getpid(), 0, 0
+        return local.db
+
+    @contextlib.contextmanager
+    def _atomic(self):
+        db = self._connection()
+        local = self._local
+        if local.depth == 0:
+            db.execute('BEGIN IMMEDIATE')
+        local.depth += 1
+        try:
+            yield db
+        except BaseException:
+            local.depth -= 1
+            if local.depth == 0:
+                db.execute('ROLLBACK')
+            raise
+        else:
+            local.depth -= 1
+            if local.depth == 0:
+                db.execute('COMMIT')
+
+    def _row(self, db, key, now_ms):
+        return db.execute('SELECT value, expires_at FROM cache WHERE '
+            'key = ? AND (expires_at IS NULL OR expires_at > ?)',
+            (key, now_ms)).fetchone()
+
+    def get(self, key):
+        row = self._row(self._connection(), _encode(key).decode('utf-8'),
+            _now_ms())
+        return None if row is None else bytes(row[0])
+
+    def set(self, key, value, ex=None, px=None, pxat=None, nx=False):
+        key = _encode(key).decode('utf-8')
+        expires_at = _expires_at_ms(ex, px, pxat)
+        now_ms = _now_ms()
+        with self._atomic() as db:
+            if nx and self._row(db, key, now_ms) is not None:
+                return None
+            db.execute('INSERT OR REPLACE INTO cache (key, value, '
+                'expires_at) VALUES (?, ?, ?)', (key, _encode(value),
+                expires_at))
+            self._local.writes += 1
+            if self._local.writes % PURGE_INTERVAL == 0:
+                db.execute('DELETE FROM cache WHERE expires_at <= ?',
+                    (now_ms,))
+        return True
+
+    def delete(self, *keys):
+        now_ms = _now_ms()
+        dropped = 0
+        with self._atomic() as db:
+            for key in keys:
+                key = _encode(key).decode('utf-8')
+                if self._row(db, key, now_ms) is not None:
+                    dropped += 1
+                db.execute('DELETE FROM cache WHERE key = ?', (key,))
+        return dropped
+
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+
+    def pttl(self, key):
+        now_ms = _now_ms()
+        row = self._row(self._connection(), _encode(key).decode('utf-8'),
+            now_ms)
+        if row is None:
+            return -2
+        if row[1] is None:
+            return -1
+        return row[1] - now_ms
+
+    def pipeline(self, transaction=True):
+        return _Pipeline(self)
+
+
+_memory_backend = None
+_memory_backend_lock = threading.Lock()
+
+
+def get_memory_backend():
+    """The process wide MemoryBackend"""
+    global _memory_backend
+    with _memory_backend_lock:
+        if _memory_backend is None:
+            _memory_backend = MemoryBackend()
+        return _memory_backend
+
+
+def _reset_locks():
+    # Locks held by other threads at the fork are never released
+    global _memory_backend_lock
+    _memory_backend_lock = threading.Lock()
+    if _memory_backend is not None:
+        _memory_backend._after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_locks)
@@ -0,0 +1,208 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Circuit breaker in front of Keystone.
+#
+# After [keystone] breaker_failures failed calls in a row (connection
+# errors, timeouts and 5xx answers) the circuit opens and the calls fail
+# at once with CircuitOpenError.  After breaker_recovery seconds it goes
+# half-open and lets breaker_half_open_calls probes through: a success
+# closes it, a failure opens it again.
+#
+# While the circuit is not closed, the validations may keep serving
+# tokens expired less than [auth] stale_while_error seconds ago.
+#
+
+import os
+import threading
+import time
+import requests
+import stealth.util.log as logging
+from stealth import conf
+from stealth.util import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+_transitions = metrics.counter('stealth_keystone_circuit_transitions_total',
+    'Keystone circuit transitions, by the state entered', ('state',))
+_rejected = metrics.counter('stealth_keystone_circuit_rejected_total',
+    'Keystone calls failed at once by the circuit')
+_stale_served = metrics.counter('stealth_keystone_circuit_stale_served_total',
+    'Expired tokens served while the Keystone circuit was not closed')
+
+
+class CircuitOpenError(requests.ConnectionError):
+
+    """Keystone is not called while the circuit is open"""
+
+
+class CircuitBreaker(object):
+
+    """Thread-safe circuit breaker.
+
+    :param failure_threshold: failed calls in a row that open the circuit
+    :param recovery_timeout: seconds the circuit stays open before the
+                             probes, and the longest a probe may take
+    :param half_open_calls: probes let through at once while half-open
+    """
+
+    def __init__(self, failure_threshold=5, recovery_timeout=30.0,
+            half_open_calls=1):
+        self._failure_threshold = failure_threshold
+        self._recovery_timeout = recovery_timeout
+        self._half_open_calls = half_open_calls
+        self._lock = threading.Lock()
+        self._state = CLOSED
+        self._failures = 0
+        self._changed_at = time.time()
+        self._probes = 0
+        self._stats = {'rejected': 0, 'stale_served': 0,
+            'transitions': {OPEN: 0, HALF_OPEN: 0, CLOSED: 0}}
+
+    def _transition(self, state):
+        LOG.warning('Keystone: Circuit %s after %s', state, self._state)
+        self._state = state
+        self._changed_at = time.time()
+        self._probes = 0
+        self._stats['transitions'][state] += 1
+        _transitions.inc(state=state)
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def allow(self):
+        """Admit a call, or fail it at once
+
+        :raises: CircuitOpenError while the circuit is open, or half-open
+                 with its probes under way
+        """
+        with self._lock:
+            elapsed = time.time() - self._changed_at
+            if self._state == OPEN and elapsed >= self._recovery_timeout:
+                self._transition(HALF_OPEN)
+            elif self._state == HALF_OPEN and \
+                    elapsed >= self._recovery_timeout:
+                # Probes that never reported back are given up on
+                self._changed_at = time.time()
+                self._probes = 0
+
+            if self._state == CLOSED:
+                return
+            if self._state == HALF_OPEN and \
+                    self._probes < self._half_open_calls:
+                self._probes += 1
+                return
+            self._stats['rejected'] += 1
+        _rejected.inc()
+        raise CircuitOpenError('Keystone circuit is open')
+
+    def success(self):
+        """Report a call that went through"""
+        with self._lock:
+            self._failures = 0
+            if self._state == HALF_OPEN:
+                self._transition(CLOSED)
+
+    def failure(self):
+        """Report a call that failed"""
+        with self._lock:
+            self._failures += 1
+            if self._state == HALF_OPEN or (self._state == CLOSED and
+                    self._failures >= self._failure_threshold):
+                self._transition(OPEN)
+
+    def serve_stale(self, expires_ms):
+        """Whether a token expired at expires_ms may still be served
+
+        Only while the circuit is not closed, and for [auth]
+        stale_while_error seconds past the expiry.
+        """
+        window_ms = conf.auth.stale_while_error * 1000
+        if window_ms <= 0 or expires_ms + window_ms <= time.time() * 1000:
+            return False
+        with self._lock:
+            if self._state == CLOSED:
+                return False
+            self._stats['stale_served'] += 1
+        _stale_served.inc()
+        return True
+
+    def stats(self):
+        """State, consecutive failures and counters of the circuit
+
+        :returns: dict of state, failures, rejected calls, stale tokens
+                  served and transitions by the state entered
+        """
+        with self._lock:
+            stats = dict(self._stats, state=self._state,
+                failures=self._failures)
+            stats['transitions'] = dict(self._stats['transitions'])
+            return stats
+
+
+_breaker = None
+_breaker_lock = threading.Lock()
+
+
+def get_breaker():
+    """The process wide Keystone circuit breaker
+
+    uses the [keystone] breaker settings, None when it is disabled
+    """
+    global _breaker
+    if not conf.keystone.breaker:
+        return None
+    with _breaker_lock:
+        if _breaker is None:
+            _breaker = CircuitBreaker(
+                failure_threshold=conf.keystone.breaker_failures,
+                recovery_timeout=conf.keystone.breaker_recovery,
+                half_open_calls=conf.keystone.breaker_half_open_calls)
+        return _breaker
+
+
+def serve_stale(expires_ms):
+    """Whether an expired token may be served, see CircuitBreaker"""
+    breaker = get_breaker()
+    return breaker is not None and breaker.serve_stale(expires_ms)
+
+
+def _reset_breaker():
+    # Locks held by other threads at the fork are never released
+    global _breaker, _breaker_lock
+    _breaker_lock = threading.Lock()
+    _breaker = None
+
+
+def _circuit_open():
+    breaker = _breaker
+    return 0 if breaker is None or breaker.state == CLOSED else 1
+
+
+metrics.gauge('stealth_keystone_circuit_open',
+    'Whether the Keystone circuit is open or half-open',
+    func=_circuit_open)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_breaker)
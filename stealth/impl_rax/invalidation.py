@@ -0,0 +1,258 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Invalidation bus keeping the per-worker caches coherent.
+#
+# Every change of a cached entry is published on a Redis channel, and each
+# worker runs a subscriber thread evicting the matching local entries.
+#
+
+import os
+import threading
+import time
+import simplejson as json
+import stealth.util.log as logging
+from stealth import conf
+
+
+LOG = logging.getLogger(__name__)
+
+STORE = 'store'
+RENEW = 'renew'
+REVOKE = 'revoke'
+USERNAME = 'username'
+
+# Longest pause between two reconnection attempts, in seconds
+MAX_RECONNECT_DELAY = 5.0
+
+_counters_lock = threading.Lock()
+_counters = {'published': 0, 'publish_errors': 0}
+
+
+def _message(action, cache_key=None, tenant=None):
+    """Build the payload of an invalidation message."""
+    return json.dumps({'a': action, 'k': cache_key, 't': tenant,
+        'ts': time.time()})
+
+
+def _count(name):
+    with _counters_lock:
+        _counters[name] += 1
+
+
+def publish(redis_client, action, cache_key=None, tenant=None):
+    """Publish the change of a cached entry to every worker
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param action: one of STORE, RENEW, REVOKE or USERNAME
+    :param cache_key: client side auth_token whose entry changed
+    :param tenant: tenant id of the entry
+
+    :returns: True on success, otherwise False
+    """
+    if not conf.local_cache.invalidation:
+        return True
+
+    try:
+        redis_client.publish(conf.local_cache.invalidation_channel,
+            _message(action, cache_key, tenant))
+        _count('published')
+        return True
+
+    except Exception as ex:
+        _count('publish_errors')
+        LOG.error(('Invalidation: Failed to publish %(s_action)s - '
+            'Exception: %(s_except)s'), {
+            's_action': action,
+            's_except': ex
+        })
+        return False
+
+
+def queue(pipe, action, cache_key=None, tenant=None):
+    """Queue the publish of a change in a transaction pipeline
+
+    Unlike publish(), the message is not counted when queued: the caller
+    reports it with sent() once the pipeline is executed, or failed.
+
+    :param pipe: pipeline the change is made in
+    :param action: one of STORE, RENEW, REVOKE or USERNAME
+    :param cache_key: client side auth_token whose entry changed
+    :param tenant: tenant id of the entry
+
+    :returns: True if a message was queued
+    """
+    if not conf.local_cache.invalidation:
+        return False
+    pipe.publish(conf.local_cache.invalidation_channel,
+        _message(action, cache_key, tenant))
+    return True
+
+
+def sent(queued, success=True):
+    """Count a message queued in a pipeline, once the pipeline ran
+
+    :param queued: what queue() returned
+    :param success: whether the pipeline was executed
+    """
+    if queued:
+        _count('published' if success else 'publish_errors')
+
+
+class Subscriber(threading.Thread):
+
+    """Worker thread applying the published invalidations locally.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param channel: name of the invalidation channel
+    :param evict: callable(action, cache_key, tenant) dropping local entries
+    :param resync: callable() dropping every local entry, called on each
+                   (re)subscription since messages may have been missed
+    """
+
+    def __init__(self, redis_client, channel, evict, resync):
+        super(Subscriber, self).__init__(name='stealth-invalidation')
+        self.daemon = True
+        self._redis_client = redis_client
+        self._channel = channel
+        self._evict = evict
+        self._resync = resync
+        self._stopped = threading.Event()
+        self._subscribed = threading.Event()
+        self._lock = threading.Lock()
+        self._stats = {'received': 0, 'errors': 0, 'reconnects': 0,
+            'resyncs': 0, 'lag_last': 0.0, 'lag_max': 0.0,
+            'lag_total': 0.0}
+
+    def run(self):
+        delay = 0.1
+        while not self._stopped.is_set():
+            pubsub = None
+            try:
+                pubsub = self._redis_client.pubsub(
+                    ignore_subscribe_messages=True)
+                pubsub.subscribe(self._channel)
+                self._resync()
+                with self._lock:
+                    self._stats['resyncs'] += 1
+                self._subscribed.set()
+                delay = 0.1
+
+                while not self._stopped.is_set():
+                    message = pubsub.get_message(timeout=1.0)
+                    if message is not None:
+                        self._handle(message)
+
+            except Exception as ex:
+                self._subscribed.clear()
+                with self._lock:
+                    self._stats['reconnects'] += 1
+                LOG.debug(('Invalidation: Subscriber disconnected - '
+                    'Exception: %(s_except)s'), {
+                    's_except': ex
+                })
+                self._stopped.wait(delay)
+                delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+            finally:
+                if pubsub is not None:
+                    try:
+                        pubsub.close()
+                    except Exception:
+                        pass
+
+    def _handle(self, message):
+        try:
+            data = json.loads(message['data'])
+            self._evict(data['a'], data.get('k'), data.get('t'))
+        except Exception as ex:
+            with self._lock:
+                self._stats['errors'] += 1
+            LOG.error(('Invalidation: Malformed message - '
+                'Exception: %(s_except)s'), {
+                's_except': ex
+            })
+            return
+
+        # Publisher and subscriber clocks may differ across hosts
+        lag = max(0.0, time.time() - data.get('ts', time.time()))
+        with self._lock:
+            self._stats['received'] += 1
+            self._stats['lag_last'] = lag
+            self._stats['lag_max'] = max(self._stats['lag_max'], lag)
+            self._stats['lag_total'] += lag
+
+    def wait_subscribed(self, timeout=None):
+        """Block until the subscription is live"""
+        return self._subscribed.wait(timeout)
+
+    def stop(self):
+        """Ask the thread to exit"""
+        self._stopped.set()
+
+    def stats(self):
+        """Received message, reconnection and lag counters"""
+        with self._lock:
+            stats = dict(self._stats)
+        stats['subscribed'] = self._subscribed.is_set()
+        return stats
+
+
+_subscriber = None
+_subscriber_args = None
+_subscriber_lock = threading.Lock()
+
+
+def start_subscriber(redis_client, evict, resync):
+    """Start the process wide subscriber, once
+
+    It is started again in forked children, which do not inherit threads.
+
+    :returns: the running Subscriber, or None when invalidation is disabled
+    """
+    global _subscriber, _subscriber_args
+    if not conf.local_cache.invalidation:
+        return None
+
+    with _subscriber_lock:
+        if _subscriber is None or not _subscriber.is_alive():
+            _subscriber_args = (redis_client, evict, resync)
+            _subscriber = Subscriber(redis_client,
+                conf.local_cache.invalidation_channel, evict, resync)
+            _subscriber.start()
+        return _subscriber
+
+
+def stats():
+    """Publisher counters and, when running, the subscriber's counters"""
+    with _counters_lock:
+        result = dict(_counters)
+    if _subscriber is not None:
+        result.update(_subscriber.stats())
+    return result
+
+
+def _restart_in_child():
+    global _subscriber, _subscriber_lock, _counters_lock
+    _subscriber_lock = threading.Lock()
+    _counters_lock = threading.Lock()
+    args, _subscriber = _subscriber_args, None
+    if args is not None:
+        start_subscriber(*args)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_in_child)
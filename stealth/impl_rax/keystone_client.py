@@ -0,0 +1,203 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import random
+import threading
+import time
+import requests
+from requests import adapters
+import stealth.util.log as logging
+from stealth import conf
+from stealth.impl_rax import circuit_breaker
+from stealth.util import metrics
+
+
+LOG = logging.getLogger(__name__)
+
+# Responses worth another try, Keystone or its load balancer is struggling
+RETRY_STATUS_CODES = frozenset([502, 503, 504])
+
+_latency = metrics.histogram('stealth_keystone_seconds',
+    'Latency of the Keystone calls, including the admin logins as '
+    'tokens', ('endpoint',))
+_errors = metrics.counter('stealth_keystone_errors_total',
+    'Keystone calls failed or worth a retry', ('endpoint',))
+
+
+class KeystoneClient(object):
+
+    """Thread-safe HTTP client shared by all the Keystone calls.
+
+    Connections are pooled and kept alive between calls, every call has a
+    connect and a read timeout, and transient failures are retried with
+    jittered exponential backoff.  Latency is counted per endpoint.
+
+    :param breaker: CircuitBreaker every attempt goes through, if any
+    """
+
+    def __init__(self, pool_connections=10, pool_size=10,
+            connect_timeout=3.05, read_timeout=10.0, retries=2,
+            backoff_factor=0.1, backoff_max=2.0, keep_alive=True,
+            breaker=None):
+        self._timeout = (connect_timeout, read_timeout)
+        self._retries = retries
+        self._backoff_factor = backoff_factor
+        self._backoff_max = backoff_max
+        self._breaker = breaker
+
+        self._session = requests.Session()
+        adapter = adapters.HTTPAdapter(pool_connections=pool_connections,
+            pool_maxsize=pool_size)
+        self._session.mount('http://', adapter)
+        self._session.mount('https://', adapter)
+        if not keep_alive:
+            self._session.headers['Connection'] = 'close'
+
+        self._stats_lock = threading.Lock()
+        self._stats = {}
+
+    def request(self, method, url, endpoint=None, **kwargs):
+        """Send a request to Keystone
+
+        :param method: HTTP method
+        :param url: URL of the request
+        :param endpoint: name the latency is counted under, defaults to url
+        :param kwargs: passed on to requests.Session.request
+
+        :returns: requests.Response object
+        :raises: requests.RequestException once the retries are used up,
+                 circuit_breaker.CircuitOpenError while the circuit is open
+        """
+        endpoint = url if endpoint is None else endpoint
+        kwargs.setdefault('timeout', self._timeout)
+
+        attempt = 0
+        while True:
+            self._admit()
+            start = time.time()
+            try:
+                res = self._session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                self._record(endpoint, time.time() - start, failed=True)
+                self._report(failed=True)
+                if attempt >= self._retries:
+                    raise
+                LOG.debug(('Keystone: %(s_endpoint)s failed, retrying - '
+                    '%(s_except)s'), {
+                    's_endpoint': endpoint,
+                    's_except': ex
+                })
+            else:
+                retry = res.status_code in RETRY_STATUS_CODES
+                self._record(endpoint, time.time() - start, failed=retry)
+                self._report(failed=res.status_code >= 500)
+                if not retry or attempt >= self._retries:
+                    return res
+                LOG.debug(('Keystone: %(s_endpoint)s returned %(s_code)s, '
+                    'retrying'), {
+                    's_endpoint': endpoint,
+                    's_code': res.status_code
+                })
+
+            time.sleep(self._backoff(attempt))
+            attempt += 1
+
+    def get(self, url, endpoint=None, **kwargs):
+        """Send a GET request to Keystone"""
+        return self.request('GET', url, endpoint=endpoint, **kwargs)
+
+    def post(self, url, endpoint=None, **kwargs):
+        """Send a POST request to Keystone"""
+        return self.request('POST', url, endpoint=endpoint, **kwargs)
+
+    def _admit(self):
+        if self._breaker is not None:
+            self._breaker.allow()
+
+    def _report(self, failed):
+        if self._breaker is None:
+            return
+        if failed:
+            self._breaker.failure()
+        else:
+            self._breaker.success()
+
+    def _backoff(self, attempt):
+        """Full jitter: a random delay up to the exponential backoff."""
+        cap = min(self._backoff_max, self._backoff_factor * (2 ** attempt))
+        return random.uniform(0, cap)
+
+    def _record(self, endpoint, elapsed, failed=False):
+        _latency.observe(elapsed, endpoint=endpoint)
+        if failed:
+            _errors.inc(endpoint=endpoint)
+        with self._stats_lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = {'count': 0, 'errors': 0,
+                    'total_seconds': 0.0, 'max_seconds': 0.0}
+            stats['count'] += 1
+            stats['total_seconds'] += elapsed
+            stats['max_seconds'] = max(stats['max_seconds'], elapsed)
+            if failed:
+                stats['errors'] += 1
+
+    def stats(self):
+        """Per-endpoint latency counters
+
+        :returns: dict of endpoint to count, errors, total_seconds and
+                  max_seconds
+        """
+        with self._stats_lock:
+            return dict((endpoint, dict(stats))
+                for endpoint, stats in self._stats.items())
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Get the process wide Keystone client
+
+    uses the [keystone] settings
+    """
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = KeystoneClient(
+                    pool_connections=conf.keystone.pool_connections,
+                    pool_size=conf.keystone.pool_size,
+                    connect_timeout=conf.keystone.connect_timeout,
+                    read_timeout=conf.keystone.read_timeout,
+                    retries=conf.keystone.retries,
+                    backoff_factor=conf.keystone.backoff_factor,
+                    backoff_max=conf.keystone.backoff_max,
+                    keep_alive=conf.keystone.keep_alive,
+                    breaker=circuit_breaker.get_breaker())
+    return _client
+
+
+def _reset_client():
+    """Drop the client, a forked worker must not share pooled sockets."""
+    global _client, _client_lock
+    _client = None
+    _client_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_client)
@@ -0,0 +1,179 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Refresh-ahead of the cached tokens.
+#
+# Once a cached token has lived past a fraction of its lifetime, the
+# request that notices it is served at once while a background worker
+# replaces the Keystone token behind the same client side cache_key.
+#
+
+import os
+import threading
+import time
+from concurrent import futures
+import stealth.util.log as logging
+from stealth import conf
+
+
+LOG = logging.getLogger(__name__)
+
+
+class RefreshAhead(object):
+
+    """Runs the background renewals of the cached tokens.
+
+    A renewal runs at most once at a time per cache_key within the process
+    and, through a lease in Redis, across processes and hosts.
+
+    :param fraction: part of the token lifetime after which it is renewed,
+                     0 disables the renewals
+    :param workers: number of renewal threads
+    :param max_pending: most renewals queued or running at once
+    :param lease_ttl: seconds other workers leave a key's renewal alone
+    :param prefix: prefix of the lease keys in Redis
+    """
+
+    def __init__(self, fraction=0.75, workers=4, max_pending=1000,
+            lease_ttl=30.0, prefix='lease:refresh:'):
+        self._fraction = fraction
+        self._workers = workers
+        self._max_pending = max_pending
+        self._lease_ms = int(lease_ttl * 1000)
+        self._prefix = prefix
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pending = set()
+        self._stats = {'scheduled': 0, 'skipped': 0, 'renewed': 0,
+            'failed': 0}
+
+    def is_due(self, token_data):
+        """Whether a cached token has passed the renewal point
+
+        :param token_data: cached token data with 'issued_ms' and
+                           'expires_ms', records without the issue time
+                           are never renewed ahead
+        """
+        issued_ms = token_data.get('issued_ms')
+        if self._fraction <= 0 or not issued_ms:
+            return False
+        expires_ms = token_data['expires_ms']
+        renew_at = issued_ms + (expires_ms - issued_ms) * self._fraction
+        return time.time() * 1000 >= renew_at
+
+    def submit(self, cache_key, func, redis_client=None):
+        """Schedule the renewal of cache_key unless one is under way
+
+        :param cache_key: client side auth_token to renew
+        :param func: callable doing the renewal, takes no arguments and
+                     returns True on success
+        :param redis_client: redis.Redis object holding the leases
+
+        :returns: True if the renewal was scheduled
+        """
+        with self._lock:
+            if cache_key in self._pending or \
+                    len(self._pending) >= self._max_pending:
+                self._stats['skipped'] += 1
+                return False
+            # Reserved while the lease is taken outside the lock
+            self._pending.add(cache_key)
+
+        if redis_client is not None and \
+                not self._take_lease(redis_client, cache_key):
+            with self._lock:
+                self._pending.discard(cache_key)
+                self._stats['skipped'] += 1
+            return False
+
+        with self._lock:
+            if self._executor is None:
+                self._executor = futures.ThreadPoolExecutor(
+                    max_workers=self._workers)
+            self._stats['scheduled'] += 1
+            executor = self._executor
+
+        executor.submit(self._run, cache_key, func)
+        return True
+
+    def skip(self):
+        """Count a renewal left out by a caller scheduling its own"""
+        with self._lock:
+            self._stats['skipped'] += 1
+
+    def _take_lease(self, redis_client, cache_key):
+        # The lease is left to expire, so a failing renewal is not
+        # retried by every request before lease_ttl
+        try:
+            return bool(redis_client.set(
+                '{0}{1}'.format(self._prefix, cache_key), os.getpid(),
+                nx=True, px=self._lease_ms))
+        except Exception as ex:
+            LOG.debug(('Refresh ahead: Failed to take the lease for '
+                '%(s_key)s - %(s_except)s'), {
+                's_key': cache_key,
+                's_except': ex
+            })
+            return False
+
+    def _run(self, cache_key, func):
+        try:
+            renewed = func()
+        except Exception as ex:
+            LOG.error(('Refresh ahead: Failed to renew %(s_key)s - '
+                '%(s_except)s'), {
+                's_key': cache_key,
+                's_except': ex
+            })
+            renewed = False
+
+        with self._lock:
+            self._pending.discard(cache_key)
+            self._stats['renewed' if renewed else 'failed'] += 1
+
+    def stats(self):
+        """Scheduled, skipped, renewed and failed renewal counters"""
+        with self._lock:
+            stats = dict(self._stats)
+            stats['pending'] = len(self._pending)
+        return stats
+
+
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def get_refresher():
+    """The process wide RefreshAhead built from the [auth] settings"""
+    global _refresher
+    with _refresher_lock:
+        if _refresher is None:
+            _refresher = RefreshAhead(fraction=conf.auth.refresh_ahead,
+                workers=conf.auth.refresh_workers,
+                max_pending=conf.auth.refresh_max_pending,
+                lease_ttl=conf.auth.refresh_lease_ttl)
+        return _refresher
+
+
+def _reset_refresher():
+    # Worker threads are not inherited by forked children
+    global _refresher, _refresher_lock
+    _refresher_lock = threading.Lock()
+    _refresher = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_refresher)
@@ -0,0 +1,179 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+import threading
+import time
+import uuid
+import stealth.util.log as logging
+from stealth import conf
+
+
+LOG = logging.getLogger(__name__)
+
+
+class _Call(object):
+
+    """An in-flight call other callers of the same key can wait on."""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    """Coalesces concurrent calls sharing a key within the process.
+
+    The first caller of a key runs the work, the others wait for it and
+    share its result.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func, lookup=None, redis_client=None):
+        """Run func once for all the concurrent callers of key
+
+        :param key: the coalescing key, e.g. the tenant id
+        :param func: callable doing the work, takes no arguments
+        :param lookup: unused, see RedisSingleFlight
+        :param redis_client: unused, see RedisSingleFlight
+
+        :returns: the result of func
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as ex:
+            call.error = ex
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+        return call.result
+
+
+class RedisSingleFlight(SingleFlight):
+
+    """Coalesces concurrent calls across processes and hosts.
+
+    Calls are first coalesced within the process.  The remaining leader
+    then takes a lease in Redis; only the lease holder runs the work while
+    the other processes poll lookup() for the result it publishes.
+    """
+
+    def __init__(self, lease_ttl=10.0, wait=10.0, poll_interval=0.05,
+            prefix='lease:'):
+        super(RedisSingleFlight, self).__init__()
+        self._lease_ms = int(lease_ttl * 1000)
+        self._wait = wait
+        self._poll_interval = poll_interval
+        self._prefix = prefix
+
+    def do(self, key, func, lookup=None, redis_client=None):
+        """Run func once for all the concurrent callers of key
+
+        :param key: the coalescing key, e.g. the tenant id
+        :param func: callable doing the work, takes no arguments
+        :param lookup: callable returning the result published by the
+                       lease holder, or None while it is not available
+        :param redis_client: redis.Redis object holding the leases
+
+        :returns: the result of func, or of lookup
+        """
+        if redis_client is None:
+            return super(RedisSingleFlight, self).do(key, func)
+        return super(RedisSingleFlight, self).do(key, functools.partial(
+            self._leased, redis_client, key, func, lookup))
+
+    def _leased(self, redis_client, key, func, lookup):
+        lease_key = '{0}{1}'.format(self._prefix, key)
+        lease_id = str(uuid.uuid4())
+        deadline = time.time() + self._wait
+
+        while True:
+            try:
+                acquired = redis_client.set(lease_key, lease_id, nx=True,
+                    px=self._lease_ms)
+            except Exception as ex:
+                # Never let the lease block the work itself
+                LOG.debug(('Single flight: Failed to take the lease for '
+                    '%(s_key)s - %(s_except)s'), {
+                    's_key': key,
+                    's_except': ex
+                })
+                return func()
+
+            if acquired:
+                try:
+                    return func()
+                finally:
+                    self._release(redis_client, lease_key, lease_id)
+
+            if lookup is not None:
+                result = lookup()
+                if result is not None:
+                    return result
+
+            if time.time() >= deadline:
+                LOG.debug(('Single flight: Gave up waiting on the lease '
+                    'for %(s_key)s'), {
+                    's_key': key
+                })
+                return func()
+
+            time.sleep(self._poll_interval)
+
+    @staticmethod
+    def _release(redis_client, lease_key, lease_id):
+        """Delete the lease, unless it expired and was taken over."""
+        try:
+            with redis_client.pipeline() as pipe:
+                pipe.watch(lease_key)
+                current = pipe.get(lease_key)
+                if current is not None and current.decode() == lease_id:
+                    pipe.multi()
+                    pipe.delete(lease_key)
+                    pipe.execute()
+        except Exception as ex:
+            # The lease expires on its own
+            LOG.debug(('Single flight: Failed to release the lease '
+                '%(s_key)s - %(s_except)s'), {
+                's_key': lease_key,
+                's_except': ex
+            })
+
+
+def get_single_flight():
+    """Build the impersonation coalescer from the [auth] settings."""
+    if conf.auth.coalesce == 'redis':
+        return RedisSingleFlight(lease_ttl=conf.auth.coalesce_lease_ttl,
+            wait=conf.auth.coalesce_wait, prefix='lease:impersonate:')
+    return SingleFlight()
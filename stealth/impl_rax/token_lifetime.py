@@ -0,0 +1,124 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Lifetime of the impersonation tokens and of their cache records.
+#
+# Every token asks Keystone for [auth] token_lifetime seconds, and no
+# record outlives [auth] max_cache_life seconds in the cache.  In adaptive
+# mode, tenants seen often get tokens up to adaptive_max_lifetime long, so
+# they are renewed less often, while rarely seen tenants get tokens down
+# to adaptive_min_lifetime, so their records leave Redis sooner.
+#
+
+import math
+import os
+import threading
+import time
+from stealth import conf
+from stealth.common.lru import LRUCache
+
+
+class RequestRates(object):
+
+    """Per tenant request rates, as exponentially decayed counters.
+
+    :param window: seconds over which the rates are averaged
+    :param max_tenants: most tenants tracked, the least recently seen are
+                        forgotten first
+    """
+
+    def __init__(self, window=300.0, max_tenants=100000):
+        self._window = window
+        self._lock = threading.Lock()
+        # tenant -> (rate, time of the last update)
+        self._rates = LRUCache(max_tenants)
+
+    def _decayed(self, entry, now):
+        if entry is None:
+            return 0.0
+        rate, updated = entry
+        return rate * math.exp(-max(now - updated, 0) / self._window)
+
+    def hit(self, tenant):
+        """Count a request of the tenant"""
+        now = time.time()
+        with self._lock:
+            rate = self._decayed(self._rates.get(tenant), now) + \
+                1.0 / self._window
+            # Forgotten once the rate has decayed to nothing
+            self._rates.set(tenant, (rate, now), now + self._window * 10)
+
+    def rate(self, tenant):
+        """Requests per second of the tenant, lately"""
+        return self._decayed(self._rates.get(tenant), time.time())
+
+
+def impersonation_lifetime(tenant):
+    """Seconds of the tenant's next impersonation token
+
+    See the [auth] token_lifetime, max_cache_life and adaptive_* settings.
+    """
+    lifetime = conf.auth.token_lifetime
+    if conf.auth.adaptive_lifetime:
+        heat = 1.0
+        if conf.auth.adaptive_hot_rate > 0:
+            heat = min(get_rates().rate(tenant) /
+                conf.auth.adaptive_hot_rate, 1.0)
+        lifetime = conf.auth.adaptive_min_lifetime + heat * (
+            conf.auth.adaptive_max_lifetime - conf.auth.adaptive_min_lifetime)
+    return int(min(lifetime, conf.auth.max_cache_life))
+
+
+def record_request(tenant):
+    """Count a request of the tenant toward its adaptive lifetime"""
+    if conf.auth.adaptive_lifetime and tenant:
+        get_rates().hit(tenant)
+
+
+def cache_expires_ms(data):
+    """Epoch milliseconds a token record expires at in the cache
+
+    The token's own expiry, capped at [auth] max_cache_life seconds from
+    its issue, or from now for records without the issue time.
+    """
+    issued_ms = data.get('issued_ms') or int(time.time() * 1000)
+    return min(data['expires_ms'],
+        issued_ms + conf.auth.max_cache_life * 1000)
+
+
+_rates = None
+_rates_lock = threading.Lock()
+
+
+def get_rates():
+    """The process wide RequestRates built from the [auth] settings"""
+    global _rates
+    with _rates_lock:
+        if _rates is None:
+            _rates = RequestRates(window=conf.auth.adaptive_window,
+                max_tenants=conf.auth.adaptive_tenants)
+        return _rates
+
+
+def _reset_rates():
+    # Locks held by other threads at the fork are never released
+    global _rates, _rates_lock
+    _rates_lock = threading.Lock()
+    _rates = None
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_rates)
@@ -13,16 +13,53 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
+import itertools
+import time
 import stealth.util.log as logging
 import redis
 from redis import connection
 from stealth import conf
 from stealth.impl_rax.auth_token import UserToken, TokenBase
+from stealth.impl_rax import single_flight
+from stealth.impl_rax import bulkhead
+from stealth.impl_rax import invalidation
+from stealth.impl_rax import circuit_breaker
+from stealth.impl_rax import refresh_ahead
+from stealth.impl_rax import token_lifetime
+from stealth.impl_rax import auth_token_cache
+from stealth.impl_rax import cache_backend
 from stealth.impl_rax.auth_token_cache import _send_data_to_cache, \
-    _retrieve_data_from_cache
+    _retrieve_data_from_cache, _retrieve_tenant_data_from_cache
+from stealth.util import metrics
 
 LOG = logging.getLogger(__name__)
 
+# Coalesces the concurrent impersonations of the same tenant
+_impersonation_flight = single_flight.get_single_flight()
+
+# Outcomes of the authentications, see record_outcome
+OUTCOMES = ('hit', 'tenant_hit', 'impersonated', 'unauthorized',
+    'precondition_failed', 'shed')
+
+_requests = metrics.counter('stealth_auth_requests_total',
+    'Authentications, by outcome', ('outcome',))
+_request_latency = metrics.histogram('stealth_auth_seconds',
+    'Latency of the authentications, by outcome', ('outcome',))
+
+
+def record_outcome(outcome, start):
+    """Count an authentication and its latency
+
+    :param outcome: one of OUTCOMES, i.e. the client token was found, the
+                    tenant's current token was reused, a token was
+                    impersonated, or the request was answered with a 401,
+                    a 412 or a 503
+    :param start: epoch seconds the authentication started at
+    """
+    _requests.inc(outcome=outcome)
+    _request_latency.observe(time.time() - start, outcome=outcome)
+
 
 def get_auth_redis_client():
     """Get a Redis Client connection from the pool
@@ -46,64 +83,236 @@ def get_auth_redis_client():
                                     port=conf.auth_redis.port,
                                     db=conf.auth_redis.redis_db)
 
-    return redis.Redis(connection_pool=pool)
+    return cache_backend.RedisBackend(connection_pool=pool)
+
+
+def get_cache_backend():
+    """Get the backend of the token cache
+
+    uses the [cache] settings, the cnc:auth_redis settings with Redis
+    """
+
+    if conf.cache.backend == 'memory':
+        return cache_backend.get_memory_backend()
+    if conf.cache.backend == 'sqlite':
+        return cache_backend.SQLiteBackend(conf.cache.sqlite_path,
+            timeout=conf.cache.sqlite_timeout)
+    return get_auth_redis_client()
+
+
+def start_cache_invalidation(redis_client):
+    """Keep the local caches coherent with the other workers
+
+    Starts, once per process, the subscriber of the invalidation channel
+    on the given redis client.  See the [local_cache] settings.  Does
+    nothing with the backends other than Redis, which have no channel.
+    """
+    if not isinstance(redis_client, redis.Redis):
+        return None
+    return invalidation.start_subscriber(redis_client,
+        auth_token_cache._evict_local, auth_token_cache._resync_local)
+
+
+def _renew(redis_client, url, tenant, cache_key, admintoken):
+    """Replace the Keystone token behind cache_key with a fresh one"""
+
+    try:
+        with bulkhead.slot(bulkhead.RENEWAL):
+            user_token = UserToken(url=url, tenant=tenant,
+                admintoken=admintoken, redis_client=redis_client)
+    except bulkhead.BulkheadFullError:
+        LOG.debug(('Renewal of the token of %(s_tenant)s shed'), {
+            's_tenant': tenant
+        })
+        return False
+    if user_token.token_data is None:
+        LOG.debug(('Unable to renew the token of '
+            '%(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return False
+
+    retval, cache_key = _send_data_to_cache(redis_client,
+        url=url, token_data=user_token, cache_key=cache_key)
+    return retval
+
 
+def _refresh_ahead(redis_client, url, cache_key, token_data, admintoken):
+    """Schedule the renewal of a cached token past its renewal point"""
+    if admintoken is None:
+        return
+    refresher = refresh_ahead.get_refresher()
+    if refresher.is_due(token_data):
+        refresher.submit(cache_key, functools.partial(_renew, redis_client,
+            url, token_data['tenant'], cache_key, admintoken),
+            redis_client=redis_client)
 
-def validate_client_token(redis_client, url, tenant, cache_key):
+
+def validate_client_token(redis_client, url, tenant, cache_key,
+        admintoken=None):
     """Validate Input Client Token
 
-    :param redis_client: redis.Redis object connected to the redis cache
+    Tokens past the [auth] refresh_ahead fraction of their lifetime are
+    still served, while they are renewed in the background under the same
+    cache_key.
+
+    :param redis_client: redis.Redis object connected to the redis cache,
+                         or any cache_backend.CacheBackend
     :param url: Keystone Identity URL to authenticate against
     :param tenant: tenant id of user data to retrieve
     :param cache_key: client side auth_token for the tenant_id
+    :param admintoken: admin token object used by the renewals, none are
+                       made without it
 
     :returns: True and token-data on success, False and None otherwise
     """
 
+    token_lifetime.record_request(tenant)
     try:
         # Try to get the client's access infomration from cache
         token_data = _retrieve_data_from_cache(redis_client,
                 url, tenant, cache_key)
         if token_data is not None:
-            norm = TokenBase.normal_time(token_data['expires'])
-            if TokenBase.will_expire_soon(TokenBase.
-                    normal_time(token_data['expires'])):
+            if TokenBase.will_expire_soon_ms(token_data['expires_ms']):
+                if circuit_breaker.serve_stale(token_data['expires_ms']):
+                    # Keystone is unavailable, keep the client going
+                    LOG.info('Serving an expired token')
+                    return True, token_data['token']
                 LOG.info('Token has expired')
             else:
+                _refresh_ahead(redis_client, url, cache_key, token_data,
+                    admintoken)
                 return True, token_data['token']
 
         LOG.debug(('Unable to get Access information for '
-            '%(s_tenant)s') % {
+            '%(s_tenant)s'), {
             's_tenant': tenant
         })
         return False, None
 
     except Exception as ex:
-        msg = ('Endpoint: Error while trying to authenticate against'
-            ' %(s_url)s - %(s_except)s') % {
+        LOG.debug(('Endpoint: Error while trying to authenticate against'
+            ' %(s_url)s - %(s_except)s'), {
             's_url': url,
-            's_except': str(ex)
-        }
-        LOG.debug(msg)
+            's_except': ex
+        })
         return False, None
 
 
-def validate_client_impersonation(redis_client, url, tenant, admintoken):
-    """Validate Client Token
+def validate_client_tokens(redis_client, url, items, admintoken=None,
+        chunk_size=None):
+    """Validate Many Input Client Tokens
+
+    The cache keys are looked up a chunk at a time, each chunk with a
+    single MGET round-trip, and the verdicts are yielded as each chunk is
+    resolved.  A token is valid only for the tenant it was issued to.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param url: Keystone Identity URL to authenticate against
+    :param items: iterable of (tenant, cache_key) pairs
+    :param admintoken: admin token object used by the renewals, see
+                       validate_client_token
+    :param chunk_size: cache keys per MGET, defaults to [auth]
+                       batch_chunk_size
+
+    :returns: generator of (tenant, valid) in the order of items
+    """
+    if chunk_size is None:
+        chunk_size = conf.auth.batch_chunk_size
+    items = iter(items)
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            return
+        cached = auth_token_cache._retrieve_batch_from_cache(redis_client,
+            url, [cache_key for tenant, cache_key in chunk])
+        for (tenant, cache_key), token_data in zip(chunk, cached):
+            token_lifetime.record_request(tenant)
+            valid = False
+            if token_data is not None and \
+                    token_data.get('tenant') == tenant:
+                if TokenBase.will_expire_soon_ms(token_data['expires_ms']):
+                    if circuit_breaker.serve_stale(
+                            token_data['expires_ms']):
+                        valid = True
+                    else:
+                        LOG.info('Token has expired')
+                else:
+                    _refresh_ahead(redis_client, url, cache_key, token_data,
+                        admintoken)
+                    valid = True
+            yield tenant, valid
+
+
+def validate_tenant_token(redis_client, url, tenant, admintoken=None):
+    """Validate the Tenant's Current Cached Token
 
     :param redis_client: redis.Redis object connected to the redis cache
     :param url: Keystone Identity URL to authenticate against
-    :param admintoken: admin token object for Keystone Identity authentication
     :param tenant: tenant id of user data to retrieve
+    :param admintoken: admin token object used by the renewals, see
+                       validate_client_token
 
     :returns: True, the auth token, and the cachekey on success,
     :         otherwise False, None, and None
     """
 
-    user_token = UserToken(url=url, tenant=tenant, admintoken=admintoken)
+    try:
+        # Try to get the tenant's current token through the tenant index
+        cache_key, token_data = _retrieve_tenant_data_from_cache(
+            redis_client, url, tenant)
+        if token_data is not None:
+            if TokenBase.will_expire_soon_ms(token_data['expires_ms']):
+                if circuit_breaker.serve_stale(token_data['expires_ms']):
+                    # Keystone is unavailable, keep the client going
+                    LOG.info('Serving an expired token')
+                    return True, token_data, cache_key
+                LOG.info('Tenant token has expired')
+            else:
+                _refresh_ahead(redis_client, url, cache_key, token_data,
+                    admintoken)
+                return True, token_data, cache_key
+
+        LOG.debug(('Unable to get the current token for '
+            '%(s_tenant)s'), {
+            's_tenant': tenant
+        })
+        return False, None, None
+
+    except Exception as ex:
+        LOG.debug(('Endpoint: Error while looking up the tenant token for'
+            ' %(s_tenant)s - %(s_except)s'), {
+            's_tenant': tenant,
+            's_except': ex
+        })
+        return False, None, None
+
+
+def _lookup_tenant_token(redis_client, url, tenant):
+    """Return the tenant's cached token as an impersonation result, or None"""
+    result = validate_tenant_token(redis_client, url, tenant)
+    if result[0]:
+        return result
+    return None
+
+
+def _priority(redis_client, tenant):
+    """Tenants whose admin username is cached are renewals, see bulkhead"""
+    if auth_token_cache._retrieve_username_from_cache(redis_client,
+            tenant) is not None:
+        return bulkhead.RENEWAL
+    return bulkhead.LOGIN
+
+
+def _impersonate(redis_client, url, tenant, admintoken):
+    """Impersonate the tenant against Keystone and cache the token"""
+
+    with bulkhead.slot(_priority(redis_client, tenant)):
+        user_token = UserToken(url=url, tenant=tenant,
+            admintoken=admintoken, redis_client=redis_client)
     if user_token.token_data is None:
         LOG.debug(('Unable to get Access information for '
-            '%(s_tenant)s') % {
+            '%(s_tenant)s'), {
             's_tenant': tenant
         })
         return False, None, None
@@ -113,3 +322,49 @@ def validate_client_impersonation(redis_client, url, tenant, admintoken):
         url=url, token_data=user_token)
 
     return True, user_token.token_data, cache_key
+
+
+def _blacklisted(redis_client, tenant):
+    """Whether impersonations of the tenant are currently refused"""
+    failure = auth_token_cache._retrieve_failure_from_cache(redis_client,
+        tenant)
+    if failure is None:
+        return False
+    auth_token_cache._count_blacklist('suppressed', failure)
+    LOG.debug(('Impersonation of %(s_tenant)s suppressed, blacklisted '
+        'for %(s_failure)s'), {
+        's_tenant': tenant,
+        's_failure': failure
+    })
+    return True
+
+
+def validate_client_impersonation(redis_client, url, tenant, admintoken):
+    """Validate Client Token
+
+    Concurrent impersonations of the same tenant are coalesced, so only
+    one of them does the Keystone work and the others share its result.
+    Tenants blacklisted after a failed impersonation are refused without
+    calling Keystone, see the [auth] blacklist_ttl_* settings.  The
+    Keystone work goes through the bulkhead, see the [keystone] bulkhead
+    settings.
+
+    :param redis_client: redis.Redis object connected to the redis cache
+    :param url: Keystone Identity URL to authenticate against
+    :param admintoken: admin token object for Keystone Identity authentication
+    :param tenant: tenant id of user data to retrieve
+
+    :returns: True, the auth token, and the cachekey on success,
+    :         otherwise False, None, and None
+    :raises: bulkhead.BulkheadFullError when the Keystone work was shed
+    """
+
+    if _blacklisted(redis_client, tenant):
+        return False, None, None
+
+    return _impersonation_flight.do(tenant,
+        functools.partial(_impersonate, redis_client, url, tenant,
+            admintoken),
+        lookup=functools.partial(_lookup_tenant_token, redis_client, url,
+            tenant),
+        redis_client=redis_client)
@@ -14,12 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 from wsgiref import simple_server
 
 import falcon
 
 from stealth.transport.wsgi import v1_0
 from stealth.transport.wsgi import hooks
+from stealth.transport.wsgi import prefork
 import stealth.util.log as logging
 from stealth import conf
 
@@ -34,8 +36,6 @@ class Driver(object):
 
     def before_hooks(self, req, resp, params):
 
-        # Disk + Sqlite
-
         return [
             hooks.ContextHook(req, resp, params),
             hooks.TransactionidHook(req, resp, params)
@@ -56,7 +56,14 @@ class Driver(object):
                 self.app.add_route(version_path + route, resource)
 
     def listen(self):
-        """Self-host using 'bind' and 'port' from conf"""
+        """Self-host using 'bind' and 'port' from conf
+
+        With the [server] mode 'prefork', requests are served by a pool of
+        worker processes, see stealth.transport.wsgi.prefork.
+        """
+        if conf.server.mode == 'prefork':
+            return self._listen_prefork()
+
         msgtmpl = (u'Serving on host %(bind)s:%(port)s')
         LOG.info(msgtmpl,
             {'bind': conf.server.host, 'port': conf.server.port})
@@ -65,3 +72,18 @@ class Driver(object):
                                           conf.server.port,
                                           self.app)
         httpd.serve_forever()
+
+    def _listen_prefork(self):
+        sock = prefork.create_socket(conf.server.host, conf.server.port,
+            backlog=conf.server.backlog,
+            unix_socket=conf.server.unix_socket or None)
+        msgtmpl = (u'Serving on %(address)s with %(workers)s workers')
+        LOG.info(msgtmpl, {'address': sock.getsockname(),
+            'workers': conf.server.workers or os.cpu_count()})
+
+        arbiter = prefork.Arbiter(self.app, sock,
+            workers=conf.server.workers or os.cpu_count(),
+            threads=conf.server.threads,
+            keep_alive=conf.server.keep_alive,
+            graceful_timeout=conf.server.graceful_timeout)
+        arbiter.run()
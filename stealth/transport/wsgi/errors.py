@@ -29,6 +29,17 @@ import falcon.status_codes as status
 #             self.TITLE, description=description, **kwargs)
 
 
+class HTTPServiceUnavailableError(falcon.HTTPServiceUnavailable):
+
+    """Wraps falcon.HTTPServiceUnavailable"""
+
+    TITLE = u'Service temporarily unavailable'
+
+    def __init__(self, description, retry_after, **kwargs):
+        super(HTTPServiceUnavailableError, self).__init__(
+            self.TITLE, description, retry_after, **kwargs)
+
+
 class HTTPUnauthorizedError(falcon.HTTPUnauthorized):
 
     """Wraps falcon.HTTPUnauthorized"""
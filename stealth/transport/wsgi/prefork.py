@@ -0,0 +1,417 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Pre-forking WSGI server.
+#
+# The master process binds the listening socket, forks the workers and
+# keeps them running.  Each worker accepts connections on the shared
+# socket and serves them, with HTTP/1.1 keep-alive, on a bounded pool of
+# threads.
+#
+# Signals to the master:
+#   SIGHUP           replace the workers gracefully
+#   SIGTERM, SIGINT  stop, letting the workers finish their requests
+#
+
+import os
+import select
+import signal
+import socket
+import socketserver
+import threading
+import time
+from concurrent import futures
+from wsgiref import simple_server
+import stealth.util.log as logging
+
+
+LOG = logging.getLogger(__name__)
+
+# Longest request line accepted, as in http.server
+MAX_REQUEST_LINE = 65536
+
+# Seconds the accepting thread waits at once for a free serving thread
+SLOT_WAIT = 0.5
+
+
+class _Input(object):
+
+    """wsgi.input bounded by the request's Content-Length."""
+
+    def __init__(self, stream, length):
+        self._stream = stream
+        self._remaining = length
+
+    def _size(self, size):
+        if size is None or size < 0 or size > self._remaining:
+            return self._remaining
+        return size
+
+    def read(self, size=-1):
+        size = self._size(size)
+        data = self._stream.read(size) if size else b''
+        self._remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        size = self._size(size)
+        data = self._stream.readline(size) if size else b''
+        self._remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(self)
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self):
+        """Skip the body left unread, to reach the next request
+
+        :returns: False if the client went away first
+        """
+        while self._remaining > 0:
+            if not self.read(65536):
+                return False
+        return True
+
+
+class _ServerHandler(simple_server.ServerHandler):
+
+    http_version = '1.1'
+
+    def cleanup_headers(self):
+        super(_ServerHandler, self).cleanup_headers()
+        # Without a length the end of the response is the end of the
+        # connection
+        if 'Content-Length' not in self.headers:
+            self.request_handler.close_connection = True
+        if self.request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+
+class RequestHandler(simple_server.WSGIRequestHandler):
+
+    """Serves the requests of a connection until it closes."""
+
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        # Idle keep-alive connections are dropped after this many seconds
+        self.timeout = self.server.keep_alive or None
+        super(RequestHandler, self).setup()
+        if not self.client_address:
+            # Unix domain socket peers have no address
+            self.client_address = ('', 0)
+
+    def handle(self):
+        self.close_connection = True
+        self.handle_one_request()
+        while not self.close_connection:
+            self.handle_one_request()
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(MAX_REQUEST_LINE + 1)
+        except (socket.timeout, ConnectionError):
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+        if len(self.raw_requestline) > MAX_REQUEST_LINE:
+            self.requestline = ''
+            self.request_version = ''
+            self.command = ''
+            self.send_error(414)
+            self.close_connection = True
+            return
+        if not self.parse_request():
+            return
+
+        try:
+            length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(400, 'Bad Content-Length')
+            self.close_connection = True
+            return
+        if self.headers.get('Transfer-Encoding') or self.server.stopping:
+            self.close_connection = True
+
+        body = _Input(self.rfile, length)
+        handler = _ServerHandler(body, self.wfile, self.get_stderr(),
+            self.get_environ(), multithread=True, multiprocess=True)
+        handler.request_handler = self
+        handler.run(self.server.get_app())
+        if not body.drain():
+            self.close_connection = True
+
+    def log_message(self, format, *args):
+        LOG.debug('%s - %s', self.address_string(), format % args)
+
+
+class WSGIServer(simple_server.WSGIServer):
+
+    """WSGI server on an already listening socket.
+
+    Connections are served by a pool of at most `threads` threads.  While
+    every thread is busy no connection is accepted, so the overload waits
+    in the listen backlog, or is refused by the kernel past it.
+
+    :param sock: listening socket, TCP or Unix domain
+    :param app: the WSGI application
+    :param threads: most connections served at once
+    :param keep_alive: seconds an idle connection is kept open, 0 for no
+                       limit
+    """
+
+    def __init__(self, sock, app, threads=16, keep_alive=5.0):
+        self.address_family = sock.family
+        socketserver.TCPServer.__init__(self, sock.getsockname(),
+            RequestHandler, bind_and_activate=False)
+        self.socket.close()
+        self.socket = sock
+        if sock.family == getattr(socket, 'AF_UNIX', None):
+            self.server_name, self.server_port = 'localhost', 0
+        else:
+            host, self.server_port = sock.getsockname()[:2]
+            self.server_name = socket.getfqdn(host)
+        self.setup_environ()
+        self.set_app(app)
+        self.keep_alive = keep_alive
+        self.stopping = False
+        self._executor = futures.ThreadPoolExecutor(max_workers=threads)
+        self._slots = threading.BoundedSemaphore(threads)
+
+    def get_request(self):
+        """Accept a connection once a thread is free to serve it"""
+        # Timed, so that serve_forever() still notices shutdown()
+        if not self._slots.acquire(timeout=SLOT_WAIT):
+            raise OSError('Every thread is busy')
+        try:
+            return super(WSGIServer, self).get_request()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def shutdown_request(self, request):
+        """Close a connection, freeing its thread's slot"""
+        try:
+            super(WSGIServer, self).shutdown_request(request)
+        finally:
+            self._slots.release()
+
+    def process_request(self, request, client_address):
+        self._executor.submit(self._process_request_thread, request,
+            client_address)
+
+    def _process_request_thread(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def handle_error(self, request, client_address):
+        LOG.exception('Server: Failed to serve %s', client_address)
+
+    def stop(self):
+        """Stop accepting connections, from outside the serving thread"""
+        self.stopping = True
+        self.shutdown()
+
+    def server_close(self):
+        """Wait for the connections being served, then close the socket"""
+        self._executor.shutdown(wait=True)
+        super(WSGIServer, self).server_close()
+
+
+def create_socket(host, port, backlog=1024, unix_socket=None):
+    """Bind the listening socket shared by the workers
+
+    :param unix_socket: path of a Unix domain socket to listen on instead
+                        of host and port
+    """
+    if unix_socket:
+        if os.path.exists(unix_socket):
+            os.unlink(unix_socket)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(unix_socket)
+    else:
+        family, type_, proto, _, address = socket.getaddrinfo(host, port,
+            0, socket.SOCK_STREAM)[0]
+        sock = socket.socket(family, type_, proto)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(address)
+    sock.listen(backlog)
+    return sock
+
+
+class Arbiter(object):
+
+    """Pre-forks the workers serving app and keeps them running.
+
+    :param app: the WSGI application, shared by the forked workers
+    :param sock: listening socket from create_socket()
+    :param workers: number of worker processes
+    :param threads: threads per worker, see WSGIServer
+    :param keep_alive: keep-alive timeout, see WSGIServer
+    :param graceful_timeout: seconds a stopping worker has to finish its
+                             requests before it is killed
+    """
+
+    def __init__(self, app, sock, workers=4, threads=16, keep_alive=5.0,
+            graceful_timeout=30.0):
+        self._app = app
+        self._sock = sock
+        self._num_workers = workers
+        self._threads = threads
+        self._keep_alive = keep_alive
+        self._graceful_timeout = graceful_timeout
+        # pid -> spawn time, and pid -> kill deadline of the retiring ones
+        self._workers = {}
+        self._retiring = {}
+        self._signals = []
+        self._wakeup = None
+
+    def run(self):
+        """Serve until SIGTERM or SIGINT, must run in the main thread"""
+        self._wakeup = os.pipe()
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self._signal)
+        LOG.info('Server: Master %s starting %s workers', os.getpid(),
+            self._num_workers)
+
+        try:
+            while True:
+                self._reap()
+                self._kill_overdue()
+                self._spawn_workers()
+                signum = self._wait_signal(1.0)
+                if signum in (signal.SIGTERM, signal.SIGINT):
+                    break
+                if signum == signal.SIGHUP:
+                    self._restart()
+        finally:
+            self._stop()
+            for fd in self._wakeup:
+                os.close(fd)
+            for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+                signal.signal(signum, signal.SIG_DFL)
+
+    def _signal(self, signum, frame):
+        self._signals.append(signum)
+        try:
+            os.write(self._wakeup[1], b'.')
+        except OSError:
+            pass
+
+    def _wait_signal(self, timeout):
+        if not self._signals:
+            readable = select.select([self._wakeup[0]], [], [], timeout)[0]
+            if readable:
+                os.read(self._wakeup[0], 512)
+        return self._signals.pop(0) if self._signals else None
+
+    def _spawn_workers(self):
+        while len(self._workers) < self._num_workers:
+            pid = os.fork()
+            if pid == 0:
+                code = 0
+                try:
+                    self._worker()
+                except BaseException:
+                    LOG.exception('Server: Worker %s failed', os.getpid())
+                    code = 1
+                finally:
+                    os._exit(code)
+            self._workers[pid] = time.time()
+
+    def _worker(self):
+        for fd in self._wakeup:
+            os.close(fd)
+        server = WSGIServer(self._sock, self._app, threads=self._threads,
+            keep_alive=self._keep_alive)
+
+        def _graceful(signum, frame):
+            # shutdown() waits on serve_forever(), so not from its thread
+            threading.Thread(target=server.stop).start()
+
+        signal.signal(signal.SIGTERM, _graceful)
+        signal.signal(signal.SIGHUP, _graceful)
+        # The master stops the workers on Ctrl-C sent to the whole group
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        LOG.info('Server: Worker %s serving', os.getpid())
+        server.serve_forever()
+        server.server_close()
+
+    def _reap(self):
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if self._workers.pop(pid, None) is not None:
+                LOG.error('Server: Worker %s exited with status %s', pid,
+                    status)
+            self._retiring.pop(pid, None)
+
+    def _retire(self, pids):
+        deadline = time.time() + self._graceful_timeout
+        for pid in pids:
+            self._workers.pop(pid, None)
+            self._retiring[pid] = deadline
+            self._kill(pid, signal.SIGTERM)
+
+    def _kill_overdue(self):
+        now = time.time()
+        for pid, deadline in list(self._retiring.items()):
+            if now >= deadline:
+                self._kill(pid, signal.SIGKILL)
+
+    @staticmethod
+    def _kill(pid, signum):
+        try:
+            os.kill(pid, signum)
+        except ProcessLookupError:
+            pass
+
+    def _restart(self):
+        """Start a new set of workers, then retire the old ones"""
+        LOG.info('Server: Replacing the workers')
+        old = list(self._workers)
+        self._workers = {}
+        self._spawn_workers()
+        self._retire(old)
+
+    def _stop(self):
+        LOG.info('Server: Stopping the workers')
+        self._retire(list(self._workers))
+        while self._retiring:
+            self._reap()
+            self._kill_overdue()
+            if self._retiring:
+                time.sleep(0.05)
+        path = None
+        if self._sock.family == getattr(socket, 'AF_UNIX', None):
+            path = self._sock.getsockname()
+        self._sock.close()
+        if path and os.path.exists(path):
+            os.unlink(path)
@@ -15,6 +15,7 @@
 # limitations under the License.
 
 from stealth.transport.wsgi.v1_0 import controller_auth
+from stealth.transport.wsgi.v1_0 import controller_metrics
 
 
 def public_endpoints():
@@ -24,4 +25,10 @@ def public_endpoints():
         ('/auth',
          controller_auth.ItemResource()),
 
+        ('/auth/batch',
+         controller_auth.BatchResource()),
+
+        ('/metrics',
+         controller_metrics.MetricsResource()),
+
     ]
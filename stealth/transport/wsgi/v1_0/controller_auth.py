@@ -16,27 +16,32 @@
 
 import logging
 import falcon
+import simplejson as json
 # Load Rackspace version of auth endpoint.
 import stealth.impl_rax.auth_endpoint as auth
 from stealth.impl_rax import token_validation
+from stealth.impl_rax.bulkhead import BulkheadFullError
 import stealth.util.log as logging
 from stealth.transport.wsgi import errors
 from stealth import conf
 LOG = logging.getLogger(__name__)
 
 
-# Get the separated Redis Server for Auth
-auth_redis_client = token_validation.get_auth_redis_client()
+# Get the token cache, by default the separated Redis Server for Auth
+auth_redis_client = token_validation.get_cache_backend()
 
 authserv = auth.AuthServ(auth_redis_client)
 
+# Room for a project id, a token and the JSON around them, per batch item
+BATCH_ITEM_BYTES = 1024
+
 
 class ItemResource(object):
 
     def on_get(self, req, resp):
         try:
             project_id = req.headers['X-PROJECT-ID']
-            LOG.info('Auth [{0}]... '.format(project_id))
+            LOG.info('Auth [%s]... ', project_id)
             res, msg = authserv.auth(req, resp)
             if res is False:
                 raise errors.HTTPUnauthorizedError(msg)
@@ -44,7 +49,83 @@ class ItemResource(object):
                 resp.location = '/auth/%s' % (project_id)
             resp.status = falcon.HTTP_204  # This is the default status
             resp.set_header('X-AUTH-TOKEN', msg)
+        except BulkheadFullError as ex:
+            # Keystone is saturated, have the client come back later
+            LOG.error('Auth Token validation shed.')
+            raise errors.HTTPServiceUnavailableError(
+                "Too many pending authentications.", ex.retry_after)
         except (KeyError, LookupError):
             # Header failure, error out with 412
             LOG.error('Missing required headers.')
             raise errors.HTTPBadRequestBody("Missing required headers.")
+
+
+def _parse_batch(req):
+    """The (project_id, X-AUTH-TOKEN) pairs of a batch request body"""
+    # Oversized bodies are refused before they are read
+    max_bytes = conf.auth.batch_max_items * BATCH_ITEM_BYTES
+    length = req.content_length
+    if length is not None and length > max_bytes:
+        raise errors.HTTPBadRequestBody(
+            "At most {0} bytes per batch.".format(max_bytes))
+    body = req.stream.read(max_bytes + 1 if length is None else length)
+    if len(body) > max_bytes:
+        raise errors.HTTPBadRequestBody(
+            "At most {0} bytes per batch.".format(max_bytes))
+    try:
+        items = json.loads(body.decode('utf-8'))
+    except (ValueError, UnicodeDecodeError):
+        raise errors.HTTPBadRequestBody("Malformed JSON body.")
+    if not isinstance(items, list) or not all(
+            isinstance(item, list) and len(item) == 2 and
+            all(isinstance(value, str) for value in item)
+            for item in items):
+        raise errors.HTTPBadRequestBody(
+            "Expected a list of [project_id, token] pairs.")
+    if len(items) > conf.auth.batch_max_items:
+        raise errors.HTTPBadRequestBody(
+            "At most {0} tokens per batch.".format(conf.auth.batch_max_items))
+    return [tuple(item) for item in items]
+
+
+def _stream_verdicts(verdicts, chunk_size):
+    """Encode the verdicts as a JSON list, a chunk at a time"""
+    yield b'['
+    separator = ''
+    chunk = []
+    for project_id, valid in verdicts:
+        chunk.append(json.dumps({'project_id': project_id, 'valid': valid}))
+        if len(chunk) == chunk_size:
+            yield (separator + ','.join(chunk)).encode('utf-8')
+            separator = ','
+            chunk = []
+    if chunk:
+        yield (separator + ','.join(chunk)).encode('utf-8')
+    yield b']'
+
+
+class BatchResource(object):
+
+    """Validates many client tokens in one request.
+
+    The body is a JSON list of [project_id, X-AUTH-TOKEN] pairs, the
+    response a JSON list of {"project_id", "valid"} verdicts in the same
+    order.  Only tokens already issued are validated, no impersonation is
+    made on behalf of the tenants.  Batches larger than [auth]
+    batch_chunk_size are streamed as they are resolved.
+    """
+
+    def on_post(self, req, resp):
+        items = _parse_batch(req)
+        LOG.info('Auth batch of %s... ', len(items))
+        verdicts = token_validation.validate_client_tokens(
+            authserv.redis_client, authserv.auth_url, items,
+            authserv.Admintoken)
+        chunk_size = conf.auth.batch_chunk_size
+        resp.status = falcon.HTTP_200
+        resp.content_type = 'application/json'
+        if len(items) <= chunk_size:
+            resp.body = json.dumps([{'project_id': project_id,
+                'valid': valid} for project_id, valid in verdicts])
+        else:
+            resp.stream = _stream_verdicts(verdicts, chunk_size)
@@ -0,0 +1,33 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import falcon
+from stealth.transport.wsgi.v1_0 import controller_auth
+from stealth.util import metrics
+
+
+class MetricsResource(object):
+
+    """Serves the metrics in the Prometheus text format.
+
+    With the [metrics] aggregate setting, the totals of all the workers
+    sharing the auth Redis are served, whichever worker is scraped.
+    """
+
+    def on_get(self, req, resp):
+        resp.status = falcon.HTTP_200
+        resp.content_type = metrics.CONTENT_TYPE
+        resp.body = metrics.render(controller_auth.auth_redis_client)
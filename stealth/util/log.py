@@ -14,33 +14,245 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+#
+# With the [logging] queue setting, the records are put on a bounded
+# queue by the request threads, and a background thread does the I/O of
+# the configured handlers, so a slow disk or syslog never adds latency to
+# the requests.  Records finding the queue full are dropped and counted.
+# Below WARNING, the records of only a sample_rate fraction of the requests
+# are kept, all the records of a request or none.
+#
+
+import atexit
+import collections
+import collections.abc
 import logging
+import os
+import queue
+import threading
+import zlib
 from logging.config import dictConfig
+from logging.handlers import QueueHandler, QueueListener
+from stealth.common import context as request_context
 from stealth.common import local
-from stealth import config
+from stealth import config, conf
 _loggers = {}
+_configured = False
+_setup_lock = threading.Lock()
+
+_queue = None
+_queue_handlers = []
+_listener = None
+_stats = collections.Counter()
+_stats_lock = threading.Lock()
+
+
+def _count(name):
+    with _stats_lock:
+        _stats[name] += 1
+
+
+def stats():
+    """Counters of the queued logging
+
+    :returns: dict of the records waiting in the queue, dropped on a full
+              queue and left out by the sampling
+    """
+    with _stats_lock:
+        return {'queued': _queue.qsize() if _queue is not None else 0,
+            'dropped': _stats['dropped'],
+            'sampled_out': _stats['sampled_out']}
+
+
+class _RequestSampler(logging.Filter):
+
+    """Keeps the records below WARNING of a fraction of the requests"""
+
+    def __init__(self, rate):
+        super(_RequestSampler, self).__init__()
+        self._rate = rate
+        self._threshold = int(rate * 0xffffffff)
+
+    def filter(self, record):
+        if self._rate >= 1 or record.levelno >= logging.WARNING:
+            return True
+        request_id = getattr(record, 'request_id', None)
+        if not request_id or not request_id.startswith('req-'):
+            # Not serving a request
+            return True
+        if zlib.crc32(request_id.encode('utf-8')) <= self._threshold:
+            return True
+        _count('sampled_out')
+        return False
+
+
+class _QueueHandler(QueueHandler):
+
+    """Queues the records for the handlers it stands in for"""
+
+    def __init__(self, log_queue, targets):
+        super(_QueueHandler, self).__init__(log_queue)
+        self.targets = targets
+
+    def prepare(self, record):
+        record = super(_QueueHandler, self).prepare(record)
+        record.stealth_targets = self.targets
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            _count('dropped')
+
+
+class _Listener(QueueListener):
+
+    """Hands the queued records over to their handlers"""
+
+    def handle(self, record):
+        for handler in record.stealth_targets:
+            if record.levelno >= handler.level:
+                handler.handle(record)
 
+    def enqueue_sentinel(self):
+        # Waits for room, the records ahead of it are all handled
+        self.queue.put(self._sentinel)
 
-def setup():
-    log_config = config.dict()
-    log_config.update({'version': 1})
-    dictConfig(log_config)
+
+def _start_queue(log_config):
+    global _queue, _listener
+    _queue = queue.Queue(conf.logging.queue_size)
+    sampler = _RequestSampler(conf.logging.sample_rate)
+    names = list(log_config.get('loggers', {}))
+    if 'root' in log_config:
+        names.append('root')
+    for name in names:
+        logger = logging.getLogger(name)
+        if not logger.handlers or any(isinstance(handler, _QueueHandler)
+                for handler in logger.handlers):
+            continue
+        handler = _QueueHandler(_queue, tuple(logger.handlers))
+        handler.addFilter(sampler)
+        logger.handlers = [handler]
+        _queue_handlers.append(handler)
+    _listener = _Listener(_queue)
+    _listener.start()
+
+
+def _stop_queue():
+    """Handle the queued records, and stop the background thread"""
+    global _queue, _listener
+    if _listener is not None:
+        _listener.stop()
+    _listener = None
+    _queue = None
+    del _queue_handlers[:]
+
+
+def _restart_in_child():
+    # The background thread is not carried over to forked children
+    global _queue, _listener, _setup_lock, _stats_lock
+    _setup_lock = threading.Lock()
+    _stats_lock = threading.Lock()
+    if _listener is None:
+        return
+    _queue = queue.Queue(conf.logging.queue_size)
+    for handler in _queue_handlers:
+        handler.queue = _queue
+    _listener = _Listener(_queue)
+    _listener.start()
+
+
+def setup(reload=False):
+    """Configure logging from the config files, once per process
+
+    :param reload: configure again even if done already, which closes and
+                   opens the handlers anew
+
+    :returns: True when logging was configured by this call
+    """
+    global _configured
+    if _configured and not reload:
+        return False
+    with _setup_lock:
+        if _configured and not reload:
+            return False
+        _stop_queue()
+        log_config = config.dict()
+        log_config.update({'version': 1})
+        dictConfig(log_config)
+        if conf.logging.queue:
+            _start_queue(log_config)
+        _configured = True
+        return True
+
+
+class _Fields(object):
+
+    """Message followed by key=value fields, rendered when emitted"""
+
+    __slots__ = ('msg', 'args', 'fields')
+
+    def __init__(self, msg, args, fields):
+        self.msg = msg
+        self.args = args
+        self.fields = fields
+
+    def __str__(self):
+        msg = str(self.msg)
+        args = self.args
+        if len(args) == 1 and isinstance(args[0], collections.abc.Mapping) \
+                and args[0]:
+            # As with the records, a lone mapping is the mapping itself
+            args = args[0]
+        if args:
+            msg = msg % args
+        return ' '.join([msg] + ['{0}={1}'.format(key, value)
+            for key, value in self.fields.items()])
 
 
 class ContextAdapter(logging.LoggerAdapter):
 
+    """Adds the request id to the records, and the fields given.
+
+    The messages are formatted with their arguments only when emitted, as
+    with the loggers:
+
+        LOG.debug('Renewed %(s_tenant)s', {'s_tenant': tenant})
+        LOG.info('Renewed', fields={'tenant': tenant, 'ttl': ttl})
+
+    The fields are appended to the message as key=value pairs, and are
+    the record's fields attribute for the structured formatters.
+    """
+
     def process(self, msg, kwargs):
-        context = getattr(local.store, 'context', None)
+        context = request_context.current.get() or \
+            getattr(local.store, 'context', None)
         if context:
             kwargs['extra'] = {'request_id': context.request_id}
         else:
             kwargs['extra'] = {'request_id': 'Not in wsgi __call__'}
+        fields = kwargs.pop('fields', None)
+        if fields:
+            kwargs['extra']['fields'] = fields
         self.extra = kwargs['extra']
         return msg, kwargs
 
+    def log(self, level, msg, *args, **kwargs):
+        if kwargs.get('fields') and self.isEnabledFor(level):
+            msg, args = _Fields(msg, args, kwargs['fields']), ()
+        super(ContextAdapter, self).log(level, msg, *args, **kwargs)
+
 
 def getLogger(name):
     if name not in _loggers:
         _loggers[name] = ContextAdapter(logging.getLogger(name), extra={})
     setup()
     return _loggers[name]
+
+
+atexit.register(_stop_queue)
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_in_child)
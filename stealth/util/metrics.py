@@ -0,0 +1,455 @@
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+#
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+#
+# Metrics in the Prometheus text format.
+#
+# Counters and histograms are kept per process, each behind its own lock
+# held only for an addition.  With the [metrics] aggregate setting, a
+# background thread adds what every process counted since its last flush
+# to a Redis hash every flush_interval seconds, and publishes its gauges
+# under a key of its own expiring with it, so any worker renders the
+# totals of all the workers.
+#
+
+import contextlib
+import os
+import socket
+import threading
+import time
+import redis
+import stealth.util.log as logging
+from stealth import conf
+
+
+LOG = logging.getLogger(__name__)
+
+# Latency buckets, in seconds
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+    1.0, 2.5, 5.0, 10.0)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace(
+        '\n', '\\n')
+
+
+def _sample(name, labels):
+    """The exposition name of a sample, e.g. name{label="value"}"""
+    labels = list(labels)
+    if not labels:
+        return name
+    return '{0}{{{1}}}'.format(name, ','.join('{0}="{1}"'.format(
+        label, _escape(str(value))) for label, value in labels))
+
+
+def _sort_key(sample):
+    """Orders the buckets of a histogram by their bounds"""
+    head, _, le = sample.partition('le="')
+    if not le:
+        return sample, 0.0
+    return head, float(le.split('"', 1)[0].replace('+Inf', 'inf'))
+
+
+def _format_value(value):
+    if value == int(value):
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric(object):
+
+    """A metric and its samples by label values.
+
+    :param name: metric name
+    :param documentation: HELP text
+    :param labels: label names the samples are told apart by
+    """
+
+    kind = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        if set(labels) != set(self.labels):
+            raise ValueError('{0} takes the labels {1}'.format(self.name,
+                ', '.join(self.labels)))
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def _reset(self):
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def samples(self):
+        """The current samples, as a dict of exposition name to value"""
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+
+    """Monotonic count, e.g. of requests."""
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        """Add amount to the count of the labels"""
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return dict((_sample(self.name, zip(self.labels, key)), value)
+            for key, value in values.items())
+
+
+class Histogram(_Metric):
+
+    """Distribution of observations, e.g. of latencies.
+
+    :param buckets: upper bounds of the buckets, in increasing order
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labels=(),
+            buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Count one observation of value under the labels"""
+        key = self._key(labels)
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [0] * (len(self.buckets) + 1) + \
+                    [0.0]
+            entry[index] += 1
+            entry[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe the seconds spent in the block"""
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - start, **labels)
+
+    def samples(self):
+        with self._lock:
+            values = dict((key, list(entry))
+                for key, entry in self._values.items())
+        samples = {}
+        for key, entry in values.items():
+            labels = list(zip(self.labels, key))
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), entry):
+                cumulative += count
+                samples[_sample(self.name + '_bucket',
+                    labels + [('le', bound)])] = cumulative
+            samples[_sample(self.name + '_count', labels)] = cumulative
+            samples[_sample(self.name + '_sum', labels)] = entry[-1]
+        return samples
+
+
+class Gauge(_Metric):
+
+    """Value sampled when the metrics are collected, e.g. a cache size.
+
+    :param func: callable returning the value, or with labels, an iterable
+                 of (label values, value) pairs
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, documentation, labels=(), func=None):
+        super(Gauge, self).__init__(name, documentation, labels)
+        self._func = func
+
+    def samples(self):
+        try:
+            if not self.labels:
+                return {self.name: self._func()}
+            return dict((_sample(self.name, zip(self.labels, key)), value)
+                for key, value in self._func())
+        except Exception as ex:
+            LOG.debug(('Metrics: Failed to sample %(s_name)s - '
+                '%(s_except)s'), {
+                's_name': self.name,
+                's_except': ex
+            })
+            return {}
+
+
+class Registry(object):
+
+    """The metrics of the process, and their aggregation over Redis.
+
+    :param prefix: prefix of the Redis keys of the aggregated metrics
+    :param flush_interval: seconds between two flushes, the gauges of a
+                           process expire after three missed flushes
+    """
+
+    def __init__(self, prefix='metrics:', flush_interval=5.0):
+        self._prefix = prefix
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._metrics = {}
+        # Counts already added to Redis, by sample
+        self._flush_lock = threading.Lock()
+        self._flushed = {}
+
+    def _register(self, cls, name, *args, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('{0} is already a {1}'.format(name,
+                    metric.kind))
+            return metric
+
+    def counter(self, name, documentation, labels=()):
+        """Register a Counter, or return the one registered as name"""
+        return self._register(Counter, name, documentation, labels)
+
+    def histogram(self, name, documentation, labels=(),
+            buckets=DEFAULT_BUCKETS):
+        """Register a Histogram, or return the one registered as name"""
+        return self._register(Histogram, name, documentation, labels,
+            buckets=buckets)
+
+    def gauge(self, name, documentation, labels=(), func=None):
+        """Register a Gauge, or return the one registered as name"""
+        return self._register(Gauge, name, documentation, labels,
+            func=func)
+
+    def _sorted_metrics(self):
+        with self._lock:
+            return [self._metrics[name] for name in sorted(self._metrics)]
+
+    def collect(self):
+        """The samples of the process
+
+        :returns: dict of counted samples and dict of gauge samples, both
+                  by exposition name
+        """
+        counts, gauges = {}, {}
+        for metric in self._sorted_metrics():
+            (gauges if metric.kind == 'gauge' else counts).update(
+                metric.samples())
+        return counts, gauges
+
+    @property
+    def _counts_key(self):
+        return '{0}counts'.format(self._prefix)
+
+    @property
+    def _workers_key(self):
+        return '{0}workers'.format(self._prefix)
+
+    def flush(self, redis_client):
+        """Add the counts since the last flush to the Redis totals
+
+        :returns: True on success, False otherwise
+        """
+        with self._flush_lock:
+            return self._flush(redis_client)
+
+    def _flush(self, redis_client):
+        counts, gauges = self.collect()
+        deltas = dict((sample, value - self._flushed.get(sample, 0))
+            for sample, value in counts.items())
+        gauges_key = '{0}gauges:{1}:{2}'.format(self._prefix,
+            socket.gethostname(), os.getpid())
+        try:
+            with redis_client.pipeline(transaction=False) as pipe:
+                for sample, delta in deltas.items():
+                    if delta:
+                        pipe.hincrbyfloat(self._counts_key, sample, delta)
+                pipe.delete(gauges_key)
+                if gauges:
+                    pipe.hset(gauges_key, mapping=gauges)
+                    pipe.pexpire(gauges_key,
+                        int(self._flush_interval * 3000))
+                    pipe.sadd(self._workers_key, gauges_key)
+                pipe.execute()
+        except Exception as ex:
+            LOG.debug(('Metrics: Failed to flush - %(s_except)s'), {
+                's_except': ex
+            })
+            return False
+        self._flushed = counts
+        return True
+
+    def _read(self, redis_client):
+        """The totals of all the processes, from Redis"""
+        counts = redis_client.hgetall(self._counts_key)
+        workers = sorted(redis_client.smembers(self._workers_key))
+        with redis_client.pipeline(transaction=False) as pipe:
+            for worker in workers:
+                pipe.hgetall(worker)
+            worker_gauges = pipe.execute()
+
+        gauges = {}
+        for worker, values in zip(workers, worker_gauges):
+            if not values:
+                # The process is gone
+                redis_client.srem(self._workers_key, worker)
+            for sample, value in values.items():
+                sample = sample.decode()
+                gauges[sample] = gauges.get(sample, 0) + float(value)
+        return dict((sample.decode(), float(value))
+            for sample, value in counts.items()), gauges
+
+    def render(self, redis_client=None):
+        """The metrics in the Prometheus text format
+
+        :param redis_client: redis.Redis object holding the totals of all
+                             the processes, the metrics of this process
+                             alone are rendered without it
+
+        :returns: the exposition text
+        """
+        if redis_client is not None and self.flush(redis_client):
+            counts, gauges = self._read(redis_client)
+        else:
+            counts, gauges = self.collect()
+        samples = dict(counts, **gauges)
+
+        lines = []
+        for metric in self._sorted_metrics():
+            lines.append('# HELP {0} {1}'.format(metric.name,
+                metric.documentation))
+            lines.append('# TYPE {0} {1}'.format(metric.name, metric.kind))
+            for sample in sorted(samples, key=_sort_key):
+                name = sample.split('{', 1)[0]
+                if name == metric.name or (metric.kind == 'histogram' and
+                        name in (metric.name + '_bucket',
+                            metric.name + '_count', metric.name + '_sum')):
+                    lines.append('{0} {1}'.format(sample,
+                        _format_value(samples[sample])))
+        return '\n'.join(lines) + '\n'
+
+    def _reset(self):
+        """Forget the counts, a forked child starts from zero"""
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        for metric in self._metrics.values():
+            metric._reset()
+        self._flushed = {}
+
+
+class Flusher(threading.Thread):
+
+    """Background thread flushing a Registry to Redis."""
+
+    def __init__(self, registry, redis_client, interval):
+        super(Flusher, self).__init__(name='stealth-metrics')
+        self.daemon = True
+        self._registry = registry
+        self._redis_client = redis_client
+        self._interval = interval
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self._interval):
+            self._registry.flush(self._redis_client)
+
+    def stop(self):
+        """Ask the thread to exit"""
+        self._stopped.set()
+
+
+REGISTRY = Registry(prefix=conf.metrics.key_prefix,
+    flush_interval=conf.metrics.flush_interval)
+
+counter = REGISTRY.counter
+histogram = REGISTRY.histogram
+gauge = REGISTRY.gauge
+
+_flusher = None
+_flusher_client = None
+_flusher_lock = threading.Lock()
+
+
+def start_flusher(redis_client):
+    """Start the process wide flusher, once
+
+    It is started again in forked children, which do not inherit threads.
+
+    :returns: the running Flusher, or None when aggregation is disabled or
+              the cache backend is not Redis
+    """
+    global _flusher, _flusher_client
+    if not conf.metrics.aggregate or \
+            not isinstance(redis_client, redis.Redis):
+        return None
+    with _flusher_lock:
+        if _flusher is None or not _flusher.is_alive():
+            _flusher_client = redis_client
+            _flusher = Flusher(REGISTRY, redis_client,
+                conf.metrics.flush_interval)
+            _flusher.start()
+        return _flusher
+
+
+def render(redis_client=None):
+    """The process wide metrics in the Prometheus text format
+
+    :param redis_client: redis.Redis object, the totals of all the
+                         processes are rendered with it when the [metrics]
+                         aggregate setting is on
+    """
+    if not conf.metrics.aggregate or \
+            not isinstance(redis_client, redis.Redis):
+        redis_client = None
+    return REGISTRY.render(redis_client)
+
+
+def _log_records():
+    return [((state,), value) for state, value in logging.stats().items()]
+
+
+gauge('stealth_log_records', 'Log records queued, dropped when the queue '
+    'was full and left out by the sampling', ('state',), func=_log_records)
+
+
+def _restart_in_child():
+    global _flusher, _flusher_lock
+    _flusher_lock = threading.Lock()
+    REGISTRY._reset()
+    _flusher = None
+    if _flusher_client is not None:
+        start_flusher(_flusher_client)
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_restart_in_child)
@@ -0,0 +1,148 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import gc
+import threading
+import time
+import mock
+from stealth.impl_rax import admin_token
+from stealth.impl_rax.admin_token import AdminTokenManager, get_admin_token
+from stealth.impl_rax.token_validation import get_auth_redis_client
+# Mock requests
+import requests_mock
+
+
+class TestAdminTokenManager(TestCase):
+
+    def setUp(self):
+        super(TestAdminTokenManager, self).setUp()
+        self.redis = get_auth_redis_client()
+        self.managers = []
+
+    def tearDown(self):
+        for manager in self.managers:
+            manager.stop()
+            self.redis.delete(manager._shared_key, manager._lease_key)
+        super(TestAdminTokenManager, self).tearDown()
+
+    def manager(self, **kwargs):
+        kwargs.setdefault('redis_client', self.redis)
+        manager = AdminTokenManager('http://mockurl.com', 'admin', 'passwd',
+            **kwargs)
+        self.managers.append(manager)
+        return manager
+
+    @requests_mock.mock()
+    def test_shared_token(self, m):
+        m.post('http://mockurl.com/tokens', text='{"access": \
+            {"token": {"id": "the-admin-token", "expires": \
+            "2125-09-04T14:09:20.236Z"}}}')
+        # Logged in without sharing the token
+        self.redis.delete(self.manager(redis_client=None)._shared_key)
+        self.assertEqual(m.call_count, 1)
+
+        first = self.manager()
+        self.assertEqual(first.token, 'the-admin-token')
+        self.assertEqual(first.stats()['logins'], 1)
+        self.assertGreater(first._next_renewal(), 0)
+
+        # Other workers adopt the published token
+        second = self.manager()
+        self.assertEqual(second.token, 'the-admin-token')
+        self.assertEqual(second.stats(), {'logins': 0, 'adopted': 1,
+            'failures': 0})
+        self.assertEqual(m.call_count, 2)
+
+        # Concurrent renewals log in once
+        now_ms = int(time.time() * 1000)
+        first._issued_ms = now_ms - 3600000
+        first._expires_ms = now_ms + 600000
+        self.redis.delete(first._shared_key)
+        threads = [threading.Thread(target=first._update_token)
+            for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        self.assertEqual(first.stats()['logins'], 2)
+        self.assertEqual(m.call_count, 3)
+
+    @requests_mock.mock()
+    def test_login_lease(self, m):
+        m.post('http://mockurl.com/tokens', text='{"access": \
+            {"token": {"id": "the-admin-token", "expires": \
+            "2125-09-04T14:09:20.236Z"}}}')
+        manager = self.manager(redis_client=None)
+        self.assertEqual(manager.stats()['logins'], 1)
+
+        # Another worker holds the lease but never publishes
+        self.redis.delete(manager._shared_key)
+        self.redis.set(manager._lease_key, 'other-worker', px=10000)
+        manager = self.manager(wait=0.2)
+        self.assertEqual(manager.token, 'the-admin-token')
+        self.assertEqual(manager.stats()['logins'], 1)
+        self.assertIsNotNone(self.redis.get(manager._shared_key))
+
+        m.post('http://mockurl.com/tokens', status_code=401)
+        self.redis.delete(manager._shared_key, manager._lease_key)
+        manager = self.manager()
+        self.assertIsNone(manager.token)
+        self.assertEqual(manager.stats()['failures'], 1)
+
+    def test_get_admin_token(self):
+        for tenant in ('', 'other'):
+            self.addCleanup(admin_token._shared.pop, ('memo', tenant), None)
+        manager = get_admin_token('memo', '', '')
+        self.managers.append(manager)
+        self.assertIsNone(manager.token)
+        # One manager, and refresher thread, per URL and admin user
+        self.assertIs(get_admin_token('memo', '', ''), manager)
+        other = get_admin_token('memo', 'other', '')
+        self.managers.append(other)
+        self.assertIsNot(other, manager)
+
+        # A caller sharing over Redis is warned it got an in-process one
+        with mock.patch.object(admin_token.LOG, 'warning') as warning:
+            self.assertIs(get_admin_token('memo', '', '',
+                redis_client=self.redis), manager)
+        self.assertTrue(warning.called)
+
+    def test_get_admin_token_race(self):
+        kept = mock.Mock()
+        self.addCleanup(admin_token._shared.pop, ('url', 'race'), None)
+
+        def build(*args, **kwargs):
+            # Logged in without holding the lock of the other callers
+            self.assertFalse(admin_token._shared_lock.locked())
+            # ... while another caller got its manager in first
+            admin_token._shared[('url', 'race')] = kept
+            return mock.Mock()
+
+        with mock.patch.object(admin_token, 'AdminTokenManager',
+                side_effect=build):
+            self.assertIs(get_admin_token('url', 'race', kept._passwd,
+                redis_client=kept._redis_client), kept)
+
+    def test_released(self):
+        manager = AdminTokenManager('http://mockurl.com', 'admin', 'passwd')
+        thread = manager._thread
+        self.assertTrue(thread.is_alive())
+        # The refresher thread does not keep the manager alive
+        del manager
+        gc.collect()
+        thread.join(5)
+        self.assertFalse(thread.is_alive())
@@ -0,0 +1,361 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import asyncio
+import json
+import time
+import httpx
+import mock
+from stealth import conf
+from stealth.common import context
+from stealth.impl_rax import auth_token_cache
+from stealth.impl_rax import token_lifetime
+from stealth.impl_rax.token_validation import get_auth_redis_client
+from stealth.impl_rax.aio import auth_app
+from stealth.impl_rax.aio import auth_middleware
+from stealth.impl_rax.aio import token_validation
+from stealth.impl_rax.aio.keystone_client import AsyncKeystoneClient
+from stealth.impl_rax.aio.auth_token_cache import _send_data_to_cache, \
+    _retrieve_data_from_cache, _retrieve_tenant_data_from_cache
+import stealth.util.log as logging
+
+
+class FakeAdminToken(object):
+    token = 'the-admin-token'
+    expires_ms = 4912668560236
+
+
+class FakeKeystone(object):
+
+    """Keystone answering the impersonation of every tenant."""
+
+    def __init__(self, impersonation_status=200):
+        self.calls = []
+        self.impersonation_status = impersonation_status
+
+    async def handler(self, request):
+        self.calls.append(request.url.path)
+        if request.url.path.endswith('/users'):
+            return httpx.Response(200, json={'users': [{'id': 'user-id'}]})
+        if request.url.path.endswith('/admins'):
+            return httpx.Response(200,
+                json={'users': [{'username': 'user-name'}]})
+        # Let the concurrent impersonations pile up
+        await asyncio.sleep(0.05)
+        return httpx.Response(self.impersonation_status, json={'access': {
+            'token': {'id': 'the-token',
+                'expires': '2125-09-04T14:09:20.236Z'}}})
+
+    def client(self):
+        return AsyncKeystoneClient(retries=0,
+            transport=httpx.MockTransport(self.handler))
+
+
+async def call(app, headers):
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b'', 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    await app({'type': 'http', 'method': 'GET', 'path': '/',
+        'headers': [(name.encode(), value.encode())
+            for name, value in headers.items()]}, receive, send)
+    return messages[0]['status'], dict(messages[0]['headers'])
+
+
+class TestAio(TestCase):
+
+    def setUp(self):
+        super(TestAio, self).setUp()
+        if auth_token_cache._tokens is not None:
+            auth_token_cache._tokens.clear()
+        auth_token_cache._usernames.clear()
+        auth_token_cache._failures.clear()
+        self.redis = get_auth_redis_client()
+        for tenant in ('tenant-aio', 'tenant-fail'):
+            self.redis.delete(auth_token_cache._tenant_index_key(tenant),
+                auth_token_cache._username_key(tenant),
+                auth_token_cache._blacklist_key(tenant))
+        self.addCleanup(auth_token_cache._failures.clear)
+
+    def run_async(self, coroutine_function):
+        async def main():
+            redis_client = token_validation.get_auth_redis_client()
+            try:
+                return await coroutine_function(redis_client)
+            finally:
+                await redis_client.aclose()
+        return asyncio.run(main())
+
+    def test_cache(self):
+        data = {'token': 'the-token', 'tenant': 'tenant-aio',
+            'expires': '2125-09-04T14:09:20.236Z',
+            'expires_ms': 4912668560236,
+            'issued_ms': int(time.time() * 1000)}
+
+        async def scenario(redis_client):
+            retval, cache_key = await _send_data_to_cache(redis_client,
+                data)
+            self.assertTrue(retval)
+            # Cached for [auth] max_cache_life at most
+            self.assertLessEqual(await redis_client.pttl(cache_key),
+                conf.auth.max_cache_life * 1000)
+            data['expires_ms'] = token_lifetime.cache_expires_ms(data)
+            auth_token_cache._tokens.clear()
+            self.assertEqual(await _retrieve_data_from_cache(redis_client,
+                cache_key), data)
+            self.assertEqual(await _retrieve_tenant_data_from_cache(
+                redis_client, 'tenant-aio'), (cache_key, data))
+            self.assertIsNone(await _retrieve_data_from_cache(redis_client,
+                'missing-key'))
+            return cache_key
+
+        cache_key = self.run_async(scenario)
+        # Records are shared with the synchronous implementation
+        auth_token_cache._tokens.clear()
+        self.assertEqual(auth_token_cache._retrieve_data_from_cache(
+            self.redis, '', 'tenant-aio', cache_key), data)
+        self.redis.delete(cache_key)
+
+    def test_migration_race(self):
+        old = json.dumps({'token': 'the-token', 'tenant': 'tenant-aio',
+            'expires': '2125-09-04T14:09:20.236Z'})
+        newer = json.dumps({'token': 'newer-token',
+            'tenant': 'tenant-aio', 'expires': '2125-09-04T14:09:20.236Z',
+            'expires_ms': 4912668560236}).encode('utf-8')
+
+        async def scenario(redis_client):
+            await redis_client.set('aio-old-key', old)
+            get = redis_client.get
+
+            async def renewing_get(key):
+                # A renewal stores a newer record right after the read
+                value = await get(key)
+                await redis_client.set(key, newer)
+                return value
+
+            with mock.patch.object(redis_client, 'get', renewing_get):
+                data = await _retrieve_data_from_cache(redis_client,
+                    'aio-old-key')
+            self.assertEqual(data['token'], 'the-token')
+            try:
+                return await redis_client.get('aio-old-key')
+            finally:
+                await redis_client.delete('aio-old-key')
+
+        # The migration leaves the newer record alone
+        self.assertEqual(self.run_async(scenario), newer)
+
+    def test_validate_client_impersonation(self):
+        keystone = FakeKeystone()
+
+        async def scenario(redis_client):
+            client = keystone.client()
+            results = await asyncio.gather(*[
+                token_validation.validate_client_impersonation(redis_client,
+                    'http://mockurl', 'tenant-aio', FakeAdminToken(),
+                    client=client)
+                for _ in range(10)])
+            await client.aclose()
+            return results
+
+        results = self.run_async(scenario)
+        # Concurrent impersonations are coalesced
+        self.assertEqual(
+            keystone.calls.count('/RAX-AUTH/impersonation-tokens'), 1)
+        valid, token, cache_key = results[0]
+        self.assertTrue(valid)
+        self.assertEqual(token['token'], 'the-token')
+        self.assertEqual(results, [results[0]] * 10)
+
+        async def scenario(redis_client):
+            valid, token = await token_validation.validate_client_token(
+                redis_client, 'http://mockurl', 'tenant-aio', cache_key)
+            self.assertTrue(valid)
+            self.assertEqual(token, 'the-token')
+            return await token_validation.validate_tenant_token(redis_client,
+                'http://mockurl', 'tenant-aio')
+
+        self.assertEqual(self.run_async(scenario), results[0])
+        self.redis.delete(cache_key)
+
+        keystone = FakeKeystone(impersonation_status=404)
+
+        async def scenario(redis_client):
+            client = keystone.client()
+            try:
+                return await token_validation.validate_client_impersonation(
+                    redis_client, 'http://mockurl', 'tenant-fail',
+                    FakeAdminToken(), client=client)
+            finally:
+                await client.aclose()
+
+        self.assertEqual(self.run_async(scenario), (False, None, None))
+
+        # The rejected tenant is then refused without calling Keystone
+        calls = len(keystone.calls)
+        auth_token_cache._failures.clear()
+        self.assertEqual(self.run_async(scenario), (False, None, None))
+        self.assertEqual(len(keystone.calls), calls)
+        self.assertEqual(self.redis.get(
+            auth_token_cache._blacklist_key('tenant-fail')), b'rejected')
+
+    def test_impersonation_leader_cancelled(self):
+        keystone = FakeKeystone()
+
+        async def scenario(redis_client):
+            client = keystone.client()
+            leader = asyncio.ensure_future(
+                token_validation.validate_client_impersonation(redis_client,
+                    'http://mockurl', 'tenant-aio', FakeAdminToken(),
+                    client=client))
+            await asyncio.sleep(0)
+            follower = asyncio.ensure_future(
+                token_validation.validate_client_impersonation(redis_client,
+                    'http://mockurl', 'tenant-aio', FakeAdminToken(),
+                    client=client))
+            await asyncio.sleep(0.01)
+            leader.cancel()
+            try:
+                return await follower
+            finally:
+                await client.aclose()
+
+        valid, token, cache_key = self.run_async(scenario)
+        # The follower still gets the result of the shared call
+        self.assertTrue(valid)
+        self.assertEqual(token['token'], 'the-token')
+        self.assertEqual(
+            keystone.calls.count('/RAX-AUTH/impersonation-tokens'), 1)
+        self.assertEqual(token_validation._flights, {})
+        self.redis.delete(cache_key)
+
+    def test_refresh_ahead_bounded(self):
+        refresher = mock.Mock()
+        refresher.is_due.return_value = True
+        token_data = {'tenant': 'tenant-aio'}
+
+        async def scenario(redis_client):
+            with mock.patch.object(token_validation.refresh_ahead,
+                    'get_refresher', return_value=refresher), \
+                    mock.patch.object(conf.auth, 'refresh_max_pending', 1), \
+                    mock.patch.object(token_validation, '_renew',
+                        mock.Mock(return_value=asyncio.sleep(0))):
+                token_validation._refresh_ahead(redis_client,
+                    'http://mockurl', 'key-1', token_data,
+                    FakeAdminToken(), None)
+                token_validation._refresh_ahead(redis_client,
+                    'http://mockurl', 'key-2', token_data,
+                    FakeAdminToken(), None)
+                self.assertEqual(list(token_validation._renewals),
+                    ['key-1'])
+                await token_validation._renewals.pop('key-1')
+
+        self.run_async(scenario)
+        refresher.skip.assert_called_once_with()
+
+    def test_middleware(self):
+        keystone = FakeKeystone()
+        seen = []
+        request_ids = []
+
+        async def downstream(scope, receive, send):
+            seen.append(scope)
+            request_ids.append(
+                logging.getLogger(__name__).process('', {})[1]['extra'])
+            await send({'type': 'http.response.start', 'status': 200,
+                'headers': []})
+            await send({'type': 'http.response.body', 'body': b''})
+
+        self.addCleanup(setattr, conf.auth, 'auth_url', conf.auth.auth_url)
+        conf.auth.auth_url = 'http://mockurl'
+
+        async def scenario(redis_client):
+            client = keystone.client()
+            with mock.patch.object(auth_middleware, 'get_admin_token',
+                    return_value=FakeAdminToken()):
+                middleware = auth_middleware.wrap(downstream, redis_client,
+                    client=client)
+            responses = [await call(middleware, {})]
+            responses.append(await call(middleware,
+                {'X-Project-ID': 'tenant-aio'}))
+            cache_key = responses[-1][1][b'http_x_auth_token'].decode()
+            responses.append(await call(middleware,
+                {'X-Project-ID': 'tenant-aio', 'X-Auth-Token': cache_key}))
+            await client.aclose()
+            return responses, cache_key
+
+        responses, cache_key = self.run_async(scenario)
+        self.assertEqual(responses[0][0], 412)
+        self.assertEqual(responses[1][0], 200)
+        self.assertIn(b'transaction-id', responses[2][1])
+        self.assertEqual(seen[1]['X-AUTH-TOKEN'], 'the-token')
+        self.assertNotIn(b'x-auth-token', dict(seen[1]['headers']))
+        self.assertEqual(request_ids[1]['request_id'],
+            responses[2][1][b'transaction-id'].decode())
+        self.assertIsNone(context.current.get())
+        self.redis.delete(cache_key)
+
+    def test_app(self):
+        keystone = FakeKeystone()
+
+        async def scenario(redis_client):
+            client = keystone.client()
+            with mock.patch.object(auth_app, 'get_admin_token',
+                    return_value=FakeAdminToken()):
+                endpoint = auth_app.app(redis_client,
+                    auth_url='http://mockurl', client=client)
+            responses = [await call(endpoint, {})]
+            responses.append(await call(endpoint,
+                {'X-Project-ID': 'tenant-aio'}))
+            cache_key = responses[-1][1][b'x-auth-token'].decode()
+            responses.append(await call(endpoint,
+                {'X-Project-ID': 'tenant-aio', 'X-Auth-Token': cache_key}))
+            await client.aclose()
+            return responses, cache_key
+
+        responses, cache_key = self.run_async(scenario)
+        self.assertEqual([status for status, headers in responses],
+            [412, 204, 204])
+        self.redis.delete(cache_key)
+
+    def test_keystone_client(self):
+        attempts = []
+
+        def handler(request):
+            attempts.append(1)
+            if len(attempts) == 1:
+                raise httpx.ConnectError('mock exception')
+            if len(attempts) == 2:
+                return httpx.Response(503)
+            return httpx.Response(200, json={})
+
+        async def scenario():
+            client = AsyncKeystoneClient(retries=2, backoff_factor=0.001,
+                transport=httpx.MockTransport(handler))
+            res = await client.post('http://mockurl/tokens',
+                endpoint='tokens')
+            await client.aclose()
+            return res, client.stats()
+
+        res, stats = asyncio.run(scenario())
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(stats['tokens']['count'], 3)
+        self.assertEqual(stats['tokens']['errors'], 2)
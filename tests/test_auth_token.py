@@ -16,6 +16,8 @@
 
 from unittest import TestCase
 from stealth.impl_rax.auth_token import AdminToken, UserToken
+from stealth.impl_rax import auth_token_cache
+from stealth.impl_rax.auth_token_cache import _invalidate_username_cache
 # Mock requests
 import requests
 import requests_mock
@@ -23,6 +25,10 @@ import requests_mock
 
 class TestAuthToken(TestCase):
 
+    def setUp(self):
+        super(TestAuthToken, self).setUp()
+        self.addCleanup(auth_token_cache._failures.clear)
+
     @requests_mock.mock()
     def test_admin_token(self, m):
         token = AdminToken(url='http://mockurl', tenant=None,
@@ -54,10 +60,23 @@ class TestAuthToken(TestCase):
         self.assertEqual(admintoken.token_data['expires'],
             '2125-09-04T14:09:20.236Z')
 
+        m.post('http://mockurl.com/tokens',
+            exc=requests.exceptions.ConnectionError)
+        admintoken = AdminToken(url='http://mockurl.com', tenant='tenant-id',
+            passwd='passwd')
+        self.assertIsNone(admintoken.token_data)
+
+        m.post('http://mockurl.com/tokens', text='\
+            {"access": {"token": {"id": "the-token", \
+            "expires": "2125-09-04T14:09:20.236Z"}}}')
+        admintoken = AdminToken(url='http://mockurl.com', tenant='tenant-id',
+            passwd='passwd')
+
         m.get('http://mockurl.com/tenants/tenant-id/users', status_code=404)
         usertoken = UserToken(url='http://mockurl.com', tenant='tenant-id',
             admintoken=admintoken)
         self.assertIsNone(usertoken.token_data)
+        self.assertEqual(usertoken._failure, 'no_users')
 
         m.get('http://mockurl.com/tenants/tenant-id/users', text='\
             {"users": [{"id": "the-user-id"}]}')
@@ -72,3 +91,79 @@ class TestAuthToken(TestCase):
             tenant='tenant-id',
             admintoken=admintoken, token=None)
         self.assertIsNone(usertoken.token_data)
+        self.assertEqual(usertoken._failure, 'no_admin')
+        self.assertEqual(auth_token_cache._failures.get('tenant-id'),
+            'no_admin')
+
+    @requests_mock.mock()
+    def test_user_token_failure_class(self, m):
+        _invalidate_username_cache(None, 'tenant-id')
+        admintoken = AdminToken(url='http://mockurl.com', tenant='tenant-id',
+            passwd='passwd', token='thetoken')
+        m.post('http://mockurl.com/tokens', text='\
+            {"access": {"token": {"id": "the-token", \
+            "expires": "2125-09-04T14:09:20.236Z"}}}')
+        m.get('http://mockurl.com/tenants/tenant-id/users', text='\
+            {"users": []}')
+        usertoken = UserToken(url='http://mockurl.com', tenant='tenant-id',
+            admintoken=admintoken)
+        self.assertEqual(usertoken._failure, 'no_users')
+
+        m.get('http://mockurl.com/tenants/tenant-id/users', text='\
+            {"users": [{"id": "the-user-id"}]}')
+        m.get('http://mockurl.com/users/the-user-id/RAX-AUTH/admins', text='\
+            {"users": [{"username": "the-user-name"}]}')
+        m.post('http://mockurl.com/RAX-AUTH/impersonation-tokens',
+            status_code=403)
+        usertoken = UserToken(url='http://mockurl.com', tenant='tenant-id',
+            admintoken=admintoken)
+        self.assertEqual(usertoken._failure, 'rejected')
+
+        # Neither the admin token's rejection nor outages are the tenant's
+        for status_code in (401, 500, 503):
+            auth_token_cache._failures.clear()
+            m.post('http://mockurl.com/RAX-AUTH/impersonation-tokens',
+                status_code=status_code)
+            usertoken = UserToken(url='http://mockurl.com',
+                tenant='tenant-id', admintoken=admintoken)
+            self.assertIsNone(usertoken.token_data)
+            self.assertIsNone(usertoken._failure)
+            self.assertIsNone(auth_token_cache._failures.get('tenant-id'))
+        _invalidate_username_cache(None, 'tenant-id')
+
+    @requests_mock.mock()
+    def test_user_token_cached_username(self, m):
+        _invalidate_username_cache(None, 'tenant-cached')
+        admintoken = AdminToken(url='http://mockurl.com', tenant='tenant-id',
+            passwd='passwd', token='thetoken')
+        m.post('http://mockurl.com/tokens', text='\
+            {"access": {"token": {"id": "the-token", \
+            "expires": "2125-09-04T14:09:20.236Z"}}}')
+        m.get('http://mockurl.com/tenants/tenant-cached/users', text='\
+            {"users": [{"id": "the-user-id"}]}')
+        m.get('http://mockurl.com/users/the-user-id/RAX-AUTH/admins', text='\
+            {"users": [{"username": "the-user-name"}]}')
+        m.post('http://mockurl.com/RAX-AUTH/impersonation-tokens', text='\
+            {"access": {"token": {"id": "the-token",\
+             "expires": "2125-09-04T14:09:20.236Z"}}}')
+        usertoken = UserToken(url='http://mockurl.com', tenant='tenant-cached',
+            admintoken=admintoken)
+        self.assertEqual(usertoken.token_data['token'], 'the-token')
+
+        # A renewal only creates the impersonation token
+        calls = m.call_count
+        usertoken = UserToken(url='http://mockurl.com', tenant='tenant-cached',
+            admintoken=admintoken)
+        self.assertEqual(usertoken.token_data['token'], 'the-token')
+        self.assertEqual(m.call_count, calls + 1)
+        self.assertTrue(m.last_request.url.endswith('impersonation-tokens'))
+
+        # A stale username is resolved again
+        m.post('http://mockurl.com/RAX-AUTH/impersonation-tokens', [
+            {'status_code': 404},
+            {'text': '{"access": {"token": {"id": "the-new-token",\
+             "expires": "2125-09-04T14:09:20.236Z"}}}'}])
+        usertoken = UserToken(url='http://mockurl.com', tenant='tenant-cached',
+            admintoken=admintoken)
+        self.assertEqual(usertoken.token_data['token'], 'the-new-token')
+        _invalidate_username_cache(None, 'tenant-cached')
@@ -15,12 +15,19 @@
 # limitations under the License.
 
 from unittest import TestCase
-from stealth.impl_rax.auth_token import TokenBase, AdminToken
+from stealth.impl_rax.auth_token import TokenBase, AdminToken, UserToken
 from stealth.impl_rax.auth_token_cache import \
-    _send_data_to_cache, _retrieve_data_from_cache
+    _send_data_to_cache, _retrieve_data_from_cache, \
+    _retrieve_tenant_data_from_cache, _tenant_index_key, \
+    _send_username_to_cache, _retrieve_username_from_cache, \
+    _invalidate_username_cache, _username_key, local_cache_stats, \
+    _retrieve_batch_from_cache, round_trip_stats
 from stealth.impl_rax.token_validation import get_auth_redis_client
+from stealth.impl_rax import auth_token_cache
 from stealth import conf
 import mock
+import msgpack
+import simplejson as json
 # Mock requests
 import requests
 import requests_mock
@@ -32,6 +39,11 @@ import redis
 redis = fakeredis
 
 
+def clear_local_cache():
+    if auth_token_cache._tokens is not None:
+        auth_token_cache._tokens.clear()
+
+
 def side_effect_exception(*args):
     raise Exception('mock exception')
 
@@ -53,6 +65,12 @@ def side_effect_redis_getdata_expired(*args):
 
 class TestAuthTokenCache(TestCase):
 
+    def setUp(self):
+        super(TestAuthTokenCache, self).setUp()
+        clear_local_cache()
+        # Records read through mocked gets are migrated under this key
+        get_auth_redis_client().delete('cache-key')
+
     def test_token_cache(self):
         # get_auth_redis_client()
         origval = conf.auth_redis.ssl_enable
@@ -80,7 +98,7 @@ class TestAuthTokenCache(TestCase):
         self.assertIsNotNone(key)
         self.assertIsInstance(key, str)
 
-        with mock.patch.object(test_redis, 'set',
+        with mock.patch.object(test_redis, 'pipeline',
                 side_effect=side_effect_exception):
             retval, key = _send_data_to_cache(test_redis, '', token_data)
             self.assertFalse(retval)
@@ -94,11 +112,13 @@ class TestAuthTokenCache(TestCase):
             tenant='tenant-id', cache_key='cache-key')
         self.assertIsNone(retval)
 
+        clear_local_cache()
         with mock.patch.object(test_redis, 'get',
                 side_effect=side_effect_exception):
             self.assertIsNone(_retrieve_data_from_cache(test_redis,
                 url='http://mockurl', tenant='tenant-id',
                 cache_key='cache-key'))
+        clear_local_cache()
         with mock.patch.object(test_redis, 'get',
                 side_effect=side_effect_redis_getdata):
             retval = _retrieve_data_from_cache(test_redis,
@@ -108,8 +128,202 @@ class TestAuthTokenCache(TestCase):
             self.assertEqual(retval['tenant'], 'tenant-id')
             self.assertEqual(retval['token'], 'the-token')
             self.assertEqual(retval['expires'], '2125-09-04T14:09:20.236Z')
+        clear_local_cache()
         with mock.patch.object(test_redis, 'get',
                 side_effect=side_effect_redis_getdata_wrong):
             self.assertIsNone(_retrieve_data_from_cache(test_redis,
                 url='http://mockurl', tenant='tenant-id',
                 cache_key='cache-key'))
+
+    @requests_mock.mock()
+    def test_retrieve_tenant_data_from_cache(self, m):
+        test_redis = get_auth_redis_client()
+        self.assertEqual(_retrieve_tenant_data_from_cache(test_redis,
+            url='http://mockurl', tenant=None), (None, None))
+
+        m.get('http://mockurl/tenants/tenant-index/users', text='\
+            {"users": [{"id": "the-user-id"}]}')
+        m.get('http://mockurl/users/the-user-id/RAX-AUTH/admins', text='\
+            {"users": [{"username": "the-user-name"}]}')
+        m.post('http://mockurl/RAX-AUTH/impersonation-tokens', text='\
+            {"access": {"token": {"id": "the-token",\
+             "expires": "2125-09-04T14:09:20.236Z"}}}')
+        admintoken = AdminToken(url='http://mockurl', tenant='tenant-id',
+            passwd='passwd', token='thetoken')
+        usertoken = UserToken(url='http://mockurl', tenant='tenant-index',
+            admintoken=admintoken)
+        retval, key = _send_data_to_cache(test_redis, '', usertoken)
+        self.assertTrue(retval)
+        self.assertEqual(test_redis.get(
+            _tenant_index_key('tenant-index')).decode(), key)
+
+        cache_key, data = _retrieve_tenant_data_from_cache(test_redis,
+            url='http://mockurl', tenant='tenant-index')
+        self.assertEqual(cache_key, key)
+        self.assertEqual(data['token'], 'the-token')
+        self.assertEqual(data['tenant'], 'tenant-index')
+
+        # The index must not hand out another tenant's token
+        test_redis.set(_tenant_index_key('tenant-other'), key)
+        self.assertEqual(_retrieve_tenant_data_from_cache(test_redis,
+            url='http://mockurl', tenant='tenant-other'), (None, None))
+
+        clear_local_cache()
+        with mock.patch.object(test_redis, 'get',
+                side_effect=side_effect_exception):
+            self.assertEqual(_retrieve_tenant_data_from_cache(test_redis,
+                url='http://mockurl', tenant='tenant-index'), (None, None))
+
+    def test_username_cache(self):
+        test_redis = get_auth_redis_client()
+        _invalidate_username_cache(test_redis, 'tenant-name')
+        self.assertIsNone(_retrieve_username_from_cache(test_redis,
+            'tenant-name'))
+
+        self.assertTrue(_send_username_to_cache(test_redis, 'tenant-name',
+            'the-user-name'))
+        self.assertEqual(_retrieve_username_from_cache(None, 'tenant-name'),
+            'the-user-name')
+        self.assertGreater(test_redis.ttl(_username_key('tenant-name')), 0)
+
+        # Another process only finds it in redis
+        _invalidate_username_cache(None, 'tenant-name')
+        self.assertIsNone(_retrieve_username_from_cache(None, 'tenant-name'))
+        self.assertEqual(_retrieve_username_from_cache(test_redis,
+            'tenant-name'), 'the-user-name')
+
+        _invalidate_username_cache(test_redis, 'tenant-name')
+        self.assertIsNone(_retrieve_username_from_cache(test_redis,
+            'tenant-name'))
+
+        with mock.patch.object(test_redis, 'set',
+                side_effect=side_effect_exception):
+            self.assertFalse(_send_username_to_cache(test_redis,
+                'tenant-name', 'the-user-name'))
+        _invalidate_username_cache(None, 'tenant-name')
+        clear_local_cache()
+        with mock.patch.object(test_redis, 'get',
+                side_effect=side_effect_exception):
+            self.assertIsNone(_retrieve_username_from_cache(test_redis,
+                'tenant-name'))
+        with mock.patch.object(test_redis, 'delete',
+                side_effect=side_effect_exception):
+            _invalidate_username_cache(test_redis, 'tenant-name')
+
+    def test_local_cache(self):
+        test_redis = get_auth_redis_client()
+        with mock.patch.object(test_redis, 'get',
+                side_effect=side_effect_redis_getdata):
+            retval = _retrieve_data_from_cache(test_redis,
+                url='http://mockurl',
+                tenant='tenant-id', cache_key='cache-key')
+            self.assertEqual(retval['expires_ms'], 4912668560236)
+
+        # Hits do not go to redis
+        stats = local_cache_stats()
+        with mock.patch.object(test_redis, 'get',
+                side_effect=side_effect_exception):
+            self.assertEqual(_retrieve_data_from_cache(test_redis,
+                url='http://mockurl', tenant='tenant-id',
+                cache_key='cache-key'), retval)
+        self.assertEqual(local_cache_stats()['hits'], stats['hits'] + 1)
+        self.assertEqual(local_cache_stats()['entries'], 1)
+
+        # Expired records are not kept
+        clear_local_cache()
+        with mock.patch.object(test_redis, 'get',
+                side_effect=side_effect_redis_getdata_expired):
+            self.assertIsNotNone(_retrieve_data_from_cache(test_redis,
+                url='http://mockurl', tenant='tenant-id',
+                cache_key='cache-key'))
+        with mock.patch.object(test_redis, 'get', return_value=None):
+            self.assertIsNone(_retrieve_data_from_cache(test_redis,
+                url='http://mockurl', tenant='tenant-id',
+                cache_key='cache-key'))
+
+    def test_record_format(self):
+        data = {'token': 'the-token', 'tenant': 'tenant-id',
+            'expires': '2125-09-04T14:09:20.236Z',
+            'expires_ms': 4912668560236}
+        origval = conf.auth_redis.record_format
+        try:
+            conf.auth_redis.record_format = 'json'
+            record = auth_token_cache._encode_record(data)
+            self.assertEqual(auth_token_cache._decode_record(record), data)
+            self.assertEqual(auth_token_cache._decode_record(
+                record.encode()), data)
+            self.assertTrue(auth_token_cache._is_current_record(record))
+
+            conf.auth_redis.record_format = 'msgpack'
+            record = auth_token_cache._encode_record(data)
+            # msgpack records are never rewritten back to json
+            with mock.patch.object(conf.auth_redis, 'record_format',
+                    'json'):
+                self.assertTrue(auth_token_cache._is_current_record(record))
+            self.assertIsInstance(record, bytes)
+            self.assertLess(len(record), len(json.dumps(data)))
+            self.assertEqual(auth_token_cache._decode_record(record), data)
+            self.assertTrue(auth_token_cache._is_current_record(record))
+            self.assertFalse(auth_token_cache._is_current_record(
+                json.dumps(data)))
+            self.assertEqual(auth_token_cache._encode_record(None), 'null')
+
+            with self.assertRaises(ValueError):
+                auth_token_cache._decode_record(msgpack.packb({'v': 99}))
+
+            # json records are read, then rewritten as msgpack
+            test_redis = get_auth_redis_client()
+            test_redis.set('json-cache-key', json.dumps(data))
+            self.assertEqual(_retrieve_data_from_cache(test_redis,
+                url='http://mockurl', tenant='tenant-id',
+                cache_key='json-cache-key'), data)
+            self.assertEqual(test_redis.get('json-cache-key'), record)
+            test_redis.delete('json-cache-key')
+        finally:
+            conf.auth_redis.record_format = origval
+
+    @requests_mock.mock()
+    def test_round_trips(self, m):
+        test_redis = get_auth_redis_client()
+        m.post('http://mockurl.com/tokens', text='{"access": \
+            {"token": {"id": "the-token", "expires": \
+            "2125-09-04T14:09:20.236Z"}}}')
+        token_data = AdminToken(url='http://mockurl.com', tenant='tenant-rt',
+            passwd='passwd')
+
+        # The record, its index and the expiry go out in one round-trip
+        stats = round_trip_stats()
+        retval, key = _send_data_to_cache(test_redis, '', token_data)
+        self.assertTrue(retval)
+        self.assertEqual(round_trip_stats()['store'],
+            stats.get('store', 0) + 1)
+        self.assertGreater(test_redis.pttl(key), 0)
+        self.assertGreater(test_redis.pttl(_tenant_index_key('tenant-rt')),
+            0)
+
+        # Local hits are not fetched, the misses share one MGET
+        clear_local_cache()
+        test_redis.set('batch-key', test_redis.get(key))
+        self.assertIsNotNone(_retrieve_data_from_cache(test_redis,
+            url='http://mockurl', tenant='tenant-rt', cache_key=key))
+        stats = round_trip_stats()
+        retval = _retrieve_batch_from_cache(test_redis, 'http://mockurl',
+            [key, 'batch-key', 'missing-key', None])
+        self.assertEqual(retval[0], retval[1])
+        self.assertEqual(retval[1]['tenant'], 'tenant-rt')
+        self.assertEqual(retval[2:], [None, None])
+        self.assertEqual(round_trip_stats()['batch_retrieve'],
+            stats.get('batch_retrieve', 0) + 1)
+
+        # Every key is now local
+        retval = _retrieve_batch_from_cache(test_redis, 'http://mockurl',
+            [key, 'batch-key'])
+        self.assertEqual(round_trip_stats()['batch_retrieve'],
+            stats.get('batch_retrieve', 0) + 1)
+
+        clear_local_cache()
+        with mock.patch.object(test_redis, 'mget',
+                side_effect=side_effect_exception):
+            self.assertEqual(_retrieve_batch_from_cache(test_redis,
+                'http://mockurl', ['batch-key']), [None])
+        test_redis.delete('batch-key', key, _tenant_index_key('tenant-rt'))
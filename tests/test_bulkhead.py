@@ -0,0 +1,184 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import asyncio
+import threading
+import time
+import mock
+from stealth import conf
+from stealth.impl_rax import auth_app
+from stealth.impl_rax import auth_token_cache
+from stealth.impl_rax import bulkhead
+from stealth.impl_rax.bulkhead import Bulkhead, BulkheadFullError
+from stealth.impl_rax.token_validation import get_auth_redis_client, \
+    validate_client_impersonation
+from stealth.impl_rax.aio import auth_app as aio_auth_app
+from stealth.impl_rax.aio import bulkhead as aio_bulkhead
+from stealth.impl_rax.aio import token_validation as aio_validation
+from stealth.impl_rax.aio.bulkhead import AsyncBulkhead
+from tests.test_aio import FakeAdminToken, FakeKeystone, call
+
+
+class TestBulkhead(TestCase):
+
+    def setUp(self):
+        super(TestBulkhead, self).setUp()
+        auth_token_cache._usernames.clear()
+        auth_token_cache._failures.clear()
+        self.redis = get_auth_redis_client()
+        self.redis.delete(auth_token_cache._username_key('tenant-shed'),
+            auth_token_cache._blacklist_key('tenant-shed'),
+            auth_token_cache._tenant_index_key('tenant-shed'))
+
+    def test_priority(self):
+        gate = Bulkhead(max_calls=1, max_queue=2, wait=5.0)
+        order = []
+
+        def call(priority):
+            with gate.slot(priority):
+                order.append(priority)
+
+        gate.acquire()
+        login = threading.Thread(target=call, args=(bulkhead.LOGIN,))
+        login.start()
+        while gate.stats()['waiting'] < 1:
+            time.sleep(0.01)
+        renewal = threading.Thread(target=call, args=(bulkhead.RENEWAL,))
+        renewal.start()
+        while gate.stats()['waiting'] < 2:
+            time.sleep(0.01)
+
+        # Renewals are let through before the logins queued earlier
+        gate.release()
+        login.join()
+        renewal.join()
+        self.assertEqual(order, [bulkhead.RENEWAL, bulkhead.LOGIN])
+        stats = gate.stats()
+        self.assertEqual((stats['active'], stats['waiting']), (0, 0))
+        self.assertEqual((stats['admitted'], stats['queued']), (3, 2))
+
+    def test_shed(self):
+        gate = Bulkhead(max_calls=1, max_queue=1, wait=0.2, retry_after=7)
+        gate.acquire()
+
+        # Waits for a slot, then gives up
+        self.assertRaises(BulkheadFullError, gate.acquire)
+
+        # Shed at once while the queue is full
+        waiter = threading.Thread(target=self.assertRaises,
+            args=(BulkheadFullError, gate.acquire))
+        waiter.start()
+        while gate.stats()['waiting'] < 1:
+            time.sleep(0.001)
+        try:
+            gate.acquire(bulkhead.RENEWAL)
+        except BulkheadFullError as ex:
+            self.assertEqual(ex.retry_after, 7)
+        else:
+            self.fail('Not shed')
+        waiter.join()
+
+        stats = gate.stats()
+        self.assertEqual((stats['shed'], stats['timed_out']), (1, 2))
+
+    def test_async_bulkhead(self):
+        gate = AsyncBulkhead(max_calls=1, max_queue=2, wait=0.05)
+        order = []
+
+        async def call(priority):
+            async with gate.slot(priority):
+                order.append(priority)
+
+        async def scenario():
+            await gate.acquire()
+            calls = [asyncio.ensure_future(call(bulkhead.LOGIN)),
+                asyncio.ensure_future(call(bulkhead.RENEWAL))]
+            await asyncio.sleep(0)
+            with self.assertRaises(BulkheadFullError):
+                await gate.acquire()
+            gate.release()
+            await asyncio.gather(*calls)
+
+            # Timed out waiting
+            await gate.acquire()
+            with self.assertRaises(BulkheadFullError):
+                await gate.acquire()
+            gate.release()
+
+        asyncio.run(scenario())
+        self.assertEqual(order, [bulkhead.RENEWAL, bulkhead.LOGIN])
+        stats = gate.stats()
+        self.assertEqual((stats['active'], stats['waiting']), (0, 0))
+        self.assertEqual((stats['shed'], stats['timed_out']), (1, 1))
+
+    def test_load_shedding(self):
+        gate = Bulkhead(max_calls=1, max_queue=0, retry_after=3)
+        gate.acquire()
+        self.addCleanup(gate.release)
+        statuses = []
+
+        def start_response(status, headers):
+            statuses.append((status, dict(headers)))
+
+        with mock.patch.object(bulkhead, 'get_bulkhead', return_value=gate):
+            # Keystone is not called
+            self.assertRaises(BulkheadFullError,
+                validate_client_impersonation, self.redis,
+                'http://mockurl', 'tenant-shed', FakeAdminToken())
+
+            with mock.patch.object(auth_app, 'get_admin_token',
+                    return_value=FakeAdminToken()):
+                endpoint = auth_app.app(self.redis,
+                    auth_url='http://mockurl')
+            endpoint({'HTTP_X_PROJECT_ID': 'tenant-shed'}, start_response)
+        self.assertEqual(statuses, [('503 Service Unavailable',
+            {'Content-Length': '0', 'Retry-After': '3'})])
+
+    def test_aio_load_shedding(self):
+        gate = AsyncBulkhead(max_calls=1, max_queue=0, retry_after=3)
+        keystone = FakeKeystone()
+
+        async def scenario():
+            redis_client = aio_validation.get_auth_redis_client()
+            client = keystone.client()
+            with mock.patch.object(aio_auth_app, 'get_admin_token',
+                    return_value=FakeAdminToken()):
+                endpoint = aio_auth_app.app(redis_client,
+                    auth_url='http://mockurl', client=client)
+            await gate.acquire()
+            try:
+                return await call(endpoint, {'X-Project-ID': 'tenant-shed'})
+            finally:
+                gate.release()
+                await client.aclose()
+                await redis_client.aclose()
+
+        with mock.patch.object(aio_bulkhead, 'get_bulkhead',
+                return_value=gate):
+            status, headers = asyncio.run(scenario())
+        self.assertEqual(status, 503)
+        self.assertEqual(headers[b'retry-after'], b'3')
+        self.assertEqual(keystone.calls, [])
+
+    def test_get_bulkhead(self):
+        bulkhead._reset_bulkhead()
+        gate = bulkhead.get_bulkhead()
+        self.assertIs(gate, bulkhead.get_bulkhead())
+        with mock.patch.object(conf.keystone, 'bulkhead', False):
+            self.assertIsNone(bulkhead.get_bulkhead())
+            with bulkhead.slot():
+                pass
@@ -0,0 +1,218 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import os
+import shutil
+import tempfile
+import threading
+import time
+import mock
+import requests_mock
+from stealth import conf
+from stealth.impl_rax import auth_token_cache
+from stealth.impl_rax import cache_backend
+from stealth.impl_rax import token_validation
+from stealth.impl_rax.auth_token import AdminToken
+from stealth.impl_rax.cache_backend import CacheBackend, MemoryBackend, \
+    RedisBackend, SQLiteBackend
+
+
+def clear_local_cache():
+    if auth_token_cache._tokens is not None:
+        auth_token_cache._tokens.clear()
+    auth_token_cache._usernames.clear()
+    auth_token_cache._failures.clear()
+
+
+class BackendTests(object):
+
+    """The contract of CacheBackend, run against each backend"""
+
+    def test_get_set(self):
+        backend = self.backend
+        self.assertIsNone(backend.get('missing'))
+        self.assertTrue(backend.set('key', 'value'))
+        self.assertEqual(backend.get('key'), b'value')
+        self.assertTrue(backend.set('key', b'\x00\xff'))
+        self.assertEqual(backend.get('key'), b'\x00\xff')
+        self.assertEqual(backend.mget(['key', 'missing']),
+            [b'\x00\xff', None])
+        self.assertEqual(backend.delete('key', 'missing'), 1)
+        self.assertIsNone(backend.get('key'))
+
+    def test_expiry(self):
+        backend = self.backend
+        now_ms = int(time.time() * 1000)
+        backend.set('px', 'value', px=50)
+        backend.set('pxat', 'value', pxat=now_ms + 60000)
+        backend.set('ex', 'value', ex=60)
+        backend.set('forever', 'value')
+        self.assertTrue(0 < backend.pttl('px') <= 50)
+        self.assertTrue(59000 < backend.pttl('pxat') <= 60000)
+        self.assertTrue(59000 < backend.pttl('ex') <= 60000)
+        self.assertEqual(backend.pttl('forever'), -1)
+        self.assertEqual(backend.pttl('missing'), -2)
+
+        time.sleep(0.1)
+        self.assertIsNone(backend.get('px'))
+        self.assertEqual(backend.pttl('px'), -2)
+        self.assertEqual(backend.delete('px'), 0)
+
+    def test_add(self):
+        backend = self.backend
+        self.assertTrue(backend.add('lease', 'first', px=50))
+        self.assertFalse(backend.add('lease', 'second', px=50))
+        self.assertIsNone(backend.set('lease', 'second', nx=True))
+        self.assertEqual(backend.get('lease'), b'first')
+
+        # An expired key is free again
+        time.sleep(0.1)
+        self.assertTrue(backend.add('lease', 'second'))
+        self.assertEqual(backend.get('lease'), b'second')
+
+    def test_pipeline(self):
+        backend = self.backend
+        backend.set('stale', 'value')
+        with backend.pipeline(transaction=True) as pipe:
+            pipe.set('record', 'value', px=60000)
+            pipe.delete('stale')
+            pipe.publish('channel', 'record')
+            self.assertEqual(pipe.execute()[:2], [True, 1])
+        self.assertEqual(backend.get('record'), b'value')
+        self.assertIsNone(backend.get('stale'))
+
+        with backend.pipeline(transaction=False) as pipe:
+            pipe.get('record')
+            pipe.pttl('record')
+            value, ttl = pipe.execute()
+        self.assertEqual(value, b'value')
+        self.assertTrue(ttl > 59000)
+
+    def test_watch(self):
+        # Check-and-set, as single_flight releases its leases
+        backend = self.backend
+        backend.set('lease', 'mine')
+        with backend.pipeline() as pipe:
+            pipe.watch('lease')
+            self.assertEqual(pipe.get('lease'), b'mine')
+            pipe.multi()
+            pipe.delete('lease')
+            pipe.execute()
+        self.assertIsNone(backend.get('lease'))
+
+        # The backend is let go of without execute() too
+        with backend.pipeline() as pipe:
+            pipe.watch('lease')
+            self.assertIsNone(pipe.get('lease'))
+        writer = threading.Thread(target=backend.set, args=('lease', 'x'))
+        writer.start()
+        writer.join(5)
+        self.assertEqual(backend.get('lease'), b'x')
+
+    @requests_mock.mock()
+    def test_validate_client_token(self, m):
+        clear_local_cache()
+        self.addCleanup(clear_local_cache)
+        admintoken = AdminToken(url='http://mockurl', tenant='tenant-id',
+            passwd='passwd', token='thetoken')
+        m.get('http://mockurl/tenants/tenant-backend/users', text='\
+            {"users": [{"id": "the-user-id"}]}')
+        m.get('http://mockurl/users/the-user-id/RAX-AUTH/admins', text='\
+            {"users": [{"username": "the-user-name"}]}')
+        m.post('http://mockurl/RAX-AUTH/impersonation-tokens', text='\
+            {"access": {"token": {"id": "the-token",\
+             "expires": "2125-09-04T14:09:20.236Z"}}}')
+
+        retval, token, cache_key = \
+            token_validation.validate_client_impersonation(self.backend,
+                url='http://mockurl', tenant='tenant-backend',
+                admintoken=admintoken)
+        self.assertTrue(retval)
+        self.assertEqual(token['token'], 'the-token')
+
+        # Read back from the backend itself
+        clear_local_cache()
+        retval, token = token_validation.validate_client_token(
+            self.backend, url='http://mockurl', tenant='tenant-backend',
+            cache_key=cache_key)
+        self.assertTrue(retval)
+        self.assertEqual(token, 'the-token')
+        result = token_validation.validate_tenant_token(self.backend,
+            url='http://mockurl', tenant='tenant-backend')
+        self.assertEqual(result[2], cache_key)
+
+
+class TestMemoryBackend(BackendTests, TestCase):
+
+    def setUp(self):
+        super(TestMemoryBackend, self).setUp()
+        self.backend = MemoryBackend()
+
+    def test_purge(self):
+        self.backend.set('expired', 'value', px=1)
+        time.sleep(0.01)
+        with mock.patch.object(cache_backend, 'PURGE_INTERVAL', 2):
+            self.backend.set('key', 'value')
+        self.assertEqual(len(self.backend), 1)
+
+
+class TestSQLiteBackend(BackendTests, TestCase):
+
+    def setUp(self):
+        super(TestSQLiteBackend, self).setUp()
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'cache.db')
+        self.backend = SQLiteBackend(self.path)
+
+    def test_shared(self):
+        # The processes of a node share the file
+        self.backend.set('key', 'value', px=60000)
+        other = SQLiteBackend(self.path)
+        self.assertEqual(other.get('key'), b'value')
+        self.assertFalse(other.add('key', 'other'))
+        self.assertEqual(self.backend.get('key'), b'value')
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.backend._atomic():
+                self.backend.set('key', 'value')
+                raise ValueError()
+        self.assertIsNone(self.backend.get('key'))
+
+
+class TestGetCacheBackend(TestCase):
+
+    def test_get_cache_backend(self):
+        backend = token_validation.get_cache_backend()
+        self.assertIsInstance(backend, RedisBackend)
+        self.assertIsInstance(backend, CacheBackend)
+        self.assertIsNone(token_validation.start_cache_invalidation(
+            MemoryBackend()))
+
+        with mock.patch.object(conf.cache, 'backend', 'memory'):
+            backend = token_validation.get_cache_backend()
+            self.assertIsInstance(backend, MemoryBackend)
+            self.assertIs(backend, token_validation.get_cache_backend())
+
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        with mock.patch.object(conf.cache, 'backend', 'sqlite'), \
+                mock.patch.object(conf.cache, 'sqlite_path',
+                    os.path.join(directory, 'cache.db')):
+            self.assertIsInstance(token_validation.get_cache_backend(),
+                SQLiteBackend)
@@ -0,0 +1,173 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import time
+import mock
+from stealth import conf
+from stealth.impl_rax import auth_token_cache
+from stealth.impl_rax import circuit_breaker
+from stealth.impl_rax.circuit_breaker import CircuitBreaker, \
+    CircuitOpenError
+from stealth.impl_rax.keystone_client import KeystoneClient
+from stealth.impl_rax.token_validation import get_auth_redis_client, \
+    validate_client_token, validate_tenant_token
+from stealth.util import metrics
+# Mock requests
+import requests
+import requests_mock
+
+
+class TestCircuitBreaker(TestCase):
+
+    def test_transitions(self):
+        counts = metrics.REGISTRY.collect()[0]
+        breaker = CircuitBreaker(failure_threshold=3, recovery_timeout=10.0,
+            half_open_calls=1)
+        with mock.patch.object(time, 'time', return_value=1000.0):
+            breaker.failure()
+            breaker.failure()
+            breaker.success()
+            breaker.failure()
+            breaker.failure()
+            self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+            breaker.allow()
+
+            # Opens at the threshold and fails fast
+            breaker.failure()
+            self.assertEqual(breaker.state, circuit_breaker.OPEN)
+            self.assertRaises(CircuitOpenError, breaker.allow)
+
+        with mock.patch.object(time, 'time', return_value=1010.0):
+            # One probe at a time once the recovery timeout is over
+            breaker.allow()
+            self.assertEqual(breaker.state, circuit_breaker.HALF_OPEN)
+            self.assertRaises(CircuitOpenError, breaker.allow)
+
+            # A failed probe opens the circuit again
+            breaker.failure()
+            self.assertEqual(breaker.state, circuit_breaker.OPEN)
+            self.assertRaises(CircuitOpenError, breaker.allow)
+
+        with mock.patch.object(time, 'time', return_value=1020.0):
+            breaker.allow()
+        with mock.patch.object(time, 'time', return_value=1030.0):
+            # A probe that never reported back is given up on
+            breaker.allow()
+            breaker.success()
+            self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+            breaker.allow()
+
+        stats = breaker.stats()
+        self.assertEqual(stats['state'], circuit_breaker.CLOSED)
+        self.assertEqual(stats['rejected'], 3)
+        self.assertEqual(stats['transitions'], {circuit_breaker.OPEN: 2,
+            circuit_breaker.HALF_OPEN: 2, circuit_breaker.CLOSED: 1})
+
+        # ... also counted in the metrics
+        after = metrics.REGISTRY.collect()[0]
+        for sample, increase in (
+                ('stealth_keystone_circuit_rejected_total', 3),
+                ('stealth_keystone_circuit_transitions_total'
+                    '{state="open"}', 2),
+                ('stealth_keystone_circuit_transitions_total'
+                    '{state="half_open"}', 2),
+                ('stealth_keystone_circuit_transitions_total'
+                    '{state="closed"}', 1)):
+            self.assertEqual(after[sample], counts.get(sample, 0) + increase)
+
+    @requests_mock.mock()
+    def test_keystone_client(self, m):
+        breaker = CircuitBreaker(failure_threshold=2, recovery_timeout=60.0)
+        client = KeystoneClient(retries=2, backoff_factor=0.001,
+            breaker=breaker)
+
+        # Client errors are Keystone answering
+        m.post('http://mockurl.com/tokens', status_code=404)
+        self.assertEqual(client.post('http://mockurl.com/tokens').status_code,
+            404)
+        self.assertEqual(breaker.state, circuit_breaker.CLOSED)
+
+        # The retries stop as the circuit opens
+        m.post('http://mockurl.com/tokens',
+            exc=requests.exceptions.ConnectTimeout)
+        self.assertRaises(CircuitOpenError, client.post,
+            'http://mockurl.com/tokens')
+        self.assertEqual(m.call_count, 3)
+
+        # ... and later calls fail fast, as connection errors
+        self.assertRaises(requests.ConnectionError, client.post,
+            'http://mockurl.com/tokens')
+        self.assertEqual(m.call_count, 3)
+        self.assertEqual(breaker.stats()['rejected'], 2)
+
+    def test_serve_stale(self):
+        sample = 'stealth_keystone_circuit_stale_served_total'
+        before = metrics.REGISTRY.collect()[0].get(sample, 0)
+        breaker = CircuitBreaker(failure_threshold=1)
+        now_ms = int(time.time() * 1000)
+        with mock.patch.object(conf.auth, 'stale_while_error', 60):
+            self.assertFalse(breaker.serve_stale(now_ms - 1000))
+            breaker.failure()
+            self.assertTrue(breaker.serve_stale(now_ms - 1000))
+            self.assertFalse(breaker.serve_stale(now_ms - 61000))
+            with mock.patch.object(conf.auth, 'stale_while_error', 0):
+                self.assertFalse(breaker.serve_stale(now_ms - 1000))
+        self.assertEqual(breaker.stats()['stale_served'], 1)
+        self.assertEqual(metrics.REGISTRY.collect()[0][sample], before + 1)
+
+    @mock.patch.object(conf.auth, 'stale_while_error', 60)
+    def test_stale_while_error(self):
+        redis_client = get_auth_redis_client()
+        if auth_token_cache._tokens is not None:
+            auth_token_cache._tokens.clear()
+
+        class ExpiredToken(object):
+            tenant = 'tenant-stale'
+            expires_ms = int(time.time() * 1000) - 1000
+            token_data = {'token': 'the-token', 'tenant': tenant,
+                'expires': '2015-09-04T14:09:20.236Z',
+                'expires_ms': expires_ms, 'issued_ms': expires_ms - 60000}
+
+        # Kept in the cache past its expiry
+        retval, cache_key = auth_token_cache._send_data_to_cache(
+            redis_client, '', ExpiredToken())
+        self.assertTrue(retval)
+        self.addCleanup(redis_client.delete, cache_key,
+            auth_token_cache._tenant_index_key('tenant-stale'))
+        self.assertGreater(redis_client.pttl(cache_key), 50000)
+
+        breaker = CircuitBreaker(failure_threshold=1)
+        with mock.patch.object(circuit_breaker, 'get_breaker',
+                return_value=breaker):
+            self.assertEqual(validate_client_token(redis_client, '',
+                'tenant-stale', cache_key), (False, None))
+
+            breaker.failure()
+            self.assertEqual(validate_client_token(redis_client, '',
+                'tenant-stale', cache_key), (True, 'the-token'))
+            valid, token, index_key = validate_tenant_token(redis_client,
+                '', 'tenant-stale')
+            self.assertTrue(valid)
+            self.assertEqual(index_key, cache_key)
+
+    def test_get_breaker(self):
+        circuit_breaker._reset_breaker()
+        breaker = circuit_breaker.get_breaker()
+        self.assertIs(breaker, circuit_breaker.get_breaker())
+        with mock.patch.object(conf.keystone, 'breaker', False):
+            self.assertIsNone(circuit_breaker.get_breaker())
+            self.assertFalse(circuit_breaker.serve_stale(0))
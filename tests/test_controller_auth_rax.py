@@ -59,3 +59,60 @@ class TestRaxAuth(V1Base):
             headers=hdrs)
         self.assertEqual(json.loads(response[0].decode('ascii'))
             ['description'], "mocking error")
+
+
+class TestRaxAuthBatch(V1Base):
+
+    def setUp(self):
+        super(TestRaxAuthBatch, self).setUp()
+        from stealth.impl_rax import auth_token_cache
+        from stealth.transport.wsgi.v1_0 import controller_auth
+        self.redis = controller_auth.auth_redis_client
+        self.keys = []
+        for tenant in ('tenant-a', 'tenant-b'):
+            data = {'token': 'token-' + tenant, 'tenant': tenant,
+                'expires': '2125-09-04T14:09:20.236Z',
+                'expires_ms': 4912668560236}
+            key = self.create_auth_token()
+            self.redis.set(key, auth_token_cache._encode_record(data))
+            self.keys.append(key)
+            self.addCleanup(self.redis.delete, key)
+
+    def batch(self, items):
+        response = self.simulate_post('/auth/batch',
+            body=json.dumps(items))
+        return json.loads(b''.join(response).decode('utf-8'))
+
+    def test_batch(self):
+        items = [['tenant-a', self.keys[0]], ['tenant-b', self.keys[1]],
+            ['tenant-a', self.keys[1]], ['tenant-c', 'missing-key']]
+        self.assertEqual(self.batch(items), [
+            {'project_id': 'tenant-a', 'valid': True},
+            {'project_id': 'tenant-b', 'valid': True},
+            {'project_id': 'tenant-a', 'valid': False},
+            {'project_id': 'tenant-c', 'valid': False}])
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+
+        # Large batches are streamed, chunk by chunk
+        with patch('stealth.conf.auth.batch_chunk_size', 3):
+            verdicts = self.batch(items * 3)
+        self.assertEqual([verdict['valid'] for verdict in verdicts],
+            [True, True, False, False] * 3)
+
+    def test_batch_malformed(self):
+        for body in ('not json', '{"tenant-a": "key"}', '[["tenant-a"]]'):
+            self.simulate_post('/auth/batch', body=body)
+            self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
+        with patch('stealth.conf.auth.batch_max_items', 1):
+            self.simulate_post('/auth/batch',
+                body=json.dumps([['tenant-a', 'key']] * 2))
+            self.assertEqual(self.srmock.status, falcon.HTTP_400)
+
+            # Bodies past the byte cap of the batch size are refused
+            self.simulate_post('/auth/batch',
+                body=json.dumps([['tenant-a', 'k' * 2048]]))
+            self.assertEqual(self.srmock.status, falcon.HTTP_400)
+            self.simulate_post('/auth/batch',
+                body=json.dumps([['tenant-a', 'k' * 512]]))
+            self.assertEqual(self.srmock.status, falcon.HTTP_200)
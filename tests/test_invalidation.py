@@ -0,0 +1,214 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import threading
+import time
+import mock
+import redis
+from stealth.impl_rax import auth_token_cache
+from stealth.impl_rax import invalidation
+from stealth.impl_rax.auth_token_cache import _revoke_data_from_cache, \
+    _retrieve_data_from_cache, _tenant_index_key
+from stealth.impl_rax.cache_backend import MemoryBackend
+from stealth.impl_rax.token_validation import get_auth_redis_client, \
+    start_cache_invalidation
+
+
+def side_effect_exception(*args, **kwargs):
+    raise Exception('mock exception')
+
+
+class TestInvalidation(TestCase):
+
+    def setUp(self):
+        super(TestInvalidation, self).setUp()
+        self.redis = get_auth_redis_client()
+        self.received = []
+        self.resyncs = []
+        self.event = threading.Event()
+
+    def _evict(self, action, cache_key, tenant):
+        self.received.append((action, cache_key, tenant))
+        self.event.set()
+
+    def _resync(self):
+        self.resyncs.append(1)
+
+    def test_subscriber(self):
+        subscriber = invalidation.Subscriber(self.redis, 'test:invalidate',
+            self._evict, self._resync)
+        subscriber.start()
+        try:
+            self.assertTrue(subscriber.wait_subscribed(5))
+            self.assertEqual(self.resyncs, [1])
+
+            self.redis.publish('test:invalidate',
+                invalidation._message(invalidation.REVOKE, 'key', 'tenant'))
+            self.assertTrue(self.event.wait(5))
+            self.assertEqual(self.received,
+                [(invalidation.REVOKE, 'key', 'tenant')])
+
+            self.redis.publish('test:invalidate', 'not json')
+            time.sleep(0.2)
+            stats = subscriber.stats()
+            self.assertEqual(stats['received'], 1)
+            self.assertEqual(stats['errors'], 1)
+            self.assertTrue(stats['subscribed'])
+            self.assertGreaterEqual(stats['lag_max'], 0.0)
+        finally:
+            subscriber.stop()
+            subscriber.join(5)
+
+    def test_subscriber_reconnect(self):
+        pubsub = self.redis.pubsub
+        calls = []
+
+        def side_effect_pubsub(*args, **kwargs):
+            calls.append(1)
+            if len(calls) == 1:
+                raise Exception('mock exception')
+            return pubsub(*args, **kwargs)
+
+        with mock.patch.object(self.redis, 'pubsub',
+                side_effect=side_effect_pubsub):
+            subscriber = invalidation.Subscriber(self.redis,
+                'test:invalidate', self._evict, self._resync)
+            subscriber.start()
+            try:
+                self.assertTrue(subscriber.wait_subscribed(5))
+                self.assertEqual(subscriber.stats()['reconnects'], 1)
+                self.assertEqual(self.resyncs, [1])
+            finally:
+                subscriber.stop()
+                subscriber.join(5)
+
+    def test_publish(self):
+        stats = invalidation.stats()
+        self.assertTrue(invalidation.publish(self.redis, invalidation.STORE,
+            'key', 'tenant'))
+        with mock.patch.object(self.redis, 'publish',
+                side_effect=side_effect_exception):
+            self.assertFalse(invalidation.publish(self.redis,
+                invalidation.STORE, 'key', 'tenant'))
+        self.assertEqual(invalidation.stats()['published'],
+            stats['published'] + 1)
+        self.assertEqual(invalidation.stats()['publish_errors'],
+            stats['publish_errors'] + 1)
+
+        subscriber = start_cache_invalidation(self.redis)
+        self.assertIs(subscriber, start_cache_invalidation(self.redis))
+
+    def test_queue(self):
+        stats = invalidation.stats()
+        with self.redis.pipeline(transaction=True) as pipe:
+            queued = invalidation.queue(pipe, invalidation.STORE, 'key',
+                'tenant')
+            # Not counted before the pipeline runs
+            self.assertEqual(invalidation.stats()['published'],
+                stats['published'])
+            pipe.execute()
+        invalidation.sent(queued)
+        self.assertEqual(invalidation.stats()['published'],
+            stats['published'] + 1)
+
+        # Messages of a failed EXEC are counted as errors
+        with mock.patch.object(redis.client.Pipeline, 'execute',
+                side_effect=side_effect_exception):
+            auth_token_cache._invalidate_username_cache(self.redis,
+                'tenant-queue')
+        self.assertEqual(invalidation.stats()['published'],
+            stats['published'] + 1)
+        self.assertEqual(invalidation.stats()['publish_errors'],
+            stats['publish_errors'] + 1)
+
+    def test_revoke(self):
+        self.redis.set('revoked-key', '{"token": "the-token", "tenant": \
+            "tenant-revoked", "expires": "2125-09-04T14:09:20.236Z"}')
+        self.redis.set(_tenant_index_key('tenant-revoked'), 'revoked-key')
+        self.assertIsNotNone(_retrieve_data_from_cache(self.redis,
+            url='http://mockurl', tenant='tenant-revoked',
+            cache_key='revoked-key'))
+
+        self.assertTrue(_revoke_data_from_cache(self.redis,
+            url='http://mockurl', cache_key='revoked-key'))
+        self.assertIsNone(self.redis.get(_tenant_index_key('tenant-revoked')))
+        self.assertIsNone(_retrieve_data_from_cache(self.redis,
+            url='http://mockurl', tenant='tenant-revoked',
+            cache_key='revoked-key'))
+
+        with mock.patch.object(self.redis, 'get',
+                side_effect=side_effect_exception):
+            self.assertFalse(_revoke_data_from_cache(self.redis,
+                url='http://mockurl', cache_key='revoked-key'))
+
+    def test_revoke_index(self):
+        record = '{"token": "the-token", "tenant": "tenant-revoked", \
+            "expires": "2125-09-04T14:09:20.236Z"}'
+        index_key = _tenant_index_key('tenant-revoked')
+        for backend in (self.redis, MemoryBackend()):
+            # The index of a newer token is left alone
+            backend.set('revoked-key', record)
+            backend.set(index_key, 'newer-key')
+            self.assertTrue(_revoke_data_from_cache(backend,
+                url='http://mockurl', cache_key='revoked-key'))
+            self.assertIsNone(backend.get('revoked-key'))
+            self.assertEqual(backend.get(index_key), b'newer-key')
+            backend.delete(index_key)
+
+        # A new token indexed between the check and the delete is kept
+        self.redis.set('revoked-key', record)
+        self.redis.set(index_key, 'revoked-key')
+        pipeline = self.redis.pipeline
+        raced = []
+
+        def racing_pipeline(*args, **kwargs):
+            pipe = pipeline(*args, **kwargs)
+            get = pipe.get
+
+            def racing_get(key):
+                # Another worker indexes a new token after the check
+                value = get(key)
+                if not raced:
+                    raced.append(key)
+                    self.redis.set(index_key, 'newer-key')
+                return value
+
+            pipe.get = racing_get
+            return pipe
+
+        with mock.patch.object(self.redis, 'pipeline', racing_pipeline):
+            self.assertTrue(_revoke_data_from_cache(self.redis,
+                url='http://mockurl', cache_key='revoked-key'))
+        self.assertEqual(raced, [index_key])
+        self.assertIsNone(self.redis.get('revoked-key'))
+        self.assertEqual(self.redis.get(index_key), b'newer-key')
+        self.redis.delete(index_key)
+
+    def test_evict_local(self):
+        auth_token_cache._usernames.set('tenant-evict', 'the-user-name',
+            time.time() + 60)
+        auth_token_cache._evict_local(invalidation.USERNAME,
+            tenant='tenant-evict')
+        self.assertIsNone(auth_token_cache._usernames.get('tenant-evict'))
+
+        auth_token_cache._tokens.set('evict-key', {}, time.time() + 60)
+        auth_token_cache._evict_local(invalidation.RENEW, 'evict-key')
+        self.assertIsNone(auth_token_cache._tokens.get('evict-key'))
+
+        auth_token_cache._tokens.set('evict-key', {}, time.time() + 60)
+        auth_token_cache._resync_local()
+        self.assertIsNone(auth_token_cache._tokens.get('evict-key'))
@@ -0,0 +1,75 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+from stealth.impl_rax import keystone_client
+from stealth.impl_rax.keystone_client import KeystoneClient
+# Mock requests
+import requests
+import requests_mock
+
+
+class TestKeystoneClient(TestCase):
+
+    @requests_mock.mock()
+    def test_request(self, m):
+        client = KeystoneClient(retries=2, backoff_factor=0.001)
+
+        m.get('http://mockurl.com/tenants/tenant-id/users', text='{}')
+        res = client.get('http://mockurl.com/tenants/tenant-id/users',
+            endpoint='tenant_users')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(m.last_request.timeout, (3.05, 10.0))
+
+        # Transient failures are retried
+        m.post('http://mockurl.com/tokens', [{'status_code': 503},
+            {'status_code': 200, 'text': '{}'}])
+        res = client.post('http://mockurl.com/tokens', endpoint='tokens')
+        self.assertEqual(res.status_code, 200)
+
+        # ... until the retries are used up
+        m.post('http://mockurl.com/tokens', status_code=502)
+        res = client.post('http://mockurl.com/tokens', endpoint='tokens')
+        self.assertEqual(res.status_code, 502)
+
+        # Other errors are returned at once
+        m.post('http://mockurl.com/tokens', status_code=404)
+        res = client.post('http://mockurl.com/tokens', endpoint='tokens')
+        self.assertEqual(res.status_code, 404)
+
+        m.get('http://mockurl.com/users/the-user-id/RAX-AUTH/admins',
+            exc=requests.exceptions.ConnectTimeout)
+        with self.assertRaises(requests.RequestException):
+            client.get('http://mockurl.com/users/the-user-id/RAX-AUTH/admins',
+                endpoint='user_admins')
+
+        stats = client.stats()
+        self.assertEqual(stats['tenant_users']['count'], 1)
+        self.assertEqual(stats['tenant_users']['errors'], 0)
+        self.assertEqual(stats['tokens']['count'], 6)
+        self.assertEqual(stats['tokens']['errors'], 4)
+        self.assertEqual(stats['user_admins']['count'], 3)
+        self.assertEqual(stats['user_admins']['errors'], 3)
+        self.assertGreaterEqual(stats['tokens']['max_seconds'], 0.0)
+
+    def test_get_client(self):
+        client = keystone_client.get_client()
+        self.assertIs(client, keystone_client.get_client())
+        keystone_client._reset_client()
+        self.assertIsNot(client, keystone_client.get_client())
+
+        client = KeystoneClient(keep_alive=False)
+        self.assertEqual(client._session.headers['Connection'], 'close')
@@ -14,10 +14,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+from unittest import TestCase
+import queue
 import uuid
+import mock
 from testfixtures import LogCapture
 
 from tests import V1Base
+from stealth import conf
 from stealth.util import log as logging
 
 
@@ -53,3 +57,120 @@ class TestLogging(V1Base):
         LOG = logging.getLogger(__name__)
         with LogCapture() as capture:
             LOG.info("Testing Request ID outside wsgi call")
+
+    def test_setup_once(self):
+        logging.setup()
+        handlers = list(logging.logging.getLogger().handlers)
+        with mock.patch.object(logging, 'dictConfig') as dict_config:
+            self.assertFalse(logging.setup())
+            logging.getLogger('tests.setup-once')
+            self.assertFalse(dict_config.called)
+
+            # Reloading is opt-in
+            self.assertTrue(logging.setup(reload=True))
+            self.assertEqual(dict_config.call_count, 1)
+        self.assertEqual(logging.logging.getLogger().handlers, handlers)
+
+
+class ListHandler(logging.logging.Handler):
+
+    def __init__(self):
+        super(ListHandler, self).__init__()
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class TestQueuedLogging(TestCase):
+
+    def record(self, level, request_id='req-{0}'.format(uuid.uuid4())):
+        record = logging.logging.LogRecord('stealth.test', level, __file__,
+            1, 'Tenant %s', ('tenant-id',), None)
+        record.request_id = request_id
+        return record
+
+    def test_queue(self):
+        target = ListHandler()
+        log_queue = queue.Queue(2)
+        handler = logging._QueueHandler(log_queue, (target,))
+        dropped = logging.stats()['dropped']
+
+        handler.handle(self.record(logging.logging.INFO))
+        handler.handle(self.record(logging.logging.INFO))
+        # The queue is full, the record is dropped and counted
+        handler.handle(self.record(logging.logging.INFO))
+        self.assertEqual(logging.stats()['dropped'], dropped + 1)
+
+        listener = logging._Listener(log_queue)
+        listener.start()
+        listener.stop()
+        self.assertEqual([record.getMessage() for record in target.records],
+            ['Tenant tenant-id', 'Tenant tenant-id'])
+
+    def test_sampling(self):
+        sampler = logging._RequestSampler(0.5)
+        kept = [sampler.filter(self.record(logging.logging.INFO,
+            'req-{0}'.format(i))) for i in range(1000)]
+        self.assertTrue(400 < kept.count(True) < 600)
+
+        # All the records of a request alike, errors and others always
+        record = self.record(logging.logging.INFO)
+        self.assertEqual(len(set(sampler.filter(record)
+            for i in range(10))), 1)
+        self.assertTrue(logging._RequestSampler(0).filter(
+            self.record(logging.logging.ERROR)))
+        self.assertTrue(logging._RequestSampler(0).filter(
+            self.record(logging.logging.INFO, 'Not in wsgi __call__')))
+        self.assertFalse(logging._RequestSampler(0).filter(
+            self.record(logging.logging.INFO)))
+
+    def test_setup(self):
+        self.addCleanup(logging.setup, reload=True)
+        with mock.patch.object(conf.logging, 'queue', True):
+            logging.setup(reload=True)
+        handlers = logging.logging.getLogger('stealth').handlers
+        self.assertEqual(len(handlers), 1)
+        self.assertIsInstance(handlers[0], logging._QueueHandler)
+        self.assertTrue(logging._listener._thread.is_alive())
+        self.assertIn('queued', logging.stats())
+
+        # Back to the handlers writing in the request thread
+        logging.setup(reload=True)
+        self.assertIsNone(logging._listener)
+        self.assertNotIsInstance(
+            logging.logging.getLogger('stealth').handlers[0],
+            logging._QueueHandler)
+
+
+class TestLazyLogging(TestCase):
+
+    def setUp(self):
+        super(TestLazyLogging, self).setUp()
+        self.handler = ListHandler()
+        self.logger = logging.logging.getLogger('tests.lazy')
+        self.logger.addHandler(self.handler)
+        self.logger.setLevel(logging.logging.INFO)
+        self.addCleanup(self.logger.removeHandler, self.handler)
+        self.LOG = logging.getLogger('tests.lazy')
+
+    def test_lazy(self):
+        argument = mock.MagicMock()
+        self.LOG.debug('Not emitted %s', argument)
+        self.LOG.debug('Not emitted', fields={'argument': argument})
+        self.assertFalse(self.handler.records)
+        self.assertFalse(argument.__str__.called)
+
+    def test_fields(self):
+        self.LOG.info('Renewed %(s_tenant)s', {'s_tenant': 'tenant-id'},
+            fields={'ttl': 60, 'shard': '50%'})
+        self.LOG.info('Shed', fields={'reason': 'timed_out'})
+        self.LOG.info('Plain %s', 'message')
+        self.assertEqual([record.getMessage()
+            for record in self.handler.records], [
+                'Renewed tenant-id ttl=60 shard=50%',
+                'Shed reason=timed_out', 'Plain message'])
+        self.assertEqual(self.handler.records[1].fields,
+            {'reason': 'timed_out'})
+        self.assertEqual(self.handler.records[0].request_id,
+            'Not in wsgi __call__')
@@ -0,0 +1,72 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import time
+from stealth.common.lru import LRUCache
+
+
+class TestLRUCache(TestCase):
+
+    def test_lru_cache(self):
+        cache = LRUCache(max_entries=2)
+        later = time.time() + 60
+        cache.set('a', 1, later)
+        cache.set('b', 2, later)
+        self.assertEqual(cache.get('a'), 1)
+
+        # 'b' is the least recently used
+        cache.set('c', 3, later)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('c'), 3)
+
+        cache.set('a', 1, time.time() - 1)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(len(cache), 1)
+
+        cache.delete('c')
+        cache.delete('missing')
+        self.assertIsNone(cache.get('c'))
+
+        cache.set('d', 4, later)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+
+    def test_lru_cache_bytes(self):
+        cache = LRUCache(max_entries=10, max_bytes=100)
+        later = time.time() + 60
+        cache.set('a', 1, later, size=60)
+        cache.set('b', 2, later, size=30)
+        cache.set('b', 2, later, size=40)
+        self.assertEqual(cache.stats()['bytes'], 100)
+
+        # 'a' is evicted to make room
+        cache.set('c', 3, later, size=50)
+        self.assertIsNone(cache.get('a'))
+        self.assertEqual(cache.get('b'), 2)
+
+        cache.set('d', 4, time.time() - 1, size=10)
+        self.assertIsNone(cache.get('d'))
+
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+        self.assertEqual(stats['evictions'], 1)
+        self.assertEqual(stats['expirations'], 1)
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['bytes'], 90)
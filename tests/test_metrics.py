@@ -0,0 +1,136 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import os
+import socket
+import time
+import falcon
+import mock
+from stealth.impl_rax import token_validation
+from stealth.impl_rax.token_validation import get_auth_redis_client
+from stealth.util import metrics
+from stealth.util.metrics import Registry
+from tests import V1Base
+
+
+class TestMetrics(TestCase):
+
+    def setUp(self):
+        super(TestMetrics, self).setUp()
+        self.redis = get_auth_redis_client()
+        self.prefix = 'test-metrics:{0}:'.format(time.time())
+        self.addCleanup(self.cleanup)
+
+    def cleanup(self):
+        keys = list(self.redis.scan_iter(self.prefix + '*'))
+        if keys:
+            self.redis.delete(*keys)
+
+    def registry(self, entries=0):
+        registry = Registry(prefix=self.prefix)
+        registry.counter('requests_total', 'Requests', ('outcome',))
+        registry.histogram('latency_seconds', 'Latency', buckets=(0.1, 1.0))
+        registry.gauge('entries', 'Entries', func=lambda: entries)
+        return registry
+
+    def test_render(self):
+        registry = self.registry(entries=7)
+        requests = registry.counter('requests_total', 'Requests',
+            ('outcome',))
+        requests.inc(outcome='hit')
+        requests.inc(2, outcome='hit')
+        requests.inc(outcome='un"known')
+        latency = registry.histogram('latency_seconds', 'Latency')
+        latency.observe(0.05)
+        latency.observe(0.5)
+        latency.observe(5)
+        self.assertRaises(ValueError, requests.inc)
+        self.assertRaises(ValueError, registry.gauge, 'requests_total', '')
+
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP entries Entries',
+            '# TYPE entries gauge',
+            'entries 7',
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1.0"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_count 3',
+            'latency_seconds_sum 5.55',
+            '# HELP requests_total Requests',
+            '# TYPE requests_total counter',
+            'requests_total{outcome="hit"} 3',
+            'requests_total{outcome="un\\"known"} 1'])
+
+    def test_aggregate(self):
+        # Two workers sharing Redis
+        workers = [self.registry(entries=3), self.registry(entries=4)]
+        for count, registry in enumerate(workers, 1):
+            registry.counter('requests_total', '', ('outcome',)).inc(count,
+                outcome='hit')
+        self.assertTrue(workers[0].flush(self.redis))
+
+        # Only what was counted since the last flush is added
+        workers[0].counter('requests_total', '', ('outcome',)).inc(
+            outcome='hit')
+        self.assertTrue(workers[0].flush(self.redis))
+        self.assertTrue(workers[0].flush(self.redis))
+
+        with mock.patch.object(os, 'getpid', return_value=-1):
+            text = workers[1].render(self.redis)
+        self.assertIn('requests_total{outcome="hit"} 4\n', text)
+        self.assertIn('entries 7\n', text)
+
+        # The gauges of the workers gone are dropped
+        self.redis.delete('{0}gauges:{1}:{2}'.format(self.prefix,
+            socket.gethostname(), -1))
+        text = workers[0].render(self.redis)
+        self.assertIn('entries 3\n', text)
+        self.assertEqual(len(self.redis.smembers(self.prefix + 'workers')), 1)
+
+        # A forked worker starts from zero
+        workers[0]._reset()
+        self.assertEqual(workers[0].collect()[0], {})
+
+    def test_instrumentation(self):
+        counts = metrics.REGISTRY.collect()[0]
+        token_validation.record_outcome('hit', time.time())
+        sample = 'stealth_auth_requests_total{outcome="hit"}'
+        self.assertEqual(metrics.REGISTRY.collect()[0][sample],
+            counts.get(sample, 0) + 1)
+
+        sample = 'stealth_redis_seconds_count{operation="retrieve"}'
+        before = counts.get(sample, 0)
+        token_validation.validate_client_token(self.redis, '', 'tenant-id',
+            'missing-key')
+        self.assertEqual(metrics.REGISTRY.collect()[0][sample], before + 1)
+        self.assertIn('stealth_local_cache_entries{cache="usernames"}',
+            metrics.REGISTRY.collect()[1])
+
+
+class TestMetricsResource(V1Base):
+
+    def test_metrics(self):
+        token_validation.record_outcome('unauthorized', time.time())
+        with mock.patch('stealth.conf.metrics.aggregate', False):
+            response = self.simulate_get('/metrics')
+        self.assertEqual(self.srmock.status, falcon.HTTP_200)
+        self.assertEqual(self.srmock.headers_dict['content-type'],
+            metrics.CONTENT_TYPE)
+        self.assertIn('# TYPE stealth_auth_requests_total counter',
+            b''.join(response).decode('utf-8'))
@@ -0,0 +1,173 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import os
+import signal
+import socket
+import tempfile
+import threading
+import time
+from http import client
+from stealth.transport.wsgi import prefork
+
+
+def app(environ, start_response):
+    if environ['PATH_INFO'] == '/stream':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return iter([b'a', b'b'])
+    # Leaves the request body unread
+    body = str(os.getpid()).encode()
+    start_response('200 OK', [('Content-Length', str(len(body)))])
+    return [body]
+
+
+class TestPrefork(TestCase):
+
+    def serve(self, sock, threads=2):
+        server = prefork.WSGIServer(sock, app, threads=threads,
+            keep_alive=2.0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.stop)
+        return server
+
+    def test_keep_alive(self):
+        sock = prefork.create_socket('127.0.0.1', 0, backlog=8)
+        self.serve(sock)
+
+        conn = client.HTTPConnection('127.0.0.1', sock.getsockname()[1],
+            timeout=5)
+        conn.request('POST', '/auth', body=b'x' * 100000)
+        res = conn.getresponse()
+        self.assertEqual(res.status, 200)
+        self.assertEqual(res.version, 11)
+        self.assertEqual(res.read(), str(os.getpid()).encode())
+        first = conn.sock
+
+        # The connection is reused, past the unread body
+        conn.request('GET', '/auth')
+        res = conn.getresponse()
+        self.assertEqual(res.status, 200)
+        res.read()
+        self.assertIs(conn.sock, first)
+
+        # Responses without a length end with the connection
+        conn.request('GET', '/stream')
+        res = conn.getresponse()
+        self.assertEqual(res.getheader('Connection'), 'close')
+        self.assertEqual(res.read(), b'ab')
+        conn.close()
+
+    def test_busy(self):
+        sock = prefork.create_socket('127.0.0.1', 0, backlog=8)
+        server = self.serve(sock, threads=1)
+        port = sock.getsockname()[1]
+
+        # The only thread is held by a kept-alive connection
+        first = client.HTTPConnection('127.0.0.1', port, timeout=5)
+        first.request('GET', '/auth')
+        first.getresponse().read()
+
+        # ... so the next connection waits in the backlog, unaccepted
+        second = client.HTTPConnection('127.0.0.1', port, timeout=0.5)
+        second.request('GET', '/auth')
+        self.assertRaises(socket.timeout, second.getresponse)
+        self.assertEqual(server._executor._work_queue.qsize(), 0)
+        second.close()
+
+        first.close()
+        third = client.HTTPConnection('127.0.0.1', port, timeout=5)
+        third.request('GET', '/auth')
+        self.assertEqual(third.getresponse().status, 200)
+        third.close()
+
+    def test_unix_socket(self):
+        path = os.path.join(tempfile.mkdtemp(), 'stealth.sock')
+        sock = prefork.create_socket(None, None, unix_socket=path)
+        self.serve(sock)
+
+        conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        conn.settimeout(5)
+        conn.connect(path)
+        conn.sendall(b'GET /auth HTTP/1.1\r\nHost: localhost\r\n'
+            b'Connection: close\r\n\r\n')
+        response = b''
+        while True:
+            data = conn.recv(4096)
+            if not data:
+                break
+            response += data
+        conn.close()
+        self.assertTrue(response.startswith(b'HTTP/1.1 200 OK'))
+        self.assertIn(b'Connection: close', response)
+
+    def request_pid(self, port):
+        deadline = time.time() + 5
+        while True:
+            try:
+                conn = client.HTTPConnection('127.0.0.1', port, timeout=5)
+                conn.request('GET', '/auth')
+                pid = int(conn.getresponse().read())
+                conn.close()
+                return pid
+            except (OSError, client.HTTPException, ValueError):
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.05)
+
+    def test_arbiter(self):
+        sock = prefork.create_socket('127.0.0.1', 0, backlog=8)
+        port = sock.getsockname()[1]
+        master = os.fork()
+        if master == 0:
+            code = 0
+            try:
+                prefork.Arbiter(app, sock, workers=2, threads=2,
+                    keep_alive=1.0, graceful_timeout=2.0).run()
+            except BaseException:
+                code = 1
+            finally:
+                os._exit(code)
+        sock.close()
+
+        try:
+            worker = self.request_pid(port)
+            self.assertNotIn(worker, (os.getpid(), master))
+
+            # A graceful restart replaces the workers
+            os.kill(master, signal.SIGHUP)
+            deadline = time.time() + 5
+            while self.request_pid(port) == worker and \
+                    time.time() < deadline:
+                time.sleep(0.05)
+            with self.assertRaises(ProcessLookupError):
+                deadline = time.time() + 5
+                while time.time() < deadline:
+                    os.kill(worker, 0)
+                    time.sleep(0.05)
+        finally:
+            os.kill(master, signal.SIGTERM)
+            deadline = time.time() + 10
+            while True:
+                pid, status = os.waitpid(master, os.WNOHANG)
+                if pid or time.time() > deadline:
+                    break
+                time.sleep(0.05)
+        self.assertEqual(pid, master)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
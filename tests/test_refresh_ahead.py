@@ -0,0 +1,112 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import threading
+import time
+import mock
+from stealth.impl_rax import refresh_ahead
+from stealth.impl_rax.refresh_ahead import RefreshAhead
+from stealth.impl_rax.token_validation import get_auth_redis_client
+
+
+def side_effect_exception(*args):
+    raise Exception('mock exception')
+
+
+class TestRefreshAhead(TestCase):
+
+    def wait_idle(self, refresher):
+        deadline = time.time() + 5
+        while refresher.stats()['pending'] and time.time() < deadline:
+            time.sleep(0.01)
+
+    def test_is_due(self):
+        now_ms = int(time.time() * 1000)
+        refresher = RefreshAhead(fraction=0.5)
+        self.assertTrue(refresher.is_due({'issued_ms': now_ms - 6000,
+            'expires_ms': now_ms + 4000}))
+        self.assertFalse(refresher.is_due({'issued_ms': now_ms - 4000,
+            'expires_ms': now_ms + 6000}))
+        # Records without the issue time are left alone
+        self.assertFalse(refresher.is_due({'expires_ms': now_ms}))
+
+        refresher = RefreshAhead(fraction=0)
+        self.assertFalse(refresher.is_due({'issued_ms': now_ms - 6000,
+            'expires_ms': now_ms + 4000}))
+
+    def test_submit(self):
+        refresher = RefreshAhead(workers=2)
+        release = threading.Event()
+
+        def renew():
+            release.wait(5)
+            return True
+
+        self.assertTrue(refresher.submit('key-a', renew))
+        # A renewal is under way for the key
+        self.assertFalse(refresher.submit('key-a', renew))
+        release.set()
+        self.wait_idle(refresher)
+
+        self.assertTrue(refresher.submit('key-b', side_effect_exception))
+        self.wait_idle(refresher)
+
+        stats = refresher.stats()
+        self.assertEqual(stats['scheduled'], 2)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(stats['renewed'], 1)
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['pending'], 0)
+
+    def test_submit_lease(self):
+        test_redis = get_auth_redis_client()
+        test_redis.delete('lease:refresh:key-leased')
+        first = RefreshAhead(lease_ttl=10.0)
+        second = RefreshAhead(lease_ttl=10.0)
+
+        self.assertTrue(first.submit('key-leased', lambda: True,
+            redis_client=test_redis))
+        self.wait_idle(first)
+        # The other workers leave the renewal alone until the lease ends
+        self.assertFalse(second.submit('key-leased', lambda: True,
+            redis_client=test_redis))
+        test_redis.delete('lease:refresh:key-leased')
+        self.assertTrue(second.submit('key-leased', lambda: True,
+            redis_client=test_redis))
+        self.wait_idle(second)
+        test_redis.delete('lease:refresh:key-leased')
+
+        # The lease is taken without holding the lock, the key reserved
+        seen = []
+
+        def set_lease(*args, **kwargs):
+            seen.append((second._lock.locked(),
+                'key-leased' in second._pending))
+            return None
+
+        lease_client = mock.Mock()
+        lease_client.set.side_effect = set_lease
+        self.assertFalse(second.submit('key-leased', lambda: True,
+            redis_client=lease_client))
+        self.assertEqual(seen, [(False, True)])
+        self.assertEqual(second.stats()['pending'], 0)
+
+    def test_get_refresher(self):
+        refresher = refresh_ahead.get_refresher()
+        self.assertIs(refresher, refresh_ahead.get_refresher())
+        refresh_ahead._reset_refresher()
+        self.assertIsNot(refresher, refresh_ahead.get_refresher())
@@ -0,0 +1,95 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import threading
+import time
+import mock
+from stealth.impl_rax.single_flight import SingleFlight, RedisSingleFlight
+from stealth.impl_rax.token_validation import get_auth_redis_client
+
+
+def side_effect_exception(*args, **kwargs):
+    raise Exception('mock exception')
+
+
+class TestSingleFlight(TestCase):
+
+    def test_single_flight(self):
+        flight = SingleFlight()
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def work():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        results = []
+
+        def caller():
+            results.append(flight.do('tenant-id', work))
+
+        threads = [threading.Thread(target=caller) for i in range(5)]
+        threads[0].start()
+        started.wait()
+        for thread in threads[1:]:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, ['result'] * 5)
+
+        # A finished call is not remembered
+        self.assertEqual(flight.do('tenant-id', lambda: 'again'), 'again')
+
+        with self.assertRaises(Exception):
+            flight.do('tenant-id', side_effect_exception)
+
+    def test_redis_single_flight(self):
+        test_redis = get_auth_redis_client()
+        flight = RedisSingleFlight(lease_ttl=1.0, wait=0.2,
+            poll_interval=0.01, prefix='lease:test:')
+
+        # Without a redis client it is a plain in-process single flight
+        self.assertEqual(flight.do('tenant-id', lambda: 'local'), 'local')
+
+        # The lease is released once the work is done
+        self.assertEqual(flight.do('tenant-id', lambda: 'leased',
+            redis_client=test_redis), 'leased')
+        self.assertIsNone(test_redis.get('lease:test:tenant-id'))
+
+        # Another process holds the lease and publishes its result
+        test_redis.set('lease:test:tenant-id', 'other', px=1000)
+        self.assertEqual(flight.do('tenant-id', lambda: 'leased',
+            lookup=lambda: 'published', redis_client=test_redis),
+            'published')
+
+        # ... or never does, so the work runs once the wait is over
+        self.assertEqual(flight.do('tenant-id', lambda: 'leased',
+            lookup=lambda: None, redis_client=test_redis), 'leased')
+        self.assertEqual(test_redis.get('lease:test:tenant-id'), b'other')
+        test_redis.delete('lease:test:tenant-id')
+
+        with mock.patch.object(test_redis, 'set',
+                side_effect=side_effect_exception):
+            self.assertEqual(flight.do('tenant-id', lambda: 'unleased',
+                redis_client=test_redis), 'unleased')
@@ -0,0 +1,122 @@
+#
+# Copyright (c) 2015 Xuan Yu xuanyu1@gmail.com
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or
+# implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from unittest import TestCase
+import time
+import mock
+import simplejson as json
+from stealth import conf
+from stealth.impl_rax import token_lifetime
+from stealth.impl_rax.auth_token import AdminToken, UserToken
+from stealth.impl_rax.auth_token_cache import _send_data_to_cache, \
+    _invalidate_username_cache
+from stealth.impl_rax.token_validation import get_auth_redis_client
+# Mock requests
+import requests_mock
+
+
+class TestTokenLifetime(TestCase):
+
+    def setUp(self):
+        super(TestTokenLifetime, self).setUp()
+        token_lifetime._reset_rates()
+        self.addCleanup(token_lifetime._reset_rates)
+
+    def test_request_rates(self):
+        rates = token_lifetime.RequestRates(window=10.0)
+        self.assertEqual(rates.rate('tenant-id'), 0)
+        with mock.patch.object(time, 'time', return_value=1000.0):
+            for _ in range(20):
+                rates.hit('tenant-id')
+            self.assertAlmostEqual(rates.rate('tenant-id'), 2.0)
+
+        # The rate decays while the tenant is idle
+        with mock.patch.object(time, 'time', return_value=1010.0):
+            self.assertAlmostEqual(rates.rate('tenant-id'), 2.0 / 2.71828,
+                places=3)
+
+    @mock.patch.multiple(conf.auth, token_lifetime=7200, max_cache_life=3600,
+        adaptive_lifetime=False)
+    def test_fixed_lifetime(self):
+        # Capped at max_cache_life
+        self.assertEqual(token_lifetime.impersonation_lifetime('tenant-id'),
+            3600)
+        token_lifetime.record_request('tenant-id')
+        self.assertIsNone(token_lifetime._rates)
+
+        now_ms = int(time.time() * 1000)
+        data = {'expires_ms': now_ms + 7200000, 'issued_ms': now_ms}
+        self.assertEqual(token_lifetime.cache_expires_ms(data),
+            now_ms + 3600000)
+        data['expires_ms'] = now_ms + 60000
+        self.assertEqual(token_lifetime.cache_expires_ms(data),
+            now_ms + 60000)
+
+    @mock.patch.multiple(conf.auth, max_cache_life=86400,
+        adaptive_lifetime=True, adaptive_min_lifetime=1800,
+        adaptive_max_lifetime=43200, adaptive_hot_rate=1.0,
+        adaptive_window=100.0)
+    def test_adaptive_lifetime(self):
+        self.assertEqual(token_lifetime.impersonation_lifetime('tenant-cold'),
+            1800)
+
+        # Half the hot rate, half way between the lifetimes
+        with mock.patch.object(time, 'time', return_value=1000.0):
+            for _ in range(50):
+                token_lifetime.record_request('tenant-warm')
+            self.assertEqual(
+                token_lifetime.impersonation_lifetime('tenant-warm'),
+                1800 + (43200 - 1800) // 2)
+
+            for _ in range(500):
+                token_lifetime.record_request('tenant-hot')
+            self.assertEqual(
+                token_lifetime.impersonation_lifetime('tenant-hot'), 43200)
+
+            with mock.patch.object(conf.auth, 'max_cache_life', 3600):
+                self.assertEqual(
+                    token_lifetime.impersonation_lifetime('tenant-hot'),
+                    3600)
+
+    @requests_mock.mock()
+    @mock.patch.multiple(conf.auth, token_lifetime=7200, max_cache_life=3600)
+    def test_impersonation(self, m):
+        _invalidate_username_cache(None, 'tenant-id')
+        self.addCleanup(_invalidate_username_cache, None, 'tenant-id')
+        admintoken = AdminToken(url='http://mockurl.com', tenant='tenant-id',
+            passwd='passwd', token='thetoken')
+        m.post('http://mockurl.com/tokens', text='\
+            {"access": {"token": {"id": "the-token", \
+            "expires": "2125-09-04T14:09:20.236Z"}}}')
+        m.get('http://mockurl.com/tenants/tenant-id/users', text='\
+            {"users": [{"id": "the-user-id"}]}')
+        m.get('http://mockurl.com/users/the-user-id/RAX-AUTH/admins', text='\
+            {"users": [{"username": "the-user-name"}]}')
+        m.post('http://mockurl.com/RAX-AUTH/impersonation-tokens', text='\
+            {"access": {"token": {"id": "the-token",\
+             "expires": "2125-09-04T14:09:20.236Z"}}}')
+        usertoken = UserToken(url='http://mockurl.com', tenant='tenant-id',
+            admintoken=admintoken)
+        self.assertEqual(json.loads(m.last_request.text)[
+            'RAX-AUTH:impersonation']['expire-in-seconds'], 3600)
+
+        # The record leaves the cache at max_cache_life
+        redis_client = get_auth_redis_client()
+        retval, cache_key = _send_data_to_cache(redis_client, '', usertoken)
+        self.assertTrue(retval)
+        self.assertLessEqual(redis_client.pttl(cache_key), 3600000)
+        self.assertGreater(redis_client.pttl(cache_key), 3500000)
+        redis_client.delete(cache_key)
@@ -15,9 +15,12 @@
 # limitations under the License.
 
 from unittest import TestCase
-from stealth.impl_rax.auth_token import AdminToken
+from stealth.impl_rax.auth_token import AdminToken, TokenBase
 from stealth.impl_rax.token_validation import get_auth_redis_client, \
-    validate_client_token, validate_client_impersonation
+    validate_client_token, validate_client_impersonation, \
+    validate_tenant_token
+from stealth.impl_rax import auth_token_cache
+from stealth.impl_rax import refresh_ahead
 from stealth import conf
 import mock
 # Mock requests
@@ -28,18 +31,25 @@ import dateutil.parser
 import fakeredis
 import redis
 import simplejson as json
+import time
 
 
 redis = fakeredis
 
 
+def clear_local_cache():
+    if auth_token_cache._tokens is not None:
+        auth_token_cache._tokens.clear()
+    auth_token_cache._failures.clear()
+
+
 def side_effect_exception(*args):
     raise Exception('mock exception')
 
 
 def side_effect_redis_getdata(*args):
     return '{"token": "the-token", "tenant": "tenant-id", \
-        "expires": "2025-09-04T14:09:20.236Z"}'
+        "expires": "2125-09-04T14:09:20.236Z"}'
 
 
 def side_effect_redis_getdata_expired(*args):
@@ -49,6 +59,16 @@ def side_effect_redis_getdata_expired(*args):
 
 class TestAuthTokenCache(TestCase):
 
+    def setUp(self):
+        super(TestAuthTokenCache, self).setUp()
+        clear_local_cache()
+        # Records read through mocked gets are migrated under this key
+        get_auth_redis_client().delete('cache-key',
+            auth_token_cache._blacklist_key('tenant-id'))
+        self.addCleanup(clear_local_cache)
+        self.addCleanup(get_auth_redis_client().delete,
+            auth_token_cache._blacklist_key('tenant-id'))
+
     def test_get_auth_redis_client(self):
         origval = conf.auth_redis.ssl_enable
         conf.auth_redis.ssl_enable = 'None'
@@ -66,6 +86,7 @@ class TestAuthTokenCache(TestCase):
         self.assertFalse(retval)
         self.assertIsNone(token)
 
+        clear_local_cache()
         with mock.patch.object(test_redis, 'get',
                 side_effect=side_effect_redis_getdata):
             retval, token = validate_client_token(
@@ -76,6 +97,7 @@ class TestAuthTokenCache(TestCase):
             self.assertTrue(retval)
             self.assertEqual(token, 'the-token')
 
+        clear_local_cache()
         with mock.patch.object(test_redis, 'get',
                 side_effect=side_effect_redis_getdata_expired):
             retval, token = validate_client_token(
@@ -86,6 +108,7 @@ class TestAuthTokenCache(TestCase):
             self.assertFalse(retval)
             self.assertIsNone(token)
 
+        clear_local_cache()
         with mock.patch.object(test_redis, 'get',
                 side_effect=side_effect_exception):
             retval, token = validate_client_token(
@@ -94,9 +117,10 @@ class TestAuthTokenCache(TestCase):
             self.assertFalse(retval)
             self.assertIsNone(token)
 
+        clear_local_cache()
         with mock.patch.object(test_redis, 'get',
                 side_effect=side_effect_redis_getdata):
-            with mock.patch.object(dateutil.parser, 'parse',
+            with mock.patch.object(auth_token_cache, '_expires_ms',
                     side_effect=side_effect_exception):
                 retval, token = validate_client_token(test_redis,
                     url='http://mockurl',
@@ -137,3 +161,157 @@ class TestAuthTokenCache(TestCase):
         self.assertFalse(retval)
         self.assertIsNone(token)
         self.assertIsNone(cache_key)
+
+        # The rejected tenant is blacklisted, across the workers too
+        stats = auth_token_cache.blacklist_stats()
+        calls = m.call_count
+        auth_token_cache._failures.clear()
+        retval, token, cache_key = validate_client_impersonation(test_redis,
+            url='http://mockurl', tenant='tenant-id', admintoken=token_data)
+        self.assertFalse(retval)
+        self.assertEqual(m.call_count, calls)
+        self.assertEqual(auth_token_cache.blacklist_stats()['suppressed'].get(
+            'rejected', 0), stats['suppressed'].get('rejected', 0) + 1)
+        self.assertLessEqual(test_redis.ttl(
+            auth_token_cache._blacklist_key('tenant-id')),
+            conf.auth.blacklist_ttl_rejected)
+
+    @requests_mock.mock()
+    def test_validate_tenant_token(self, m):
+        test_redis = get_auth_redis_client()
+        retval, token, cache_key = validate_tenant_token(test_redis,
+            url='http://mockurl', tenant='tenant-unknown')
+        self.assertFalse(retval)
+        self.assertIsNone(token)
+        self.assertIsNone(cache_key)
+
+        token_data = AdminToken(url='http://mockurl', tenant='tenant-id',
+            passwd='passwd', token='thetoken')
+        m.get('http://mockurl/tenants/tenant-cached/users', text='\
+            {"users": [{"id": "the-user-id"}]}')
+        m.get('http://mockurl/users/the-user-id/RAX-AUTH/admins', text='\
+            {"users": [{"username": "the-user-name"}]}')
+        m.post('http://mockurl/RAX-AUTH/impersonation-tokens', text='\
+            {"access": {"token": {"id": "the-token",\
+             "expires": "2125-09-04T14:09:20.236Z"}}}')
+        retval, token, cache_key = validate_client_impersonation(test_redis,
+            url='http://mockurl', tenant='tenant-cached',
+            admintoken=token_data)
+        self.assertTrue(retval)
+
+        # The second lookup is answered from the tenant index
+        calls = m.call_count
+        retval, token, index_key = validate_tenant_token(test_redis,
+            url='http://mockurl', tenant='tenant-cached')
+        self.assertTrue(retval)
+        self.assertEqual(index_key, cache_key)
+        self.assertEqual(token['token'], 'the-token')
+        self.assertEqual(m.call_count, calls)
+
+        with mock.patch.object(TokenBase, 'will_expire_soon_ms',
+                side_effect=side_effect_exception):
+            retval, token, cache_key = validate_tenant_token(test_redis,
+                url='http://mockurl', tenant='tenant-cached')
+            self.assertFalse(retval)
+
+    def test_validate_client_token_migration(self):
+        test_redis = get_auth_redis_client()
+        test_redis.set('old-cache-key', side_effect_redis_getdata())
+        test_redis.pexpireat('old-cache-key', 4912668560236)
+
+        retval, token = validate_client_token(test_redis,
+            url='http://mockurl', tenant='tenant-id',
+            cache_key='old-cache-key')
+        self.assertTrue(retval)
+        self.assertEqual(token, 'the-token')
+
+        # The record now carries its epoch expiry, with the same TTL
+        record = auth_token_cache._decode_record(
+            test_redis.get('old-cache-key'))
+        self.assertEqual(record['expires_ms'], 4912668560236)
+        self.assertAlmostEqual(test_redis.pttl('old-cache-key') / 1000.0,
+            4912668560.236 - time.time(), delta=5)
+
+        # ... and is read without parsing the expiry time string
+        clear_local_cache()
+        with mock.patch.object(auth_token_cache, '_expires_ms',
+                side_effect=side_effect_exception):
+            retval, token = validate_client_token(test_redis,
+                url='http://mockurl', tenant='tenant-id',
+                cache_key='old-cache-key')
+            self.assertTrue(retval)
+        test_redis.delete('old-cache-key')
+
+    def test_migration_race(self):
+        test_redis = get_auth_redis_client()
+        test_redis.set('old-cache-key', side_effect_redis_getdata())
+        newer = json.dumps({'token': 'newer-token',
+            'tenant': 'tenant-id', 'expires': '2125-09-04T14:09:20.236Z',
+            'expires_ms': 4912668560236}).encode('utf-8')
+        get = test_redis.get
+
+        def renewing_get(key):
+            # A renewal stores a newer record right after the read
+            value = get(key)
+            test_redis.set(key, newer)
+            return value
+
+        with mock.patch.object(test_redis, 'get', renewing_get):
+            retval, token = validate_client_token(test_redis,
+                url='http://mockurl', tenant='tenant-id',
+                cache_key='old-cache-key')
+        self.assertTrue(retval)
+        self.assertEqual(token, 'the-token')
+        # The migration leaves the newer record alone
+        self.assertEqual(test_redis.get('old-cache-key'), newer)
+        test_redis.delete('old-cache-key')
+
+    @requests_mock.mock()
+    def test_validate_client_token_refresh_ahead(self, m):
+        test_redis = get_auth_redis_client()
+        test_redis.delete('lease:refresh:renew-key')
+        refresh_ahead._reset_refresher()
+        now_ms = int(time.time() * 1000)
+        data = {'token': 'the-token', 'tenant': 'tenant-renew',
+            'expires': '2125-09-04T14:09:20.236Z',
+            'expires_ms': now_ms + 60000, 'issued_ms': now_ms - 3600000}
+        test_redis.set('renew-key', auth_token_cache._encode_record(data),
+            pxat=data['expires_ms'])
+
+        token_data = AdminToken(url='http://mockurl', tenant='tenant-id',
+            passwd='passwd', token='thetoken')
+        m.get('http://mockurl/tenants/tenant-renew/users', text='\
+            {"users": [{"id": "the-user-id"}]}')
+        m.get('http://mockurl/users/the-user-id/RAX-AUTH/admins', text='\
+            {"users": [{"username": "the-user-name"}]}')
+        m.post('http://mockurl/RAX-AUTH/impersonation-tokens', text='\
+            {"access": {"token": {"id": "the-new-token",\
+             "expires": "2125-09-04T14:09:20.236Z"}}}')
+
+        # The request is served with the current token right away
+        retval, token = validate_client_token(test_redis,
+            url='http://mockurl', tenant='tenant-renew',
+            cache_key='renew-key', admintoken=token_data)
+        self.assertTrue(retval)
+        self.assertEqual(token, 'the-token')
+
+        refresher = refresh_ahead.get_refresher()
+        deadline = time.time() + 5
+        while refresher.stats()['pending'] and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertEqual(refresher.stats()['renewed'], 1)
+
+        # ... and the client keeps its cache_key for the renewed token
+        clear_local_cache()
+        retval, token = validate_client_token(test_redis,
+            url='http://mockurl', tenant='tenant-renew',
+            cache_key='renew-key', admintoken=token_data)
+        self.assertTrue(retval)
+        self.assertEqual(token, 'the-new-token')
+        self.assertEqual(test_redis.get(
+            auth_token_cache._tenant_index_key('tenant-renew')),
+            b'renew-key')
+        self.assertEqual(refresher.stats()['scheduled'], 1)
+
+        test_redis.delete('renew-key', 'lease:refresh:renew-key',
+            auth_token_cache._tenant_index_key('tenant-renew'))
@@ -38,3 +38,20 @@ class TestDriver(V1Base):
                           return_value=mock_server_object):
             app_container = Driver()
             app_container.listen()
+
+    def test_driver_prefork(self):
+        from stealth import conf
+        from stealth.transport.wsgi import prefork
+        from stealth.transport.wsgi.driver import Driver
+        origval = conf.server.mode
+        conf.server.mode = 'prefork'
+        sock = prefork.create_socket('127.0.0.1', 0)
+        try:
+            with patch.object(prefork, 'create_socket', return_value=sock):
+                with patch.object(prefork.Arbiter, 'run') as run:
+                    app_container = Driver()
+                    app_container.listen()
+                    self.assertEqual(run.call_count, 1)
+        finally:
+            conf.server.mode = origval
+            sock.close()